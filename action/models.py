@@ -31,7 +31,7 @@
 from django.db import models
 from django.core.cache import cache
 
-from campaign.models import Campaign
+from campaign.models import Campaign, CampaignStats, CampaignMembership
 from profile.models import Profile
 from status.models import Entry
 from status.view_objects import EntryView
@@ -92,6 +92,8 @@ class Action(models.Model):
                           msg = 'pledged to <strong>%s</strong>' % self.title,
                           campaign = self.campaign)
             entry.save()
+            CampaignStats.objects.add(self.campaign, geuser, num_pledges = 1, num_ideas = 1)
+            CampaignMembership.objects.touch(self.campaign, geuser)
             EntryView.refresh_recent_activity(self.campaign)
             Entry.objects.clear_dashboard_cache(self.campaign)
 
@@ -35,7 +35,7 @@ from django.template.loader         import render_to_string
 
 from core.util              import get_current_organization, get_current_campaign
 from core.util              import chop_campaign, ge_login_required
-from campaign.models        import Campaign
+from campaign.models        import Campaign, CampaignStats, CampaignMembership
 from profile.models         import Profile
 from action.models          import Action, Pledge, Barrier
 from action.view_objects    import ActionView
@@ -74,8 +74,11 @@ def done(request, action_id):
     action = get_object_or_404(Action, pk=action_id)
 
     user_pledge = Pledge.objects.get(action=action, user=current_user)
-    user_pledge.is_completed = True
-    user_pledge.save()
+    if not user_pledge.is_completed:
+        user_pledge.is_completed = True
+        user_pledge.save()
+        CampaignStats.objects.add(action.campaign, current_user, num_pledges_completed = 1)
+        CampaignMembership.objects.touch(action.campaign, current_user)
 
     action_view = ActionView(action, current_user)
 
@@ -0,0 +1,310 @@
+"""Per-campaign leaderboard of the users compared_to_average scores.
+
+The scores of a campaigns users (CampaignMembership.compared_to_average) are kept 
+sorted, best first, in memcached, so a users rank is a binary search instead of 
+a count over the campaign membership. CampaignMembershipManager.save_scores 
+updates the board, and ge_rerank rebuilds it from the database. 
+
+The board is split into shards of about SHARD_SIZE users, each under its own key, 
+so an update rewrites one or two shards rather than the whole board, and no item
+gets near memcached's 1MB limit. A small index under the boards key lists the 
+shards in order, with the first entry and size of each, so a rank reads the 
+index and one shard.
+
+Several worker processes can update the same board, so updates and rebuilds take 
+a short lock in memcached. If an update can't get it, it drops the index, and the 
+next read rebuilds the board. A read that finds a shard evicted does the same.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import bisect
+import time
+
+from django.core.cache import cache
+
+from profile.models import GRADES
+
+LOCK_SECONDS = 5
+LOCK_WAIT_SECONDS = 2
+LOCK_POLL_SECONDS = 0.05
+
+# Users per shard when the board is built. A shard is split when it 
+# grows to twice this.
+SHARD_SIZE = 1000
+
+
+class Leaderboard(object):
+    """The scores of a campaigns users, best first, as read from memcached.
+    The index is a list of [shard id, first entry, number of entries], best shard first. 
+    Entries are (-score, user id) tuples, so sorting them puts the best first, and 
+    equal scores in user id order. The first entry of the first shard is not used.
+    Shards are fetched as they are needed.
+    """
+
+    def __init__(self, campaign, index=None, shards=None):
+        """@param index, shards The board as just built by _build. Default is to read
+        it from memcached, building it if it isn't there."""
+        self.campaign = campaign
+        self.index = index
+        self.shards = shards or {}
+        if self.index is None:
+            self.index = cache.get(_index_key(campaign.id))
+            if self.index is None:
+                self._rebuild()
+
+    def __len__(self):
+        return sum([num for (_, _, num) in self.index])
+
+    def rank_of_score(self, score):
+        'Position a user with score would have: 1 + number of users with a better score'
+        entry = (-score,)   # Sorts before all the entries with that score
+        while True:
+            position = _shard_position(self.index, entry)
+            entries = self._shard_at(position)
+            if entries is not None:
+                break
+
+        num_before = sum([num for (_, _, num) in self.index[:position]])
+        return num_before + bisect.bisect_left(entries, entry) + 1
+
+    def rank(self, user_id, score=None):
+        """Position of user in the campaign, 1 is best. Users with the same score 
+        have the same rank.
+        @param score The users score, if known. Default is to read it from their
+        membership, 0 if they aren't a member.
+        """
+        if score is None:
+            score = _user_score(self.campaign, user_id)
+        return self.rank_of_score(score)
+
+    def grade(self, user_id, score=None):
+        'School type grade, from GRADES, for how well user is doing. See rank.'
+        num_users = len(self)
+        if not num_users:
+            return GRADES[0]
+        num_rank = int( float(self.rank(user_id, score)) / num_users * len(GRADES) )
+
+        # Very last user gets 6, so move down to 5
+        return GRADES[ min(num_rank, len(GRADES) - 1) ]
+
+    def top(self, num):
+        'List of (user id, score) of the best num users'
+        result = []
+        position = 0
+        while len(result) < num and position < len(self.index):
+            entries = self._shard_at(position)
+            if entries is None:
+                result, position = [], 0
+                continue
+            result.extend([(user_id, -neg_score) 
+                           for (neg_score, user_id) in entries[:num - len(result)]])
+            position += 1
+        return result
+
+    def _shard_at(self, position):
+        """Entries of the shard at position in the index. 
+        If it has been evicted, rebuilds the board and returns None, so the caller 
+        can start again. The rebuilt board has all its shards loaded."""
+        shard_id = self.index[position][0]
+        if shard_id not in self.shards:
+            entries = cache.get(_shard_key(self.campaign.id, shard_id))
+            if entries is None:
+                self._rebuild()
+                return None
+            self.shards[shard_id] = entries
+        return self.shards[shard_id]
+
+    def _rebuild(self):
+        'Replaces this board with one built from the database'
+        self.index, self.shards = _build(self.campaign)
+
+
+def _index_key(campaign_id):
+    'Key of the index of a campaigns leaderboard'
+    return 'ge_leaderboard_%d' % campaign_id
+
+
+def _shard_key(campaign_id, shard_id):
+    'Key of one shard of a campaigns leaderboard'
+    return 'ge_leaderboard_%d_%d' % (campaign_id, shard_id)
+
+
+def _lock_key(campaign_id):
+    'Key of the lock on a campaigns leaderboard'
+    return 'ge_leaderboard_lock_%d' % campaign_id
+
+
+def _shard_position(index, entry):
+    'Position in index of the shard that holds entry, or would if it was on the board'
+    firsts = [first for (_, first, _) in index[1:]]
+    return bisect.bisect_right(firsts, entry)
+
+
+def _user_score(campaign, user_id):
+    'compared_to_average of user in campaign, 0 if they are not a member'
+    from campaign.models import CampaignMembership
+    scores = CampaignMembership.objects.\
+            filter(campaign = campaign, user = user_id).\
+            values_list('compared_to_average', flat=True)
+    return scores[0] if scores else 0
+
+
+def load_scores(campaign):
+    'Map of user id: compared_to_average of the (non system) users of campaign'
+    from campaign.models import CampaignMembership
+    return dict( CampaignMembership.objects.\
+            filter(campaign = campaign, user__is_system_user = False).\
+            values_list('user', 'compared_to_average') )
+
+
+def get(campaign):
+    'The Leaderboard of campaign, from memcached, or the database if it is not there'
+    return Leaderboard(campaign)
+
+
+def rebuild(campaign):
+    'Reloads the leaderboard of campaign from the database, and returns it'
+    return Leaderboard(campaign, *_build(campaign))
+
+
+def _build(campaign):
+    """Sorts the scores of campaign into shards, and stores them if we get the lock.
+    Without the lock someone else is writing the board, so we leave it to them.
+    The scores are read with the lock held, so an update can't land between our
+    read and our write, and be lost.
+    @return Tuple of (index, map of shard id: entries)
+    """
+    is_locked = _lock(campaign.id)
+    try:
+        entries = sorted([(-score, user_id) 
+                          for (user_id, score) in load_scores(campaign).items()])
+
+        index = []
+        shards = {}
+        for shard_id, start in enumerate( range(0, max(len(entries), 1), SHARD_SIZE) ):
+            shards[shard_id] = entries[start:start + SHARD_SIZE]
+            first = shards[shard_id][0] if shards[shard_id] else None
+            index.append( [shard_id, first, len(shards[shard_id])] )
+
+        if not is_locked:
+            return index, shards
+
+        old_index = cache.get(_index_key(campaign.id)) or []
+        cache.set_many( dict([(_shard_key(campaign.id, shard_id), shard_entries) 
+                              for (shard_id, shard_entries) in shards.items()]) )
+        cache.set(_index_key(campaign.id), index)
+        for shard_id, _, _ in old_index:
+            if shard_id not in shards:
+                cache.delete(_shard_key(campaign.id, shard_id))
+    finally:
+        if is_locked:
+            cache.delete(_lock_key(campaign.id))
+
+    return index, shards
+
+
+def update(campaign, changes):
+    """Moves users to their new scores on the leaderboard of campaign.
+    Does nothing if the board isn't in memcached, the next get will load it.
+    @param changes Map of user id: (old score, new score). Old score is None 
+    for a user new to the board.
+    """
+    if not _lock(campaign.id):
+        # Someone else is taking too long. Don't risk losing our update.
+        cache.delete(_index_key(campaign.id))
+        return
+
+    try:
+        if not _move(campaign.id, changes):
+            cache.delete(_index_key(campaign.id))
+    finally:
+        cache.delete(_lock_key(campaign.id))
+
+
+def _move(campaign_id, changes):
+    """Does the work of update, with the lock held. 
+    @return False if the board needs rebuilding
+    """
+    index = cache.get(_index_key(campaign_id))
+    if index is None:
+        return True
+
+    shards = {}
+    def entries_at(position):
+        'Entries of the shard at position, None if evicted'
+        shard_id = index[position][0]
+        if shard_id not in shards:
+            shards[shard_id] = cache.get(_shard_key(campaign_id, shard_id))
+        return shards[shard_id]
+
+    removed_ids = []
+    for user_id, (old_score, new_score) in changes.items():
+        if old_score is not None:
+            old_entry = (-old_score, user_id)
+            position = _shard_position(index, old_entry)
+            entries = entries_at(position)
+            if entries is None:
+                return False
+            at = bisect.bisect_left(entries, old_entry)
+            if at < len(entries) and entries[at] == old_entry:
+                del entries[at]
+                index[position][2] -= 1
+                if not entries and len(index) > 1:
+                    # Its range goes to the shard before (or after, for the first)
+                    removed_ids.append(index[position][0])
+                    del index[position]
+
+        new_entry = (-new_score, user_id)
+        position = _shard_position(index, new_entry)
+        entries = entries_at(position)
+        if entries is None:
+            return False
+        at = bisect.bisect_left(entries, new_entry)
+        if at < len(entries) and entries[at] == new_entry:
+            continue
+        entries.insert(at, new_entry)
+        index[position][2] += 1
+
+        if len(entries) >= 2 * SHARD_SIZE:
+            shard_id = index[position][0]
+            new_id = max([sid for (sid, _, _) in index] + removed_ids) + 1
+            shards[shard_id], shards[new_id] = entries[:SHARD_SIZE], entries[SHARD_SIZE:]
+            index[position][2] = SHARD_SIZE
+            index.insert(position + 1, [new_id, shards[new_id][0], len(shards[new_id])])
+
+    live_ids = set([shard_id for (shard_id, _, _) in index])
+    cache.set_many( dict([(_shard_key(campaign_id, shard_id), entries) 
+                          for (shard_id, entries) in shards.items() 
+                          if shard_id in live_ids and entries is not None]) )
+    cache.set(_index_key(campaign_id), index)
+    for shard_id in removed_ids:
+        cache.delete(_shard_key(campaign_id, shard_id))
+    return True
+
+
+def _lock(campaign_id):
+    'Takes the lock on a campaigns board. False if we waited too long.'
+    deadline = time.time() + LOCK_WAIT_SECONDS
+    while not cache.add(_lock_key(campaign_id), 1, LOCK_SECONDS):
+        if time.time() >= deadline:
+            return False
+        time.sleep(LOCK_POLL_SECONDS)
+    return True
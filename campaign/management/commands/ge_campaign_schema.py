@@ -0,0 +1,97 @@
+"""Schema upkeep for the campaign tables, for databases created before 
+their newer columns:
+
+    ./manage.py ge_campaign_schema columns      Add the missing columns and indexes
+    ./manage.py ge_campaign_schema backfill     Fill in last_active of existing members
+
+New databases get them from syncdb (models.py and sql/campaignmembership.sql).
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Disable the pylint check for dynamically added attributes. This happens a lot
+# with Django DB model usage.
+# pylint: disable-msg=E1101
+# pylint: disable-msg=E1103
+
+from django.db import connection, transaction, DatabaseError
+from django.core.management.base import BaseCommand, CommandError
+
+from campaign.models import Campaign, CampaignMembership
+
+# Postgres has no datetime type, MySQL's timestamp updates itself
+DATETIME = 'timestamp' if 'postgresql' in connection.settings_dict['ENGINE'] else 'datetime'
+
+# Each column, with the statements that add and fill it
+COLUMNS = [
+    ('campaign_campaignmembership.compared_to_average', [
+        "ALTER TABLE campaign_campaignmembership "+\
+                "ADD COLUMN compared_to_average double precision NOT NULL DEFAULT 0;",
+        # Start from the score the user had before scores were per campaign
+        "UPDATE campaign_campaignmembership SET compared_to_average = "+\
+                "(SELECT p.compared_to_average FROM profile_profile p "+\
+                "WHERE p.id = campaign_campaignmembership.user_id);",
+    ]),
+    ('campaign_campaignmembership.last_active', [
+        "ALTER TABLE campaign_campaignmembership ADD COLUMN last_active %s NULL;" % DATETIME,
+        "CREATE INDEX campaign_campaignmembership_campaign_active "+\
+                "ON campaign_campaignmembership (campaign_id, last_active);",
+    ]),
+]
+
+class Command(BaseCommand):
+    'Newer columns of the campaign tables'
+
+    args = 'columns | backfill'
+    help = 'Add the newer columns to the campaign tables, and fill them in'
+
+    def handle(self, *args, **options):
+        'Main entry point for command'
+
+        if len(args) != 1 or args[0] not in ('columns', 'backfill'):
+            raise CommandError('Usage: ge_campaign_schema %s' % self.args)
+
+        if args[0] == 'columns':
+            self.columns()
+        else:
+            self.backfill()
+
+    def columns(self):
+        'Adds and fills each column, skipping the ones that exist'
+
+        cursor = connection.cursor()
+        for name, statements in COLUMNS:
+            try:
+                for sql in statements:
+                    cursor.execute(sql)
+                transaction.commit_unless_managed()
+                print('Added: %s' % name)
+            except DatabaseError, exc:
+                transaction.rollback_unless_managed()
+                print('Skipped (%s): %s' % (str(exc).strip(), name))
+
+        print('Then fill in last_active: ge_campaign_schema backfill, '+
+              'and rebuild the leaderboards: ge_rerank')
+
+    def backfill(self):
+        'Sets last_active of the members of each campaign from their activity'
+        for campaign in Campaign.objects.all():
+            num_changed = CampaignMembership.objects.backfill_last_active(campaign)
+            print('%s: set last_active of %d members' % (campaign.name, num_changed))
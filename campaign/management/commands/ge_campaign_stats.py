@@ -0,0 +1,89 @@
+"""Checks the campaign and user stats counters (see CampaignStatsManager) against 
+a recount of the answers, pledges and status updates, and optionally fixes them.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Disable the pylint check for dynamically added attributes. This happens a lot
+# with Django DB model usage.
+# pylint: disable-msg=E1101
+# pylint: disable-msg=E1103
+
+
+from optparse import make_option
+
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandError
+
+from campaign.models import Campaign, CampaignStats, CampaignUserStats
+
+
+class Command(BaseCommand):
+    'Verify the campaign stats counters'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--campaign', type='int', dest='campaign_id', default=None,
+            help='Only check the campaign with this id'),
+        make_option('--users', action='store_true', dest='users', default=False,
+            help='Also check the counters of each user who has them'),
+        make_option('--fix', action='store_true', dest='fix', default=False,
+            help='Replace wrong counters with the recount'),
+    )
+    help = 'Recount the campaign stats from the base data, and report or fix differences'
+
+    def handle(self, *args, **options):
+        'Main entry point for command'
+
+        campaign_list = Campaign.objects.all()
+        if options['campaign_id']:
+            campaign_list = campaign_list.filter(id = options['campaign_id'])
+            if not campaign_list:
+                raise CommandError('Campaign with id %s not found' % options['campaign_id'])
+
+        num_wrong = 0
+        for campaign in campaign_list:
+            row = CampaignStats.objects.row(campaign)
+            num_wrong += self.verify(row, CampaignStats.objects.counted(campaign), options['fix'])
+
+            if options['users']:
+                for user_row in CampaignUserStats.objects.\
+                        filter(campaign = campaign).select_related('user'):
+                    counted = CampaignStats.objects.counted(campaign, user_row.user)
+                    num_wrong += self.verify(user_row, counted, options['fix'])
+
+        print('%d wrong counters%s' % (num_wrong, ', fixed' if options['fix'] and num_wrong else ''))
+
+    def verify(self, row, counted, fix):
+        """Compares a row of counters with the recount, and prints the differences.
+        @return Number of counters that differ
+        """
+        wrong = [(name, getattr(row, name), value) for name, value in sorted(counted.items())
+                 if getattr(row, name) != value]
+
+        for name, stored, value in wrong:
+            print('%s: %s is %d, should be %d' % (row, name, stored, value))
+
+        if wrong and fix:
+            # Only the wrong columns, so we don't undo counts added since the recount
+            row.__class__.objects.filter(pk = row.pk).update(
+                    **dict( [(name, value) for name, _, value in wrong] ))
+            transaction.commit_unless_managed()
+
+        return len(wrong)
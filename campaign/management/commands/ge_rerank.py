@@ -0,0 +1,62 @@
+"""Rebuilds the leaderboards (see campaign.leaderboard) from the users scores
+in the database. Run after changing scores outside the worker, or if memcached lost them.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Disable the pylint check for dynamically added attributes. This happens a lot
+# with Django DB model usage.
+# pylint: disable-msg=E1101
+# pylint: disable-msg=E1103
+
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from campaign.models import Campaign
+from campaign import leaderboard
+
+
+class Command(BaseCommand):
+    'Rebuild campaign leaderboards'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--campaign', type='int', dest='campaign_id', default=None,
+            help='Only rebuild the campaign with this id'),
+        make_option('--top', type='int', dest='top', default=5,
+            help='Print this many of the best users of each campaign'),
+    )
+    help = 'Rebuild the leaderboard of each campaign from the database'
+
+    def handle(self, *args, **options):
+        'Main entry point for command'
+
+        campaign_list = Campaign.objects.all()
+        if options['campaign_id']:
+            campaign_list = campaign_list.filter(id = options['campaign_id'])
+            if not campaign_list:
+                raise CommandError('Campaign with id %s not found' % options['campaign_id'])
+
+        for campaign in campaign_list:
+            board = leaderboard.rebuild(campaign)
+            print('%s: %d users' % (campaign.name, len(board)))
+            for position, (user_id, score) in enumerate(board.top(options['top'])):
+                print('  %d. user %d: %s' % (position + 1, user_id, score))
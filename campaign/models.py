@@ -33,12 +33,21 @@ import datetime
 from json import JSONEncoder
 
 from django.db                  import models
+from django.db                  import connection, transaction, IntegrityError
+from django.db.models           import F, Max
 from django.core.cache          import cache
 from django.core.urlresolvers   import reverse
 
 from organization.models    import Organization
 from profile.models         import Profile
 from core.util              import get_current_organization, get_current_user
+from campaign               import leaderboard
+
+# Users who answered, posted or pledged in this many days are active
+ACTIVE_DAYS = 30
+
+# Don't record activity more often than this, per user and campaign
+ACTIVE_TOUCH_SECONDS = 300
 
 class CampaignManager(models.Manager):
     'Methods that deal with Campaign objects, above the level of a single object'
@@ -131,6 +140,9 @@ class Campaign(models.Model):
             #self.users.add(geuser)
             cache.delete(self.users_cache_key)
             cache.delete(self._num_users_cache_key)
+            if not geuser.is_system_user:
+                leaderboard.update(self, {geuser.id: (None, 0)})
+            CampaignStats.objects.add(self, num_users=1)
 
     @property
     def _num_users_cache_key(self):
@@ -167,27 +179,29 @@ class Campaign(models.Model):
         """The invite message without [url] placeholder"""
         return self.invite_message.replace('[url]', '')
 
-    def active_user_ids(self, cutoff_date=None):
-        """Ids of the users (Profile objects) who are active in this campaign.
-        @param cutoff_date Users with an answer since this date are considered active. Defaults
-        to 30 days ago
-        @return A set of the user (Profile) ids who have answered an indicator since cutoff_date.
+    def active_memberships(self, cutoff_date=None):
+        """CampaignMemberships of the users who are active in this campaign, most recently
+        active first. One range query on the (campaign, last_active) index.
+        @param cutoff_date Users who answered, posted or pledged since this date are 
+        considered active. Defaults to ACTIVE_DAYS ago.
         """
-        from indicator.models import Answer, Indicator
-
         if not cutoff_date:
-            cutoff_date = datetime.date.today() - datetime.timedelta(days=30)
-
-        active_user_ids = set()
+            cutoff_date = datetime.date.today() - datetime.timedelta(days=ACTIVE_DAYS)
 
-        for ind in Indicator.objects.filter(campaign = self):
-            ind_user_ids = Answer.objects.\
-                    filter(indicator_id = ind.id, action_date__gte = cutoff_date).\
-                    values_list('user_id', flat=True)
+        return CampaignMembership.objects.\
+                filter(campaign = self, last_active__gte = cutoff_date).\
+                order_by('-last_active')
 
-            active_user_ids.update(ind_user_ids)
+    def active_user_ids(self, cutoff_date=None):
+        """Ids of the users (Profile objects) who are active in this campaign.
+        @param cutoff_date See active_memberships
+        @return A set of the user (Profile) ids who have been active since cutoff_date.
+        """
+        return set( self.active_memberships(cutoff_date).values_list('user', flat=True) )
 
-        return active_user_ids
+    def num_active_users(self, cutoff_date=None):
+        'Number of users who are active in this campaign, see active_memberships'
+        return self.active_memberships(cutoff_date).count()
 
     def users_json(self, force=False):
         """JSON array of users in this campaign"""
@@ -236,58 +250,297 @@ class Campaign(models.Model):
             num_pledges_completed
             pledges_completed_pct
             num_ideas
+        With geuser, that users stats in this campaign, without the num_users, 
+        answers_per_user and pledges_completed_pct keys.
+        Read from the counters, see CampaignStatsManager.
+        """
+        if geuser:
+            return CampaignStats.objects.row(self, geuser).as_map()
+
+        if not hasattr(self, '_stats'):
+            self._stats = CampaignStats.objects.row(self).as_map()  # pylint: disable-msg=W0201
+
+        return self._stats 
+
+class CampaignMembershipManager(models.Manager):
+    'Methods above the level of a single CampaignMembership'
+
+    def touch(self, campaign, geuser):
+        """Records that geuser answered, posted or pledged in campaign just now.
+        Skips the write if they were already active in the last ACTIVE_TOUCH_SECONDS."""
+        now = datetime.datetime.now()
+        recently = now - datetime.timedelta(seconds = ACTIVE_TOUCH_SECONDS)
+
+        num_updated = self.filter(
+                models.Q(last_active__isnull = True) | models.Q(last_active__lt = recently),
+                campaign = campaign, 
+                user = geuser).update(last_active = now)
+        if num_updated:
+            transaction.commit_unless_managed()
+
+    def backfill_last_active(self, campaign):
+        """Sets last_active of each member of campaign from their latest answer, 
+        status update and pledge. For memberships from before last_active existed.
+        @return Number of memberships changed
         """
         from indicator.models import Answer
         from action.models    import Pledge
         from status.models    import Entry
 
-        if geuser or not hasattr(self, '_stats'):
-            stats = {}
+        indicator_ids = [ind.id for ind in campaign.indicator_set.filter(is_synthetic = False)]
+        latest_lists = [
+            Answer.objects.filter(indicator_id__in = indicator_ids).\
+                    values_list('user').annotate(Max('created')),
+            Entry.objects.filter(campaign = campaign).\
+                    values_list('who').annotate(Max('when')),
+            Pledge.objects.filter(action__campaign = campaign).\
+                    values_list('user').annotate(Max('created')),
+        ]
+
+        latest = {}
+        for latest_list in latest_lists:
+            for user_id, when in latest_list:
+                if when and (user_id not in latest or when > latest[user_id]):
+                    latest[user_id] = when
+
+        num_changed = 0
+        for membership_id, user_id, last_active in \
+                self.filter(campaign = campaign).values_list('id', 'user', 'last_active'):
+            when = latest.get(user_id)
+            if when and when != last_active:
+                self.filter(pk = membership_id).update(last_active = when)
+                num_changed += 1
+
+        transaction.commit_unless_managed()
+        return num_changed
+
+    def save_scores(self, campaign, scores):
+        """Stores the compared_to_average of many users of campaign, with one update.
+        Users whose score hasn't changed, or who aren't members, are left alone.
+        Moves the changed users on the campaigns leaderboard.
+        @param scores Map of user id: compared_to_average
+        @return Map of user id: score, of the users that changed
+        """
+        if not scores:
+            return {}
+
+        existing = self.\
+                filter(campaign = campaign, user__in = scores.keys()).\
+                values_list('id', 'user', 'compared_to_average')
+
+        changed = {}
+        moves = {}
+        update_ids = []
+        update_params = []
+        for membership_id, user_id, score in existing:
+            if score == scores[user_id]:
+                continue
+            changed[user_id] = scores[user_id]
+            moves[user_id] = (score, scores[user_id])
+            update_ids.append(membership_id)
+            update_params.extend([membership_id, scores[user_id]])
+
+        if update_ids:
+            cursor = connection.cursor()
+            sql = "update campaign_campaignmembership set compared_to_average = case id "+\
+                    "when %s then %s " * len(update_ids) +\
+                    "end where id in (" + ", ".join(["%s"] * len(update_ids)) + ");"
+            cursor.execute(sql, update_params + update_ids)
+            transaction.commit_unless_managed()
+
+            leaderboard.update(campaign, moves)
+
+        return changed
 
-            indicator_ids = [ind.id for ind in self.indicator_set.all()]
-            answers_qs = Answer.objects.filter(indicator_id__in = indicator_ids)
-            if geuser:
-                answers_qs = answers_qs.filter(user = geuser)
-            num_answers = answers_qs.count()
-            stats['num_answers'] = num_answers
 
-            pledge_qs = Pledge.objects.filter(action__campaign = self)
-            if geuser:
-                pledge_qs = pledge_qs.filter(user = geuser)
-            stats['num_pledges'] = num_pledges = pledge_qs.count()
+class CampaignMembership(models.Model):
+    """Profile joined a Campaign"""
 
-            num_pledges_completed = pledge_qs.filter(is_completed = True).count()
-            stats['num_pledges_completed'] = num_pledges_completed
+    objects = CampaignMembershipManager()
 
-            status_qs = Entry.objects.filter(campaign = self)
-            if geuser:
-                status_qs = status_qs.filter(who = geuser)
-            stats['num_ideas'] = status_qs.count() 
+    campaign = models.ForeignKey(Campaign)
+    user = models.ForeignKey(Profile)
+    join_date = models.DateField(auto_now_add=True)
 
-            if geuser:
-                return stats
+    # How far above (positive) or below the average user they are, in percent, 
+    # on their latest day. See IndicatorManager.compared_to_average_scores.
+    compared_to_average = models.FloatField(default=0)
 
-            stats['num_users'] = num_users = self.users.count()
-            stats['answers_per_user'] = num_answers / num_users
+    # Last answer, status update or pledge in this campaign. Indexed with campaign, 
+    # see sql/campaignmembership.sql
+    last_active = models.DateTimeField(null=True, blank=True)
 
-            if num_pledges:
-                stats['pledges_completed_pct'] = num_pledges_completed / float(num_pledges) * 100.0 
-            else:
-                stats['pledges_completed_pct'] = 0
+    def __unicode__(self):
+        return '%s joined campaign %s' % (self.user, self.campaign)
 
-            self._stats = stats     # pylint: disable-msg=W0201
+class CampaignStatsManager(models.Manager):
+    """Keeps the counters in CampaignStats and CampaignUserStats current. 
+    The counters are changed with an update of just those columns, so concurrent 
+    requests don't lose counts. ge_campaign_stats checks them against the base data."""
 
-        return self._stats 
+    def counted(self, campaign, geuser=None):
+        """The counters of campaign, or of geuser in campaign, counted from the answers,
+        pledges and status updates. Answers are those of regular users to regular indicators.
+        @return Map of counter name: value
+        """
+        from indicator.models import Answer
+        from action.models    import Pledge
+        from status.models    import Entry
 
-class CampaignMembership(models.Model):
-    """Profile joined a Campaign"""
+        counters = {}
+
+        indicator_ids = [ind.id for ind in campaign.indicator_set.filter(is_synthetic = False)]
+        answers_qs = Answer.objects.filter(
+                indicator_id__in = indicator_ids, user__is_system_user = False)
+        if geuser:
+            answers_qs = answers_qs.filter(user = geuser)
+        counters['num_answers'] = answers_qs.count()
+
+        pledge_qs = Pledge.objects.filter(action__campaign = campaign)
+        if geuser:
+            pledge_qs = pledge_qs.filter(user = geuser)
+        counters['num_pledges'] = pledge_qs.count()
+        counters['num_pledges_completed'] = pledge_qs.filter(is_completed = True).count()
+
+        status_qs = Entry.objects.filter(campaign = campaign)
+        if geuser:
+            status_qs = status_qs.filter(who = geuser)
+        counters['num_ideas'] = status_qs.count() 
+
+        if not geuser:
+            counters['num_users'] = campaign.users.count()
+
+        return counters
+
+    def _model_keys(self, campaign, geuser):
+        'The model for campaign (geuser None) or user counters, and its lookup keys'
+        if geuser:
+            return CampaignUserStats, {'campaign': campaign, 'user': geuser}
+        return CampaignStats, {'campaign': campaign}
+
+    def row(self, campaign, geuser=None):
+        """The CampaignStats of campaign, or the CampaignUserStats of geuser in campaign.
+        Created from counted() if it doesn't exist yet."""
+        model, keys = self._model_keys(campaign, geuser)
+        try:
+            return model.objects.get(**keys)
+        except model.DoesNotExist:
+            pass
+
+        values = dict(keys)
+        values.update( self.counted(campaign, geuser) )
+
+        sid = transaction.savepoint()
+        try:
+            row = model.objects.create(**values)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Another request created it since our get
+            transaction.savepoint_rollback(sid)
+            row = model.objects.get(**keys)
+
+        transaction.commit_unless_managed()
+        return row
+
+    def add(self, campaign, geuser=None, **deltas):
+        """Adds to the counters of campaign, and of geuser in campaign, e.g.
+        add(campaign, geuser, num_pledges=1). Call after saving what is being counted:
+        a row that doesn't exist yet is counted from the base data instead.
+        num_users only applies to the campaign counters.
+        """
+        self._add(campaign, None, deltas)
+        if geuser:
+            self._add(campaign, geuser, deltas)
+
+    def _add(self, campaign, geuser, deltas):
+        'Adds deltas to one row of counters'
+        model, keys = self._model_keys(campaign, geuser)
+        field_names = [field.name for field in model._meta.fields]  # pylint: disable-msg=W0212
+        updates = dict( [(name, F(name) + delta) for name, delta in deltas.items() 
+                         if name in field_names] )
+        if not updates:
+            return
+
+        if model.objects.filter(**keys).update(**updates):
+            transaction.commit_unless_managed()
+        else:
+            self.row(campaign, geuser)
+
+    def load(self, campaigns):
+        """Reads the stats of several campaigns in one query, so that each campaigns
+        stats() doesn't query. Campaigns without counters yet are left to stats()."""
+        rows = dict( [(row.campaign_id, row) for row in 
+                      CampaignStats.objects.filter(campaign__in = campaigns)] )
+        for campaign in campaigns:
+            if campaign.id in rows:
+                campaign._stats = rows[campaign.id].as_map()    # pylint: disable-msg=W0212
+
+
+class StatsCounters(models.Model):
+    'Counters shared by the campaign and user stats. See Campaign.stats.'
+
+    num_answers = models.IntegerField(default=0)
+    num_pledges = models.IntegerField(default=0)
+    num_pledges_completed = models.IntegerField(default=0)
+    num_ideas = models.IntegerField(default=0)
+
+    class Meta:
+        """Django config"""
+        abstract = True
+
+    def as_map(self):
+        'The counters as a map, see Campaign.stats'
+        return {
+                'num_answers': self.num_answers,
+                'num_pledges': self.num_pledges,
+                'num_pledges_completed': self.num_pledges_completed,
+                'num_ideas': self.num_ideas,
+                }
+
+
+class CampaignStats(StatsCounters):
+    'Counters for a whole Campaign'
+
+    objects = CampaignStatsManager()
+
+    campaign = models.ForeignKey(Campaign, unique=True)
+    num_users = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return 'Stats of campaign %s' % self.campaign_id
+
+    def as_map(self):
+        'See Campaign.stats'
+        stats = super(CampaignStats, self).as_map()
+        stats['num_users'] = self.num_users
+
+        if self.num_users:
+            stats['answers_per_user'] = self.num_answers / float(self.num_users)
+        else:
+            stats['answers_per_user'] = 0
+
+        if self.num_pledges:
+            stats['pledges_completed_pct'] = \
+                    self.num_pledges_completed / float(self.num_pledges) * 100.0 
+        else:
+            stats['pledges_completed_pct'] = 0
+
+        return stats
+
+
+class CampaignUserStats(StatsCounters):
+    'Counters for one user in a Campaign'
 
     campaign = models.ForeignKey(Campaign)
     user = models.ForeignKey(Profile)
-    join_date = models.DateField(auto_now_add=True)
+
+    class Meta:
+        """Django config"""
+        unique_together = ('campaign', 'user')
 
     def __unicode__(self):
-        return '%s joined campaign %s' % (self.user, self.campaign)
+        return 'Stats of user %s in campaign %s' % (self.user_id, self.campaign_id)
+
 
 class UserMustSelectCampaign(Exception):
     """Thrown when there are several campaigns the user could choose,
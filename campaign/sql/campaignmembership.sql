@@ -0,0 +1,5 @@
+-- Run by syncdb after creating campaign_campaignmembership.
+-- For an existing database, run: ./manage.py ge_campaign_schema columns
+
+-- Active users of a campaign, most recently active first: Campaign.active_memberships
+CREATE INDEX campaign_campaignmembership_campaign_active ON campaign_campaignmembership (campaign_id, last_active);
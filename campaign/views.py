@@ -26,19 +26,20 @@ This is how customers administer their campaigns
 # pylint: disable-msg=E1101
 # pylint: disable-msg=E1103
 
-import csv
-
 from django.shortcuts               import render_to_response
 from django.template                import RequestContext
 from django.http                    import HttpResponseRedirect, HttpResponse
 from django.core.urlresolvers       import reverse
 from django.core.exceptions         import PermissionDenied
 from django.shortcuts               import get_object_or_404
+from django.core.paginator          import Paginator, PageNotAnInteger, EmptyPage
 
 from campaign.models        import Campaign
 from campaign.forms         import CampaignForm
-from profile.models         import Profile
 from core.util              import get_current_organization, chop_campaign, ge_login_required
+from core                   import export
+
+USERS_PER_PAGE = 100
 
 def redirect_to_default(request):
     """No campaign slug in URL. Redirect to the default campaign"""
@@ -115,18 +116,23 @@ def delete(request, campaign_id):
 @ge_login_required
 @chop_campaign
 def users(request, campaign_id):
-    """List of ACTIVE users in this campaign"""
+    """List of ACTIVE users in this campaign, a page at a time. GET param 'page'."""
 
     response_map = {}
     
     campaign = get_object_or_404(Campaign, pk=campaign_id)
     response_map['campaign'] = campaign
 
-    active_user_ids = list( campaign.active_user_ids() )
-    user_map = Profile.objects.in_bulk(active_user_ids)
-    user_result = user_map.values()
-    user_result.sort(key = lambda u: u.user.username)
-    response_map['users'] = user_result
+    # Most recently active first. One query for the count, one for the page.
+    paginator = Paginator(
+            campaign.active_memberships().select_related('user__user'), USERS_PER_PAGE)
+    try:
+        page = paginator.page( request.GET.get('page', 1) )
+    except (PageNotAnInteger, EmptyPage):
+        page = paginator.page(1)
+
+    response_map['page'] = page
+    response_map['users'] = [membership.user for membership in page.object_list]
 
     return render_to_response(
             'campaign/campaign_users.html',
@@ -154,26 +160,19 @@ def campaigns_csv(request):
     org = current_user.organization
     campaigns = Campaign.objects.filter(organization = org)
 
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=campaigns.csv'
+    rows = [[
+        campaign.id,
+        campaign.name,
+        campaign.start_date,
+        campaign.end_date,
+        campaign.is_default
+        ] for campaign in campaigns]
 
-    writer = csv.writer(response)
-    writer.writerow([
+    return export.csv_response('campaigns.csv', [
         'Campaign Id',
         'Name',
         'Start Date',
         'End Date',
         'Is Default'
-        ])
-
-    for campaign in campaigns:
-        writer.writerow([
-            campaign.id,
-            campaign.name,
-            campaign.start_date,
-            campaign.end_date,
-            campaign.is_default
-            ])
-
-    return response
+        ], [rows])
 
@@ -0,0 +1,151 @@
+"""Streaming CSV exports.
+
+The rows are read in chunks of settings.EXPORT_CHUNK_SIZE, by primary key, and 
+each chunk is written out before the next is read, so an export uses the same 
+memory however many rows it has. 
+Django hands a response whose content is an iterator to the web server a piece
+at a time, as long as no middleware reads response.content (USE_ETAGS must be off).
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import csv
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class _LineBuffer(object):
+    'File-like object that csv.writer writes to, emptied after each chunk'
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        'Called by csv.writer'
+        self.parts.append(data)
+
+    def drain(self):
+        'Everything written since the last drain'
+        result = ''.join(self.parts)
+        self.parts = []
+        return result
+
+
+def _encode(value):
+    'csv in Python 2 only writes byte strings'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def in_chunks(queryset, chunk_size=None, order_field=None):
+    """The objects of queryset, a list of chunk_size at a time, in primary key order.
+    Each chunk is a separate query starting after the last key of the previous one, 
+    so no query is slower than the first, and only one chunk is ever in memory.
+    @param order_field Order by this (non null) field first, then primary key
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    if order_field:
+        queryset = queryset.order_by(order_field, 'pk')
+    else:
+        queryset = queryset.order_by('pk')
+    last = None
+
+    while True:
+        if last is None:
+            chunk_qs = queryset
+        elif order_field:
+            chunk_qs = queryset.filter(
+                    Q(**{order_field +'__gt': getattr(last, order_field)}) | 
+                    Q(**{order_field: getattr(last, order_field), 'pk__gt': last.pk}))
+        else:
+            chunk_qs = queryset.filter(pk__gt = last.pk)
+
+        chunk = list( chunk_qs[:chunk_size] )
+        if not chunk:
+            return
+        yield chunk
+
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+
+
+def csv_lines(header, row_chunks):
+    """The CSV text of header and rows, one string per chunk.
+    @param row_chunks Iterable of lists of rows, each row a list of values
+    """
+    buf = _LineBuffer()
+    writer = csv.writer(buf)
+
+    writer.writerow(header)
+    yield buf.drain()
+
+    for rows in row_chunks:
+        for row in rows:
+            writer.writerow([_encode(value) for value in row])
+        yield buf.drain()
+
+
+def csv_response(filename, header, row_chunks):
+    'HttpResponse which streams the CSV of header and row_chunks, as a download'
+
+    response = HttpResponse(csv_lines(header, row_chunks), mimetype='text/csv')
+    response['Content-Disposition'] = 'attachment; filename='+ filename
+    return response
+
+
+def date_range(params, default_days=None):
+    """The 'start' and 'end' dates (YYYY-MM-DD, both included) in params, 
+    usually request.GET.
+    @param default_days If there's no 'start', start this many days before today. 
+    Otherwise no start.
+    @return Tuple of (start, end). Either can be None, meaning no limit.
+    @raise ValueError if a date is not valid 
+    """
+    start = _parse_date( params.get('start') )
+    end = _parse_date( params.get('end') )
+
+    if not start and default_days is not None:
+        start = datetime.date.today() - datetime.timedelta(default_days)
+
+    return start, end
+
+
+def _parse_date(date_str):
+    'The date in date_str, or None if it is empty'
+    if not date_str:
+        return None
+    return datetime.datetime.strptime(date_str, DATE_FORMAT).date()
+
+
+def filter_dates(queryset, field_name, start, end):
+    """queryset with field_name between start and end, see date_range. 
+    field_name can be a date or a datetime."""
+    if start:
+        queryset = queryset.filter(**{field_name +'__gte': start})
+    if end:
+        queryset = queryset.filter(**{field_name +'__lt': end + datetime.timedelta(1)})
+    return queryset
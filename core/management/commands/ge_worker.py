@@ -1,5 +1,5 @@
-""" Worker daemon for Good Energy. Runs in the background, connected via Gearman,
-and does long running tasks.
+""" Worker daemon for Good Energy. Runs in the background, connected via Gearman
+(or the local queue, see core.messaging), and does long running tasks.
 """
 
 #    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
@@ -28,61 +28,87 @@ and does long running tasks.
 
 import logging
 import time
-import random
+import sys
+import signal
 import threading
+import multiprocessing
+import Queue
 
 import daemon
-from gearman import GearmanWorker
 from django.conf import settings    # Sets up logging
 from django.db import connection, transaction
 from django.core.management.base import NoArgsCommand
 
 from core import messaging
 from indicator.models import Indicator, Answer
+from indicator import ready
+from profile.models import Profile, Group
+from campaign.models import Campaign, CampaignMembership
+
+MODE_THREAD = 'thread'
+MODE_PROCESS = 'process'
+
+# How often a batch being collected checks for urgent jobs
+URGENT_POLL_SECONDS = 0.2
+
+# Most (user, day) overall averages to calculate in one go
+USER_BATCH_SIZE = 200
+
+
+def set_transaction_isolation():
+    """ 
+    Defaut transaction isolation on MySQL InnoDB is REPEATABLE-READ, which means
+    a connection always gets the same result for a given query, even if the data has
+    changed.
+    This daemon runs for a long time, we need to see db changes, so change to READ-COMMITTED.
+    Django connections are per-thread, so each long running thread must call this.
+    """
+    
+    cur = connection.cursor()
+    cur.execute("set session transaction isolation level read committed")
+    cur.close()
 
 
 class GEWorker(daemon.Daemon):
-    "Our worker daemon - takes Gearman jobs and does them"
+    "Our worker daemon - takes jobs from the message queue and does them"
     
     def __init__(self):
         super(GEWorker, self).__init__()
-        self.worker = GearmanWorker(settings.GEARMAN_SERVERS)
 
-        self.worker.register_function(messaging.SUBJECT_THREAD_COUNT, self.thread_count)
-        self.worker.register_function(messaging.SUBJECT_THREAD_NAMES, self.thread_names)
+        self.handlers = {
+            messaging.SUBJECT_THREAD_COUNT: self.thread_count,
+            messaging.SUBJECT_THREAD_NAMES: self.thread_names,
+            messaging.SUBJECT_AVG_STATS: self.average_stats,
+            messaging.SUBJECT_AVG: self.average,
+            messaging.SUBJECT_AVG_URGENT: self.average_urgent,
+        }
 
-        self.worker.register_function(messaging.SUBJECT_AVG, self.average)
+        self.batcher = AverageBatcher(
+                settings.AVERAGE_BATCH_SECONDS, 
+                settings.WORKER_QUEUE_SIZE)
 
-        self._set_transaction_isolation()
-
-    def _set_transaction_isolation(self):
-        """ 
-        Defaut transaction isolation on MySQL InnoDB is REPEATABLE-READ, which means
-        a connection always gets the same result for a given query, even if the data has
-        changed.
-        This daemon runs for a long time, we need to see db changes, so change to READ-COMMITTED.
-        """
-        
-        cur = connection.cursor()
-        cur.execute("set session transaction isolation level read committed")
-        cur.close()
+        set_transaction_isolation()
 
     def run(self):
         """Entry point for daemon.Daemon subclasses - main method"""
-        self.worker.work()  # Never returns
-    
-    def wait_for_thread(self):
-        'Sleeps until a thread is available. Gearman will queue the requests whilst we pause here'
-        
-        if settings.DEBUG:
-            connection.queries = [] # Prevent query list growing indefinitely 
-
-        running_threads = threading.active_count() 
-        while running_threads >= settings.MAX_WORKER_THREADS:
-            logging.debug(
-                    'Waiting for thread. Currently %s: %s' % 
-                    (running_threads, self.thread_names()) )
-            time.sleep(1)
+
+        if settings.WORKER_MODE == MODE_PROCESS:
+            # Fork before starting any threads
+            self.batcher.pool = new_pool()
+
+        signal.signal(signal.SIGTERM, self.stop)
+
+        self.batcher.start()
+        messaging.backend().work(self.handlers)  # Never returns
+
+    def stop(self, signum, frame):
+        """SIGTERM handler. Finishes the average jobs we already accepted, then exits"""
+        logging.info('Worker stopping, %d average jobs to finish', self.batcher.queue_depth())
+        self.batcher.stop()
+        self.batcher.join(settings.WORKER_DRAIN_SECONDS)
+        if self.batcher.is_alive():
+            logging.warn('Gave up waiting for average jobs: %s', self.batcher.stats())
+        sys.exit(0)
     
     def thread_count(self, job):
         'Returns number of threads currently running'
@@ -91,14 +117,27 @@ class GEWorker(daemon.Daemon):
     def thread_names(self, job):
         'Returns an array of active thread names'
         return str( ', '.join([thread.name for thread in threading.enumerate()]) ) +'\n'
+
+    def average_stats(self, job):
+        'Returns how well average jobs are being coalesced, and how many are waiting'
+        return self.batcher.stats() +'\n'
     
     def average(self, job):
-        """ Calculates daily indicator average for group and overall
-        @job.arg Id of the new Answer to include. 
+        """ Calculates daily indicator average for group and overall.
+        Queued with the other recent average jobs, see AverageBatcher.
+        Blocks if the queue is full, which leaves the job in the message queue until we catch up.
+        @job.arg Comma separated ids of the new Answers to include. 
+        """
+        for answer_id in job.arg.split(','):
+            self.batcher.add(answer_id)
+
+    def average_urgent(self, job):
+        """Same as average, but the user is waiting on the results page, so 
+        doesn't wait for the rest of the batch window, or for room in the queue.
+        @job.arg Comma separated ids, including the users last Answer of the day
         """
-        self.wait_for_thread()
-        worker_thread = AverageWorker(job.arg)
-        worker_thread.start()
+        for answer_id in job.arg.split(','):
+            self.batcher.add_urgent(answer_id)
 
  
 class Command(NoArgsCommand):
@@ -115,27 +154,273 @@ class Command(NoArgsCommand):
             logging.exception("Fatal error")
 
 
-class AverageWorker(threading.Thread):
-    'Calculates group and overall averages'
+class AverageBatcher(threading.Thread):
+    """Calculates group and overall averages.
+    Collects the average jobs that arrive within window_seconds, then does one 
+    recompute per distinct (indicator, action_date), instead of one per answer.
+    The overall averages of the average user and the groups are shared by all 
+    the indicators of a campaign, so those are done once per (campaign, action_date),
+    after the indicators.
+    The recomputes run in this thread, or in a process pool if pool is set.
+    Urgent jobs end the current window early.
+    """
 
-    def __init__(self, arg):
-        thread_name = self.__class__.__name__ + str( random.randint(0, 10000) )
-        super(AverageWorker, self).__init__(name = thread_name)
+    def __init__(self, window_seconds, max_queued):
+        super(AverageBatcher, self).__init__(name = self.__class__.__name__)
+        self.daemon = True
 
-        self.answer_id = arg
-        logging.debug('AverageWorker: Answer Id %s' % self.answer_id)
+        self.window_seconds = window_seconds
+        self.queue = Queue.Queue(max_queued)
+        self.urgent_queue = Queue.Queue()
+        self.pool = None
+        self.stopping = threading.Event()
+
+        self.num_jobs = 0
+        self.num_urgent = 0
+        self.num_recomputes = 0
+        self.last_batch_size = 0
+
+    def add(self, answer_id):
+        'Queue an Answer id whose averages need updating. Blocks if the queue is full.'
+        while True:
+            try:
+                # Timeout so that signals (SIGTERM) still get handled whilst we wait
+                self.queue.put(answer_id, timeout=1)
+                return
+            except Queue.Full:
+                continue
+
+    def add_urgent(self, answer_id):
+        'Queue an Answer id for the next batch, and start that batch now. Never blocks.'
+        self.urgent_queue.put(answer_id)
+
+    def queue_depth(self):
+        'Number of answer ids waiting for the next batch'
+        return self.queue.qsize() + self.urgent_queue.qsize()
+
+    def stop(self):
+        'Finish the jobs already queued, then exit'
+        self.stopping.set()
+
+    def stats(self):
+        'Coalescing ratio and queue depth, as a string'
+        ratio = float(self.num_jobs) / self.num_recomputes if self.num_recomputes else 0
+        return 'jobs: %d, urgent: %d, recomputes: %d, ratio: %.1f, last batch: %d, queued: %d' % \
+                (self.num_jobs, self.num_urgent, self.num_recomputes, ratio, 
+                        self.last_batch_size, self.queue_depth())
 
     def run(self):
         'Main'
-        logging.debug('Running AverageWorker')
+        logging.debug('Running AverageBatcher')
+        set_transaction_isolation()
+
+        while not self.stopping.is_set() or self.queue_depth():
+
+            batch = self.next_batch()
+            if not batch:
+                continue
+
+            if settings.DEBUG:
+                connection.queries = [] # Prevent query list growing indefinitely 
+
+            try:
+                self.process(batch)
+            except Exception:
+                logging.exception('Error calculating averages')
+
+            transaction.commit_unless_managed()
+
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+    def next_batch(self):
+        """Waits for the first job, then collects jobs for window_seconds, 
+        or until an urgent job arrives.
+        @return List of answer ids, empty if nothing arrived
+        """
+        urgent = self._take_urgent()
+        if urgent:
+            return urgent
 
         try:
-            answer = Answer.objects.get(pk = self.answer_id)
-        except Answer.DoesNotExist:
-            logging.warn('No Answer with id %s' % self.answer_id)
-            return
+            batch = [self.queue.get(timeout=URGENT_POLL_SECONDS)]
+        except Queue.Empty:
+            return []
+
+        deadline = time.time() + self.window_seconds
+        while not self.stopping.is_set():
+            urgent = self._take_urgent()
+            if urgent:
+                batch.extend(urgent)
+                break
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append( self.queue.get(timeout=min(remaining, URGENT_POLL_SECONDS)) )
+            except Queue.Empty:
+                continue
+
+        return batch
+
+    def _take_urgent(self):
+        'All the urgent answer ids waiting, without blocking'
+        urgent = []
+        while True:
+            try:
+                urgent.append( self.urgent_queue.get_nowait() )
+            except Queue.Empty:
+                break
+        self.num_urgent += len(urgent)
+        return urgent
+
+    def process(self, answer_ids):
+        """Update the averages for all the answers with the given ids, 
+        once per distinct key"""
+
+        num_jobs = len(answer_ids)
+        answer_ids = set([long(answer_id) for answer_id in answer_ids])
+        indicator_keys, overall_keys, user_keys = average_keys(answer_ids)
+
+        user_batches = user_average_batches(user_keys)
+
+        # Overall averages are calculated from the indicator averages, and 
+        # user averages compare to both, so each step must finish before the next.
+        # Overall keys share the avg user rows, so they never run in parallel.
+        if self.pool:
+            self.pool.map(update_indicator_averages, indicator_keys)
+        else:
+            for key in indicator_keys:
+                update_indicator_averages(key)
+
+        for key in overall_keys:
+            update_overall_averages(key)
+
+        if self.pool:
+            self.pool.map(update_user_averages, user_batches)
+        else:
+            for batch in user_batches:
+                update_user_averages(batch)
+
+        self.num_jobs += num_jobs
+        self.num_recomputes += len(indicator_keys)
+        self.last_batch_size = num_jobs
+        logging.info('AverageBatcher: %s', self.stats())
+
+
+def new_pool():
+    """A pool of WORKER_PROCESSES processes. Each is replaced after 
+    WORKER_MAX_JOBS_PER_PROCESS jobs on Python 2.7+. Python 2.6 can't do that, 
+    so there they last as long as the pool."""
+    pool_options = {}
+    if sys.version_info >= (2, 7):
+        pool_options['maxtasksperchild'] = settings.WORKER_MAX_JOBS_PER_PROCESS
+    return multiprocessing.Pool(settings.WORKER_PROCESSES, _init_pool_process, **pool_options)
+
+
+def _init_pool_process():
+    """Runs in each new pool process. 
+    The DB connection inherited from the parent belongs to the parent, so drop it 
+    (without closing, which would close it for the parent too) and open our own."""
+    connection.connection = None
+    set_transaction_isolation()
+
+
+def average_keys(answer_ids):
+    """The distinct recomputes needed to include the given answers in the averages.
+    Keys are plain values, so they can be sent to a pool process.
+    @return Tuple of three lists:
+     - (indicator_id, action_date) for the indicator averages
+     - (campaign_id, action_date, group_ids) for the overall averages of the 
+       average user and of all the groups the answering users are in
+     - (campaign_id, user_id, action_date) for the users own overall averages
+    """
+
+    answer_rows = Answer.objects.\
+            filter(pk__in = answer_ids, is_skip = False).\
+            values_list('indicator_id', 'action_date', 'user_id')
+    if not answer_rows:
+        return [], [], []
+
+    user_ids = set([row[2] for row in answer_rows])
+    campaign_ids = dict( Indicator.objects.\
+            filter(id__in = set([row[0] for row in answer_rows])).\
+            values_list('id', 'campaign') )
+
+    group_ids_by_user = {}
+    membership = Profile.groups.through.objects.\
+            filter(profile__in = list(user_ids)).\
+            values_list('profile', 'group')
+    for user_id, group_id in membership:
+        group_ids_by_user.setdefault(user_id, set()).add(group_id)
+
+    indicator_keys = set()
+    group_ids_by_day = {}
+    user_keys = set()
+    for indicator_id, action_date, user_id in answer_rows:
+        if indicator_id not in campaign_ids:
+            logging.warn('No Indicator with id %s', indicator_id)
+            continue
+        campaign_id = campaign_ids[indicator_id]
+        indicator_keys.add( (indicator_id, action_date) )
+        group_ids_by_day.setdefault( (campaign_id, action_date), set() ).\
+                update( group_ids_by_user.get(user_id, ()) )
+        user_keys.add( (campaign_id, user_id, action_date) )
+
+    overall_keys = [(campaign_id, action_date, frozenset(group_ids)) 
+                    for (campaign_id, action_date), group_ids in group_ids_by_day.items()]
+
+    return list(indicator_keys), overall_keys, list(user_keys)
+
+
+def update_indicator_averages(key):
+    """Update the averages for one (indicator_id, action_date) key"""
+    indicator_id, action_date = key
+
+    indicator = Indicator.objects.get(pk = indicator_id).subclass()
+    indicator.average_from_totals(action_date)
+
+    transaction.commit_unless_managed()
+
+def update_overall_averages(key):
+    """Update the overall averages of the average user and the groups,
+    for one (campaign_id, action_date, group_ids) key"""
+    campaign_id, action_date, group_ids = key
+
+    campaign = Campaign.objects.get(pk = campaign_id)
+    group_avg_user_ids = Group.objects.filter(id__in = list(group_ids)).\
+            values_list('avg_user', flat=True) if group_ids else []
+    Indicator.objects.update_overall_averages(campaign, action_date, group_avg_user_ids)
+
+    transaction.commit_unless_managed()
+
+def user_average_batches(user_keys):
+    """Groups (campaign_id, user_id, action_date) keys by campaign, in batches of
+    at most USER_BATCH_SIZE.
+    @return List of (campaign_id, list of (user_id, action_date))
+    """
+    by_campaign = {}
+    for campaign_id, user_id, action_date in user_keys:
+        by_campaign.setdefault(campaign_id, []).append( (user_id, action_date) )
+
+    batches = []
+    for campaign_id, user_dates in by_campaign.items():
+        for start in range(0, len(user_dates), USER_BATCH_SIZE):
+            batches.append( (campaign_id, user_dates[start:start + USER_BATCH_SIZE]) )
+    return batches
+
+def update_user_averages(batch):
+    """Update the overall averages for one (campaign_id, [(user_id, action_date), ...]) batch"""
+    campaign_id, user_dates = batch
 
-        answer.update_averages()
+    campaign = Campaign.objects.get(pk = campaign_id)
+    averages = Indicator.objects.calculate_day_averages(campaign, user_dates)
+    scores = Indicator.objects.compared_to_average_scores(campaign, averages)
+    CampaignMembership.objects.save_scores(campaign, scores)
 
-        transaction.commit_unless_managed()
+    transaction.commit_unless_managed()
+    for user_id in set([user_id for user_id, _ in user_dates]):
+        ready.mark_ready(user_id)
 
@@ -32,8 +32,9 @@ from django.contrib         import admin
 from django.contrib.auth    import logout
 from django.http            import HttpResponseRedirect
 
-from campaign.models import Campaign
+from campaign.models import Campaign, CampaignStats
 from indicator.models import Indicator, IndicatorLikert, IndicatorNumber
+from indicator import catalog
 from action.models import Action
 from action.view_objects import ActionView
 from status.models import Entry, EntryComment
@@ -60,7 +61,8 @@ class Manager(admin.AdminSite):
         org = geuser.organization
 
         # Campaigns
-        campaign_list = Campaign.objects.filter(organization = org)
+        campaign_list = list( Campaign.objects.filter(organization = org) )
+        CampaignStats.objects.load(campaign_list)
         extra_context['campaign_list'] = campaign_list
 
         # Actions
@@ -113,7 +115,12 @@ class IndicatorLikertAdmin(admin.ModelAdmin):
     def save_model(self, request, indicator, form, change):
         """Force cache refresh"""
         super(IndicatorLikertAdmin, self).save_model(request, indicator, form, change)
-        Indicator.objects.all_regular_indicators(indicator.campaign, force=True)
+        catalog.bump(indicator.campaign_id)
+
+    def delete_model(self, request, indicator):
+        """Force cache refresh"""
+        super(IndicatorLikertAdmin, self).delete_model(request, indicator)
+        catalog.bump(indicator.campaign_id)
 
 class IndicatorNumberAdmin(admin.ModelAdmin):
     """Custom admin for IndicatorNumber"""
@@ -130,7 +137,12 @@ class IndicatorNumberAdmin(admin.ModelAdmin):
     def save_model(self, request, indicator, form, change):
         """Force cache refresh"""
         super(IndicatorNumberAdmin, self).save_model(request, indicator, form, change)
-        Indicator.objects.all_regular_indicators(indicator.campaign, force=True)
+        catalog.bump(indicator.campaign_id)
+
+    def delete_model(self, request, indicator):
+        """Force cache refresh"""
+        super(IndicatorNumberAdmin, self).delete_model(request, indicator)
+        catalog.bump(indicator.campaign_id)
 
 class CampaignAdmin(admin.ModelAdmin):
     'Custom admin for Campaign'
@@ -146,7 +158,7 @@ class CampaignAdmin(admin.ModelAdmin):
         super(CampaignAdmin, self).save_model(request, campaign, form, change)
 
         # Force cache refresh
-        #Indicator.objects.all_regular_indicators(campaign, force=True)
+        catalog.bump(campaign.id)
 
     def queryset(self, request):
         'Django QuerySet of what to show in the admin - we narrow for this users org'
@@ -20,46 +20,279 @@
 #
 
 
-from threading import Thread
+import time
+import heapq
 import logging
+import sqlite3
+import threading
 
-from gearman.libgearman import Client
 from django.conf import settings
 
 SUBJECT_AVG = 'average'
+SUBJECT_AVG_URGENT = 'average_urgent'
+SUBJECT_AVG_STATS = 'average_stats'
+SUBJECT_THREAD_COUNT = 'thread_count'
+SUBJECT_THREAD_NAMES = 'thread_names'
 
-CLIENT = Client()
-for host in settings.GEARMAN_SERVERS:
-    CLIENT.add_server(host)
+BACKEND_GEARMAN = 'gearman'
+BACKEND_LOCAL = 'local'
+
+# Someone is waiting on these. Workers take them before any other messages.
+PRIORITY_SUBJECTS = (SUBJECT_AVG_URGENT,)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    """The message queue backend chosen by settings.MESSAGING_BACKEND.
+    Created on first use, then shared."""
+    global _backend                                 # pylint: disable-msg=W0603
+
+    with _backend_lock:
+        if not _backend:
+            if settings.MESSAGING_BACKEND == BACKEND_LOCAL:
+                _backend = LocalBackend(settings.LOCAL_QUEUE_PATH)
+            else:
+                _backend = GearmanBackend(settings.GEARMAN_SERVERS)
+    return _backend
 
 
 def send(subject, payload):
     """Send a message. Subject must be one of the constants in this file. 
     Payload will be converted to a string"""
-    CLIENT.do_background(subject, str(payload))
+    backend().send(subject, payload)
+
+
+def send_batch(subject, payloads):
+    """Send one message per payload, all with the same subject"""
+    backend().send_batch(subject, payloads)
 
 
 def delayed_send(subject, payload, seconds_delay):
     """Calls send in seconds_delay"""
     logging.debug('Scheduling send for in %d seconds', seconds_delay)
-    delay = DelayThread(subject, payload, seconds_delay)
-    delay.start()
-    
-
-class DelayThread(Thread):
-    """A thread that sleeps for a given amount of time, 
-    then calls send with the correct info"""
-    
-    def __init__(self, subject, payload, seconds_delay):
-        super(DelayThread, self).__init__()
+    backend().delayed_send(subject, payload, seconds_delay)
+
+
+class Job(object):
+    """A message received from the queue. Same attributes as a Gearman job."""
+
+    def __init__(self, subject, arg):
         self.subject = subject
-        self.payload = payload
-        self.seconds_delay = seconds_delay
-        
+        self.arg = arg
+
+
+class Backend(object):
+    """Interface of a message queue backend"""
+
+    def send(self, subject, payload):
+        """Queue a message for a worker"""
+        raise NotImplementedError()
+
+    def send_batch(self, subject, payloads):
+        """Queue one message per payload"""
+        for payload in payloads:
+            self.send(subject, payload)
+
+    def delayed_send(self, subject, payload, seconds_delay):
+        """Queue a message for a worker in seconds_delay"""
+        DelayTimer.instance().schedule(seconds_delay, self.send, subject, payload)
+
+    def work(self, handlers):
+        """Receive messages forever, calling handlers[message subject](job) for each.
+        @param handlers Map of subject to function taking a Job
+        """
+        raise NotImplementedError()
+
+
+class GearmanBackend(Backend):
+    """Sends messages to a Gearman server.
+    Gearman keeps a queue per subject, so PRIORITY_SUBJECTS don't wait behind other subjects."""
+
+    def __init__(self, servers):
+        from gearman.libgearman import Client
+
+        self.servers = servers
+        self.client = Client()
+        for host in servers:
+            self.client.add_server(host)
+
+    def send(self, subject, payload):
+        """See Backend"""
+        self.client.do_background(subject, str(payload))
+
+    def work(self, handlers):
+        """See Backend"""
+        from gearman import GearmanWorker
+
+        worker = GearmanWorker(self.servers)
+        for subject, handler in handlers.items():
+            worker.register_function(subject, handler)
+        worker.work()  # Never returns
+
+
+class LocalBackend(Backend):
+    """Durable queue in an SQLite file, for running the workers on a single box 
+    or in load tests, without a Gearman server.
+    A message is deleted once its handler returns. Messages claimed by a worker
+    that died are handed out again after CLAIM_TIMEOUT seconds.
+    """
+
+    CLAIM_TIMEOUT = 300
+    POLL_SECONDS = 0.5
+    BATCH_SIZE = 100
+
+    def __init__(self, path):
+        self.path = path
+
+        conn = self._connect()
+        conn.execute(
+                "create table if not exists message ("
+                "id integer primary key autoincrement, "
+                "subject text not null, "
+                "payload text not null, "
+                "run_after real not null, "
+                "claimed_at real)")
+        conn.execute(
+                "create index if not exists message_run_after on message (run_after)")
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        """A new connection. SQLite connections can't be shared between threads"""
+        return sqlite3.connect(self.path, timeout=30)
+
+    def send(self, subject, payload):
+        """See Backend"""
+        self.send_batch(subject, [payload])
+
+    def send_batch(self, subject, payloads):
+        """See Backend. All in one transaction."""
+        self._insert(subject, payloads, time.time())
+
+    def delayed_send(self, subject, payload, seconds_delay):
+        """See Backend. Stored straight away, so not lost if we stop before it is due."""
+        self._insert(subject, [payload], time.time() + seconds_delay)
+
+    def _insert(self, subject, payloads, run_after):
+        """Store messages, available to workers from run_after (unix time)"""
+        conn = self._connect()
+        try:
+            conn.executemany(
+                    "insert into message (subject, payload, run_after) values (?, ?, ?)",
+                    [(subject, str(payload), run_after) for payload in payloads])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def claim(self, subjects, limit=BATCH_SIZE):
+        """Mark up to limit due messages as ours.
+        @return List of (id, subject, payload)
+        """
+        now = time.time()
+        placeholders = ', '.join(['?'] * len(subjects))
+
+        conn = self._connect()
+        conn.isolation_level = None     # We manage the transaction
+        try:
+            conn.execute("begin immediate")
+            rows = conn.execute(
+                    "select id, subject, payload from message "
+                    "where subject in (%s) and run_after <= ? "
+                    "and (claimed_at is null or claimed_at < ?) "
+                    "order by id limit ?" % placeholders,
+                    list(subjects) + [now, now - self.CLAIM_TIMEOUT, limit]).fetchall()
+            conn.executemany(
+                    "update message set claimed_at = ? where id = ?",
+                    [(now, row[0]) for row in rows])
+            conn.execute("commit")
+        finally:
+            conn.close()
+
+        return rows
+
+    def done(self, message_ids):
+        """Remove handled messages"""
+        conn = self._connect()
+        try:
+            conn.executemany("delete from message where id = ?", 
+                    [(message_id,) for message_id in message_ids])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def depth(self):
+        """Number of messages not yet handled"""
+        conn = self._connect()
+        try:
+            return conn.execute("select count(*) from message").fetchone()[0]
+        finally:
+            conn.close()
+
+    def work(self, handlers):
+        """See Backend. Messages with a subject in PRIORITY_SUBJECTS jump the queue."""
+        priority_subjects = [subject for subject in handlers if subject in PRIORITY_SUBJECTS]
+        while True:
+            rows = []
+            if priority_subjects:
+                rows = self.claim(priority_subjects)
+            if not rows:
+                rows = self.claim(handlers.keys())
+            if not rows:
+                time.sleep(self.POLL_SECONDS)
+                continue
+
+            handled = []
+            for message_id, subject, payload in rows:
+                try:
+                    handlers[subject](Job(subject, payload))
+                except Exception:
+                    logging.exception('Error handling %s message %s', subject, message_id)
+                handled.append(message_id)
+            self.done(handled)
+
+
+class DelayTimer(threading.Thread):
+    """One thread that runs all the delayed sends when they are due, 
+    instead of one sleeping thread per message."""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """The shared timer, started on first use"""
+        with cls._instance_lock:
+            if not cls._instance:
+                cls._instance = DelayTimer()
+                cls._instance.start()
+        return cls._instance
+
+    def __init__(self):
+        super(DelayTimer, self).__init__(name = self.__class__.__name__)
+        self.daemon = True
+        self.condition = threading.Condition()
+        self.heap = []
+        self.counter = 0    # Keeps heap order stable for equal times
+
+    def schedule(self, seconds_delay, func, *args):
+        """Call func(*args) in seconds_delay"""
+        with self.condition:
+            self.counter += 1
+            heapq.heappush(self.heap, (time.time() + seconds_delay, self.counter, func, args))
+            self.condition.notify()
+
     def run(self):
         'Thread main loop'
-        import time
-        logging.debug('Thread sleeping')
-        time.sleep(self.seconds_delay)
-        logging.debug('Thread woke up')
-        send(self.subject, self.payload)
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    timeout = self.heap[0][0] - time.time() if self.heap else None
+                    self.condition.wait(timeout)
+                _, _, func, args = heapq.heappop(self.heap)
+
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('Error in delayed send')
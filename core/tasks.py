@@ -1,6 +1,7 @@
 """ Worker daemon for Good Energy. 
 Runs in the background via oilcan, connected via Gearman,
 and does long running tasks.
+Without Gearman, run work_local() to take the same tasks from the local queue.
 """
 
 #    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
@@ -32,7 +33,9 @@ import logging
 from oilcan import task
 from django.db import connection, transaction
 
+from core import messaging
 from indicator.models import Answer
+from indicator import ready
 
 
 def _set_transaction_isolation():
@@ -52,19 +55,40 @@ def _set_transaction_isolation():
 @task
 def average(answer_id_str):
     """ Calculates daily indicator average for group and overall.
-    @answer_id_str: Id of the new Answer to include. String.
+    @answer_id_str: Comma separated ids of the new Answers to include. String.
+    @return The last of those Answers, or None if there are none
     """
     logging.debug('Running AverageWorker')
     _set_transaction_isolation()
-    answer_id = long(answer_id_str)
 
-    try:
-        answer = Answer.objects.get(pk=answer_id)
-    except Answer.DoesNotExist:
-        logging.warn('No Answer with id %s', answer_id)
-        return
+    answer = None
+    for answer_id in [long(part) for part in answer_id_str.split(',')]:
+        try:
+            answer = Answer.objects.get(pk=answer_id)
+        except Answer.DoesNotExist:
+            logging.warn('No Answer with id %s', answer_id)
+            continue
 
-    answer.update_averages()
+        answer.update_averages()
 
     transaction.commit_unless_managed()
+    return answer
 
+
+@task
+def average_urgent(answer_id_str):
+    """Same as average, for a user waiting on the results page.
+    @answer_id_str: Comma separated ids, including the users last Answer of the day. String.
+    """
+    answer = average(answer_id_str)
+    if answer:
+        ready.mark_ready(answer.user_id)
+
+
+def work_local():
+    """Runs the tasks in this file for messages in the local queue 
+    (settings.MESSAGING_BACKEND = 'local'). Never returns."""
+    messaging.backend().work({
+        messaging.SUBJECT_AVG: lambda job: average(job.arg),
+        messaging.SUBJECT_AVG_URGENT: lambda job: average_urgent(job.arg),
+    })
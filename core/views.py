@@ -36,9 +36,11 @@ from django.core.urlresolvers       import reverse
 from django.core.cache              import cache
 from django.http                    import HttpResponseRedirect
 from django.core.mail               import mail_admins
+from django.conf                    import settings
 #from django.db                     import connection
 
 from indicator.models       import Indicator, Answer
+from indicator              import ready
 from indicator.forms        import indicator_form
 from status.models          import Entry
 from status.view_objects    import EntryView
@@ -184,6 +186,11 @@ def results(request, campaign_slug, indicator_id = None):
 
     campaign = get_current_campaign()
 
+    # If they just answered their last indicator, the worker is updating the averages.
+    # Give it a moment, otherwise show the averages we have.
+    response_map['is_results_pending'] = \
+            not ready.wait(geuser, settings.RESULTS_WAIT_SECONDS)
+
     overall_indicator = Indicator.objects.overall_indicator(campaign)
     response_map['overall_indicator'] = overall_indicator
 
@@ -225,16 +232,14 @@ def results(request, campaign_slug, indicator_id = None):
     response_map['my_groups'] = geuser.groups.all()
     response_map['all_groups'] = Group.objects.filter(organization = organization)
 
+    # Indicators the user or avg user has no answer for that day aren't displayed
+    ratings = Indicator.objects.compared_to_average_all(campaign, geuser, yesterday.date())
     indicator_rating_list = []
     for ind in indicator_list:
-        try:
-            (ind.user_rating, ind.user_rating_exact) = ind.compared_to_average(geuser, yesterday)
+        if ind.id in ratings:
+            (ind.user_rating, ind.user_rating_exact) = ratings[ind.id]
             ind.user_rating_exact = abs(ind.user_rating_exact)
             indicator_rating_list.append(ind)
-        except Answer.DoesNotExist:
-            # User or Avg User has no answer for that day, don't display the indicator
-            #ind.user_rating, ind.user_rating_exact = 0, 0
-            pass
 
     indicator_rating_list.sort(key=lambda x: x.user_rating, reverse=True)
     response_map['indicator_rating_list'] = indicator_rating_list
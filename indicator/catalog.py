@@ -0,0 +1,132 @@
+"""Per-process cache of the indicators of each campaign, in front of memcached.
+
+Entries are kept in this process (most recently used first, up to
+settings.CATALOG_SIZE), and in memcached for the other processes. Each campaign
+has a version number in memcached, which bump increments when the campaign or
+its indicators change. Entries for an older version are ignored.
+To save a memcached round trip on every request, a process only re-reads a
+campaigns version every settings.CATALOG_CHECK_SECONDS.
+
+Values are shared within the process, callers must copy them before changing them.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import time
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Entries not tied to a campaign (the average user) use this, and are never bumped
+GLOBAL = 0
+
+_lock = threading.Lock()
+_entries = {}       # (campaign_id, name) -> (version, value)
+_recent = []        # Keys of _entries, least recently used first
+_versions = {}      # campaign_id -> (version, time we read it)
+
+
+def _version_key(campaign_id):
+    """Memcached key of a campaigns version"""
+    return 'ge_catalog_version_%d' % campaign_id
+
+
+def _entry_key(campaign_id, name, version):
+    """Memcached key of an entry"""
+    return 'ge_catalog_%d_%s_%d' % (campaign_id, name, version)
+
+
+def version(campaign_id):
+    """The current version of a campaigns entries.
+    Only asks memcached if we haven't for CATALOG_CHECK_SECONDS."""
+    if campaign_id == GLOBAL:
+        return 0
+
+    now = time.time()
+    with _lock:
+        local = _versions.get(campaign_id)
+    if local and now - local[1] < settings.CATALOG_CHECK_SECONDS:
+        return local[0]
+
+    current = cache.get(_version_key(campaign_id))
+    if current is None:
+        # New, or memcached restarted. Start from the time, so we don't
+        # go back to a version a process might still have.
+        cache.add(_version_key(campaign_id), int(now))
+        current = cache.get(_version_key(campaign_id)) or int(now)
+
+    with _lock:
+        _versions[campaign_id] = (current, now)
+    return current
+
+
+def bump(campaign_id):
+    """The campaign or its indicators changed. Drops its entries in every process
+    (in other processes, within CATALOG_CHECK_SECONDS)."""
+    try:
+        current = cache.incr(_version_key(campaign_id))
+    except ValueError:      # Not in memcached
+        current = int(time.time())
+        cache.set(_version_key(campaign_id), current)
+
+    with _lock:
+        _versions[campaign_id] = (current, time.time())
+
+
+def get(campaign_id, name, load):
+    """The named entry for a campaign, from this process, or memcached, or by
+    calling load() and storing the result in both.
+    @param campaign_id Campaign id, or GLOBAL
+    @param load Function to build the value if it isn't cached
+    """
+    current = version(campaign_id)
+    local_key = (campaign_id, name)
+
+    with _lock:
+        entry = _entries.get(local_key)
+        if entry and entry[0] == current:
+            _touch(local_key)
+            return entry[1]
+
+    # Wrapped in a tuple, so an empty value is still a hit
+    cache_key = _entry_key(campaign_id, name, current)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        value = cached[0]
+    else:
+        value = load()
+        cache.set(cache_key, (value,))
+
+    with _lock:
+        _entries[local_key] = (current, value)
+        _touch(local_key)
+    return value
+
+
+def _touch(local_key):
+    """Marks local_key as just used, and forgets the least recently used entries
+    if there are too many. Call with _lock held."""
+    if local_key in _recent:
+        _recent.remove(local_key)
+    _recent.append(local_key)
+
+    while len(_recent) > settings.CATALOG_SIZE:
+        del _entries[ _recent.pop(0) ]
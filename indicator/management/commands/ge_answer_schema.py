@@ -0,0 +1,210 @@
+"""Schema upkeep for indicator_answer, for databases created before its 
+indexes and unique constraint:
+
+    ./manage.py ge_answer_schema dedupe [--dry-run]   Remove duplicate answers
+    ./manage.py ge_answer_schema indexes              Add the indexes
+    ./manage.py ge_answer_schema explain              Check the hot queries use an index
+
+New databases get the same indexes from syncdb (Answer.Meta and sql/answer.sql).
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Disable the pylint check for dynamically added attributes. This happens a lot
+# with Django DB model usage.
+# pylint: disable-msg=E1101
+# pylint: disable-msg=E1103
+
+import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from django.core.management.base import BaseCommand, CommandError
+
+from indicator.models import Indicator, Answer, AverageAccumulator
+
+INDEXES = [
+    # User's answers: by_indicator, next, create_update, previously, compared_to_average
+    "CREATE UNIQUE INDEX indicator_answer_user_indicator_date "+\
+            "ON indicator_answer (user_id, indicator_id, action_date);",
+    # Daily averages, participation, exports
+    "CREATE INDEX indicator_answer_indicator_date "+\
+            "ON indicator_answer (indicator_id, action_date);",
+]
+
+class Command(BaseCommand):
+    'Indexes and duplicates of indicator_answer'
+
+    args = 'dedupe | indexes | explain'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='dedupe: Only report the duplicates'),
+    )
+    help = 'Remove duplicate answers, add indexes to indicator_answer, check the query plans'
+
+    def handle(self, *args, **options):
+        'Main entry point for command'
+
+        if len(args) != 1 or args[0] not in ('dedupe', 'indexes', 'explain'):
+            raise CommandError('Usage: ge_answer_schema %s' % self.args)
+
+        if args[0] == 'dedupe':
+            self.dedupe(options['dry_run'])
+        elif args[0] == 'indexes':
+            self.indexes()
+        else:
+            self.explain()
+
+    def dedupe(self, dry_run):
+        """Keeps the newest of each users answers to an indicator on a day, 
+        then rebuilds the averages of the indicator days that changed."""
+
+        cursor = connection.cursor()
+        cursor.execute(
+                "select user_id, indicator_id, action_date, max(id), count(*) "+\
+                "from indicator_answer where indicator_id is not null "+\
+                "group by user_id, indicator_id, action_date having count(*) > 1;")
+        duplicates = cursor.fetchall()
+
+        num_deleted = 0
+        indicator_days = set()
+        for user_id, indicator_id, action_date, keep_id, count in duplicates:
+            print('User %s, indicator %s, %s: %d answers, keeping %s' % 
+                    (user_id, indicator_id, action_date, count, keep_id))
+            num_deleted += count - 1
+            indicator_days.add( (indicator_id, action_date) )
+
+            if not dry_run:
+                cursor.execute(
+                        "delete from indicator_answer where user_id = %s "+\
+                        "and indicator_id = %s and action_date = %s and id <> %s;",
+                        [user_id, indicator_id, action_date, keep_id])
+
+        if dry_run:
+            print('Would delete %d answers' % num_deleted)
+            return
+
+        transaction.commit_unless_managed()
+        print('Deleted %d answers' % num_deleted)
+
+        # The running totals and averages included the duplicates
+        indicators = dict( [(ind.id, ind) for ind in Indicator.objects.load_concrete( 
+                Indicator.objects.filter(id__in = [ind_id for ind_id, _ in indicator_days]) )] )
+        for indicator_id, action_date in sorted(indicator_days):
+            indicator = indicators.get(indicator_id)
+            if not indicator or indicator.is_synthetic:
+                continue
+            AverageAccumulator.objects.rebuild(indicator, action_date)
+            indicator.average(action_date)
+        print('Rebuilt averages for %d indicator days' % len(indicator_days))
+
+    def indexes(self):
+        'Adds the indexes, skipping the ones that exist'
+
+        cursor = connection.cursor()
+        for sql in INDEXES:
+            try:
+                cursor.execute(sql)
+                transaction.commit_unless_managed()
+                print('Created: %s' % sql)
+            except DatabaseError, exc:
+                transaction.rollback_unless_managed()
+                print('Skipped (%s): %s' % (str(exc).strip(), sql))
+
+        print('If the unique index failed on duplicate rows, run: ge_answer_schema dedupe')
+
+    def explain(self):
+        'Prints the plan of each hot query, and fails if any of them reads the whole table'
+
+        try:
+            sample = Answer.objects.exclude(indicator_id = None).order_by('-id')[0]
+        except IndexError:
+            raise CommandError('Need at least one answer to build the queries')
+
+        user_id = sample.user_id
+        indicator_id = sample.indicator_id
+        day = sample.action_date
+
+        queries = [
+            ('by_indicator', Answer.objects.filter(
+                user__id = user_id, indicator_id = indicator_id, is_skip = False).\
+                        order_by('action_date')),
+            ('next', Answer.objects.filter(
+                indicator_id__in = [indicator_id], user__id = user_id, action_date = day)),
+            ('create_update', Answer.objects.filter(
+                user__id = user_id, indicator_id = indicator_id, action_date = day)),
+            ('previously', Answer.objects.filter(
+                user__id = user_id, indicator_id = indicator_id).order_by('-action_date')[:1]),
+            ('compared_to_average', Answer.objects.filter(
+                user__id = user_id, action_date = day, is_skip = False, 
+                indicator_id = indicator_id)),
+            ('average', Answer.objects.filter(
+                indicator_id = indicator_id, action_date = day, is_skip = False)),
+            ('export', Answer.objects.filter(
+                indicator_id__in = [indicator_id], 
+                action_date__range = (day - datetime.timedelta(30), day))),
+        ]
+
+        engine = settings.DATABASES['default']['ENGINE']
+        cursor = connection.cursor()
+        if 'postgresql' in engine:
+            # Small tables are quicker to scan. We want to know if it *can* use an index.
+            cursor.execute("set enable_seqscan = off;")
+
+        failed = []
+        for name, queryset in queries:
+            sql, params = queryset.query.get_compiler(using = queryset.db).as_sql()
+            plan, uses_index = explain(cursor, engine, sql, params)
+            print('%s: %s\n    %s' % 
+                    (name, 'index' if uses_index else 'NO INDEX', '\n    '.join(plan)))
+            if not uses_index:
+                failed.append(name)
+
+        if 'postgresql' in engine:
+            cursor.execute("set enable_seqscan = on;")
+
+        if failed:
+            raise CommandError('Not using an index: %s' % ', '.join(failed))
+
+
+def explain(cursor, engine, sql, params):
+    """The query plan for sql.
+    @return Tuple of (plan as list of strings, does it use an index on indicator_answer)
+    """
+    if 'mysql' in engine:
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [col[0] for col in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        plan = [', '.join(['%s=%s' % (col, row[col]) for col in columns]) for row in rows]
+        uses_index = all([row['key'] for row in rows if row['table'] == 'indicator_answer'])
+
+    elif 'sqlite' in engine:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = [row[-1] for row in cursor.fetchall()]
+        uses_index = not [line for line in plan 
+                          if 'indicator_answer' in line and 'INDEX' not in line]
+
+    else:
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = [row[0] for row in cursor.fetchall()]
+        uses_index = not [line for line in plan if 'Seq Scan on indicator_answer' in line]
+
+    return plan, uses_index
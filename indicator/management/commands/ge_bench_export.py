@@ -0,0 +1,109 @@
+"""Times the answers CSV export for a campaign, and checks it stays within a 
+memory ceiling. Writes the CSV to /dev/null, or to --output.
+Run it against a large database (millions of answers) to check the export
+really streams.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Disable the pylint check for dynamically added attributes. This happens a lot
+# with Django DB model usage.
+# pylint: disable-msg=E1101
+# pylint: disable-msg=E1103
+
+import time
+import resource
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core import export
+from indicator.models import Indicator
+from indicator.views import ANSWERS_CSV_HEADER, answers_csv_chunks
+from campaign.models import Campaign
+
+
+def peak_memory_mb():
+    'Most memory this process has used so far, in MB. ru_maxrss is in KB on Linux.'
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Command(BaseCommand):
+    'Benchmark the answers CSV export'
+
+    args = '<campaign_id>'
+    option_list = BaseCommand.option_list + (
+        make_option('--start', dest='start', default=None,
+            help='First action date to export (YYYY-MM-DD). Defaults to all.'),
+        make_option('--end', dest='end', default=None,
+            help='Last action date to export (YYYY-MM-DD). Defaults to all.'),
+        make_option('--max-memory', type='int', dest='max_memory', default=200,
+            help='Fail if the process uses more than this many MB'),
+        make_option('--output', dest='output', default='/dev/null',
+            help='File to write the CSV to'),
+    )
+    help = 'Time exporting a campaigns answers as CSV, and check the memory used'
+
+    def handle(self, *args, **options):
+        'Main entry point for command'
+
+        if len(args) != 1:
+            raise CommandError('Usage: ge_bench_export <campaign_id>')
+        try:
+            campaign = Campaign.objects.get(pk = args[0])
+        except Campaign.DoesNotExist:
+            raise CommandError('Campaign with id %s not found' % args[0])
+
+        try:
+            start, end = export.date_range(options)
+        except ValueError:
+            raise CommandError('Dates must be YYYY-MM-DD')
+
+        settings.DEBUG = False   # Otherwise Django keeps every query in memory
+
+        indicator_ids = list( Indicator.objects.\
+                filter(campaign = campaign).values_list('id', flat=True) )
+
+        memory_before = peak_memory_mb()
+        start_time = time.time()
+        num_rows = -1           # Not counting the header
+        num_bytes = 0
+
+        out = open(options['output'], 'wb')
+        try:
+            row_chunks = answers_csv_chunks(indicator_ids, start, end)
+            for text in export.csv_lines(ANSWERS_CSV_HEADER, row_chunks):
+                out.write(text)
+                num_rows += text.count('\n')
+                num_bytes += len(text)
+        finally:
+            out.close()
+
+        duration = time.time() - start_time
+        memory_after = peak_memory_mb()
+
+        print('%d answers, %.1f MB of CSV in %.1fs (%d rows/s)' % 
+                (num_rows, num_bytes / 1048576.0, duration, num_rows / max(duration, 0.001)))
+        print('Peak memory: %.1f MB (%.1f MB before exporting)' % (memory_after, memory_before))
+
+        if memory_after > options['max_memory']:
+            raise CommandError('Used %.1f MB, over the %d MB ceiling' % 
+                    (memory_after, options['max_memory']))
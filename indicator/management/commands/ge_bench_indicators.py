@@ -0,0 +1,81 @@
+"""Counts the queries needed to load the indicators of a campaign as their 
+subclasses, the old way (probing each subclass relation) against the new way 
+(Indicator.indicator_type).
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Disable the pylint check for dynamically added attributes. This happens a lot
+# with Django DB model usage.
+# pylint: disable-msg=E1101
+# pylint: disable-msg=E1103
+
+from django.conf import settings
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+
+from indicator.models import Indicator
+from campaign.models import Campaign
+
+
+def count_queries(func):
+    'Number of queries func runs, and its result'
+    start = len(connection.queries)
+    result = func()
+    return len(connection.queries) - start, result
+
+
+class Command(BaseCommand):
+    'Benchmark indicator loading'
+
+    args = '<campaign_id>'
+    help = 'Count the queries to load a campaigns indicators, old way against new'
+
+    def handle(self, *args, **options):
+        'Main entry point for command'
+
+        if len(args) != 1:
+            raise CommandError('Usage: ge_bench_indicators <campaign_id>')
+        try:
+            campaign = Campaign.objects.get(pk = args[0])
+        except Campaign.DoesNotExist:
+            raise CommandError('Campaign with id %s not found' % args[0])
+
+        settings.DEBUG = True   # Makes Django record connection.queries
+        base_list = list( Indicator.objects.filter(campaign = campaign) )
+        if not base_list:
+            raise CommandError('Campaign %s has no indicators' % campaign.id)
+
+        old_count, _ = count_queries(
+                lambda: [ind._probe_subclass() for ind in base_list])
+        new_count, _ = count_queries(
+                lambda: [ind.subclass() for ind in base_list])
+        bulk_count, _ = count_queries(
+                lambda: Indicator.objects.load_concrete(base_list))
+
+        print('%d indicators' % len(base_list))
+        print('subclass() on each, probing relations: %d queries' % old_count)
+        print('subclass() on each, using indicator_type: %d queries' % new_count)
+        print('load_concrete on all: %d queries' % bulk_count)
+
+        # What a dashboard render does with a cold cache
+        dashboard_count, _ = count_queries(
+                lambda: Indicator.objects.all_regular_indicators(campaign, force=True))
+        print('all_regular_indicators, cache cold: %d queries' % dashboard_count)
@@ -0,0 +1,103 @@
+"""Times the graph data calculation (Indicator.answers_with_average) with NumPy 
+(indicator.series) against the pure python version, on generated histories.
+Doesn't touch the database.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import time
+import random
+import datetime
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from indicator.models import IndicatorLikert
+from indicator import series
+
+HISTORIES = [('1 year', 365), ('5 years', 365 * 5)]
+REPEAT = 20
+
+
+class FakeAnswer(object):
+    """Just the Answer attributes the graph code uses"""
+
+    def __init__(self, answer_id, action_date, answer_num):
+        self.id = answer_id
+        self.action_date = action_date
+        self.answer_num = answer_num
+
+
+def make_rows(num_days, answer_rate, value_func, first_id):
+    """(id, action_date, answer_num) for an answer on answer_rate of the last num_days"""
+    start = datetime.date.today() - datetime.timedelta(num_days)
+    rows = []
+    for day in range(num_days):
+        if random.random() < answer_rate:
+            rows.append( (first_id + day, start + datetime.timedelta(day), value_func()) )
+    return rows
+
+
+def is_same(result_a, result_b):
+    """Are the two graph data results the same, allowing for float rounding"""
+    if sorted(result_a[4]) != sorted(result_b[4]):    # Missing answer ids, any order
+        return False
+
+    for series_a, series_b in zip(result_a[:4], result_b[:4]):
+        if len(series_a) != len(series_b):
+            return False
+        for point_a, point_b in zip(series_a, series_b):
+            if point_a[0] != point_b[0] or abs(point_a[1] - point_b[1]) > 1e-9:
+                return False
+    return True
+
+
+class Command(NoArgsCommand):
+    'Benchmark graph data calculation'
+    
+    help = 'Benchmark graph data calculation, NumPy against pure python'
+    
+    def handle_noargs(self, **options):       # We don't use **options  pylint: disable-msg=W0613
+        'Called by NoArgsCommand'
+
+        if not series.numpy:
+            raise CommandError('NumPy is not installed')
+
+        indicator = IndicatorLikert(name='Benchmark')
+
+        for label, num_days in HISTORIES:
+            from_rows = make_rows(num_days, 0.8, lambda: random.randint(1, 5), 0)
+            to_rows = make_rows(num_days, 0.95, lambda: random.uniform(1, 5), num_days)
+
+            from_answers = [FakeAnswer(*row) for row in from_rows]
+            to_answers = [FakeAnswer(*row) for row in to_rows]
+
+            start = time.time()
+            for _ in range(REPEAT):
+                python_result = indicator._graph_series(from_answers, to_answers)
+            python_ms = (time.time() - start) * 1000 / REPEAT
+
+            start = time.time()
+            for _ in range(REPEAT):
+                numpy_result = series.graph_series(from_rows, to_rows)
+            numpy_ms = (time.time() - start) * 1000 / REPEAT
+
+            print('%s: python %.2f ms, numpy %.2f ms, %.1fx faster, results %s' % 
+                    (label, python_ms, numpy_ms, python_ms / numpy_ms,
+                    'match' if is_same(python_result, numpy_result) else 'DIFFER'))
@@ -1,5 +1,10 @@
 """Calculates the daily mean for each indicator. 
 The mean is stored as an Answer owned by a special user.
+
+The days of each campaign are split into chunks which run in a pool of processes.
+Each finished chunk is recorded as a BackfillCheckpoint, so running the same 
+command again after a crash skips them. The checkpoints are deleted once a run 
+finishes without errors.
 """
 
 #    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
@@ -27,44 +32,187 @@ The mean is stored as an Answer owned by a special user.
 # pylint: disable-msg=E1103
 
 import datetime
+import time
+import logging
+import multiprocessing
+from optparse import make_option
 
-from django.core.management.base import NoArgsCommand
-from django.db.models import Min
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
 
-from indicator.models import Indicator
+from indicator.models import Indicator, Answer, BackfillCheckpoint
 from campaign.models import Campaign
 from profile.models import Group
 
-class Command(NoArgsCommand):
+class Command(BaseCommand):
     'Calculate the daily mean for each indicator'
     
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+            help='Only calculate days from this date (YYYY-MM-DD). Defaults to campaign start.'),
+        make_option('--campaign', type='int', dest='campaign_id', default=None,
+            help='Only calculate the campaign with this id'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='List the chunks that would be calculated, and how many answers they have'),
+        make_option('--processes', type='int', dest='processes', 
+            default=multiprocessing.cpu_count(),
+            help='Number of processes to calculate chunks in. Defaults to one per CPU.'),
+        make_option('--chunk-days', type='int', dest='chunk_days', default=7,
+            help='Number of days in each chunk'),
+        make_option('--restart', action='store_true', dest='restart', default=False,
+            help='Forget the chunks a previous run finished, and do them again'),
+    )
     help = 'Calculate the daily mean for each indicator'
     
-    def handle_noargs(self, **options):       # We don't use **options  pylint: disable-msg=W0613
-        'Called by NoArgsCommand'
-        
-        one_day = datetime.timedelta(1)
-        average_date = datetime.date.today() - one_day
-        end_date = Campaign.objects.aggregate( Min('start_date') )['start_date__min']
+    def handle(self, *args, **options):
+        'Main entry point for command'
         
-        average_user = Indicator.objects.average_user()
+        campaign_list = Campaign.objects.all()
+        if options['campaign_id']:
+            campaign_list = campaign_list.filter(id = options['campaign_id'])
+            if not campaign_list:
+                raise CommandError('Campaign with id %s not found' % options['campaign_id'])
+
+        since = None
+        if options['since']:
+            try:
+                since = datetime.datetime.strptime(options['since'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--since must be a date like 2011-01-31')
+
+        if options['chunk_days'] < 1:
+            raise CommandError('--chunk-days must be at least 1')
+
+        yesterday = datetime.date.today() - datetime.timedelta(1)
+        chunk_list = []
+        for campaign in campaign_list:
+            start_date = max(campaign.start_date, since) if since else campaign.start_date
+            chunk_list.extend( 
+                    chunks(campaign.id, start_date, yesterday, options['chunk_days']) )
+
+        if options['restart']:
+            BackfillCheckpoint.objects.filter(campaign__in = campaign_list).delete()
+
+        done = set( BackfillCheckpoint.objects.\
+                filter(campaign__in = campaign_list).\
+                values_list('campaign', 'start_date', 'end_date') )
+        todo = [chunk for chunk in chunk_list if chunk not in done]
+        print('%d chunks, %d already done by a previous run' % 
+                (len(chunk_list), len(chunk_list) - len(todo)))
 
+        if options['dry_run']:
+            for campaign_id, start_date, end_date in todo:
+                num_answers = Answer.objects.filter(
+                        indicator_id__in = campaign_indicator_ids(campaign_id),
+                        action_date__range = (start_date, end_date)).count()
+                print('Campaign %s, %s to %s: %d answers' % 
+                        (campaign_id, start_date, end_date, num_answers))
+            return
+
+        # Child processes must open their own DB connection
+        connection.close()
+        pool = multiprocessing.Pool(options['processes'], _init_pool_process)
+
+        run_start = time.time()
+        total_rows = 0
+        failed = []
         try:
-            while average_date > end_date:
-                print 'Calculating mean for all indicators on %s' % average_date
-                
-                for campaign in Campaign.objects.all():
+            for chunk, num_rows, seconds, error in \
+                    pool.imap_unordered(calculate_chunk, todo):
+
+                campaign_id, start_date, end_date = chunk
+                if error:
+                    failed.append(chunk)
+                    print('Campaign %s, %s to %s: FAILED %s' % 
+                            (campaign_id, start_date, end_date, error))
+                    continue
+
+                total_rows += num_rows
+                print('Campaign %s, %s to %s: %d rows in %.1fs, %.0f rows/s' % 
+                        (campaign_id, start_date, end_date, 
+                            num_rows, seconds, num_rows / max(seconds, 0.001)))
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - run_start
+        print('Saved %d rows in %.1fs, %.0f rows/s' % 
+                (total_rows, elapsed, total_rows / max(elapsed, 0.001)))
+
+        if failed:
+            raise CommandError('%d chunks failed. Run again to retry them.' % len(failed))
+
+        BackfillCheckpoint.objects.filter(campaign__in = campaign_list).delete()
+
+
+def chunks(campaign_id, start_date, end_date, chunk_days):
+    """Splits start_date to end_date into chunks of chunk_days, newest first.
+    Boundaries are fixed multiples of chunk_days, so they are the same from one
+    day to the next, and a run resumed tomorrow finds todays checkpoints.
+    @return List of (campaign_id, start_date, end_date), dates inclusive.
+    """
+    result = []
+    if start_date > end_date:
+        return result
+
+    first = start_date.toordinal() // chunk_days
+    last = end_date.toordinal() // chunk_days
+    for index in range(last, first - 1, -1):
+        chunk_start = datetime.date.fromordinal(index * chunk_days)
+        chunk_end = datetime.date.fromordinal((index + 1) * chunk_days - 1)
+        result.append( (campaign_id, max(chunk_start, start_date), min(chunk_end, end_date)) )
+    return result
+
+
+def campaign_indicator_ids(campaign_id):
+    'Ids of the regular indicators of a campaign'
+    campaign = Campaign.objects.get(pk = campaign_id)
+    return [ind.id for ind in Indicator.objects.all_regular_indicators(campaign)]
+
+
+def _init_pool_process():
+    """Runs in each new pool process. Don't share the parents DB connection"""
+    connection.connection = None
+
+
+def calculate_chunk(chunk):
+    """Calculates the means of one chunk, then records it as done. Runs in a pool process.
+    @param chunk (campaign_id, start_date, end_date)
+    @return Tuple of (chunk, number of averages saved, seconds taken, error or None)
+    """
+    start = time.time()
+    campaign_id, start_date, end_date = chunk
+    num_rows = 0
+
+    try:
+        campaign = Campaign.objects.get(pk = campaign_id)
+        indicator_list = Indicator.objects.all_regular_indicators(campaign)
+
+        avg_user_ids = list( Group.objects.\
+                filter(avg_user__isnull = False).\
+                values_list('avg_user', flat=True) )
+        avg_user_ids.append( Indicator.objects.average_user().id )
+
+        average_date = end_date
+        while average_date >= start_date:
+
+            for indicator in indicator_list:
+                num_rows += len( indicator.average(average_date) )
 
-                    for indicator in Indicator.objects.all_regular_indicators(campaign):
-                        indicator.average(average_date)
+            num_rows += len( Indicator.objects.calculate_day_averages(campaign, 
+                    [(user_id, average_date) for user_id in avg_user_ids]) )
 
-                        for group in Group.objects.all():
-                            indicator.average(average_date, group=group)
-                            Indicator.objects.calculate_day_average(campaign, group.avg_user, average_date)
+            average_date -= datetime.timedelta(1)
 
-                    Indicator.objects.calculate_day_average(campaign, average_user, average_date)
+        BackfillCheckpoint.objects.create(
+                campaign = campaign, 
+                start_date = start_date,
+                end_date = end_date,
+                num_rows = num_rows)
+        transaction.commit_unless_managed()
 
-                average_date -= one_day
+    except Exception, exc:
+        logging.exception('Error calculating means for %s', chunk)
+        return (chunk, num_rows, time.time() - start, str(exc))
 
-        except Exception:
-            import pudb; pudb.post_mortem()
+    return (chunk, num_rows, time.time() - start, None)
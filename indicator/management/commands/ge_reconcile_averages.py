@@ -0,0 +1,115 @@
+"""Rebuilds the running average totals (AverageAccumulator) from the Answers,
+and reports any that had drifted.
+
+With --schema, first empties the table and adds AverageAccumulator.scope and its 
+unique index to a table created before them. The totals are all derived from the 
+Answers, so the run that follows puts them back.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Disable the pylint check for dynamically added attributes. This happens a lot
+# with Django DB model usage.
+# pylint: disable-msg=E1101
+# pylint: disable-msg=E1103
+
+import datetime
+from optparse import make_option
+
+from django.db import connection, transaction, DatabaseError
+from django.core.management.base import BaseCommand, CommandError
+
+from indicator.models import Indicator, Answer, AverageAccumulator
+from campaign.models import Campaign
+
+# Run by --schema, in order
+SCHEMA = [
+    "DELETE FROM indicator_averageaccumulator;",
+    "ALTER TABLE indicator_averageaccumulator ADD COLUMN scope integer NOT NULL DEFAULT 0;",
+    "CREATE UNIQUE INDEX indicator_averageaccumulator_scope "+\
+            "ON indicator_averageaccumulator (indicator_id, action_date, scope);",
+]
+
+class Command(BaseCommand):
+    'Rebuild the running average totals from the answers'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+            help='Only check the last DAYS days. Defaults to all days.'),
+        make_option('--campaign', type='int', dest='campaign_id', default=None,
+            help='Only check the campaign with this id'),
+        make_option('--schema', action='store_true', dest='schema', default=False,
+            help='First empty the table and add the scope column, see module doc'),
+    )
+    help = 'Rebuild the running average totals from the answers, and report drift'
+
+    def handle(self, *args, **options):
+        'Main entry point for command'
+
+        if options['schema']:
+            if options['days'] or options['campaign_id']:
+                raise CommandError('--schema empties the table, so it rebuilds every day '+
+                                   'of every campaign. Leave out --days and --campaign.')
+            self.schema()
+
+        campaign_list = Campaign.objects.all()
+        if options['campaign_id']:
+            campaign_list = campaign_list.filter(id = options['campaign_id'])
+            if not campaign_list:
+                raise CommandError('Campaign with id %s not found' % options['campaign_id'])
+
+        start_date = None
+        if options['days']:
+            start_date = datetime.date.today() - datetime.timedelta(options['days'])
+
+        num_checked = 0
+        num_drifted = 0
+
+        for campaign in campaign_list:
+            for indicator in Indicator.objects.all_regular_indicators(campaign):
+
+                answer_qs = Answer.objects.filter(indicator_id = indicator.id)
+                if start_date:
+                    answer_qs = answer_qs.filter(action_date__gte = start_date)
+                date_list = answer_qs.values_list('action_date', flat=True).distinct()
+
+                for action_date in date_list:
+                    num_checked += 1
+                    drift = AverageAccumulator.objects.rebuild(indicator, action_date)
+
+                    for group_id, old_totals, new_totals in drift:
+                        num_drifted += 1
+                        print('Drift on %s, %s, group %s: was %s / %s, now %s / %s' % 
+                                ((indicator, action_date, group_id) + old_totals + new_totals))
+
+        print('Checked %d indicator days, fixed %d totals' % (num_checked, num_drifted))
+
+    def schema(self):
+        'Empties the table, and adds the scope column and index, skipping the ones that exist'
+
+        cursor = connection.cursor()
+        for sql in SCHEMA:
+            try:
+                cursor.execute(sql)
+                transaction.commit_unless_managed()
+                print('Done: %s' % sql)
+            except DatabaseError, exc:
+                transaction.rollback_unless_managed()
+                print('Skipped (%s): %s' % (str(exc).strip(), sql))
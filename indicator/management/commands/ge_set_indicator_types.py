@@ -0,0 +1,65 @@
+"""Records the subclass of each Indicator saved before Indicator.indicator_type existed.
+On an existing database, adds the column first (see ADD_COLUMN). Safe to run again.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Disable the pylint check for dynamically added attributes. This happens a lot
+# with Django DB model usage.
+# pylint: disable-msg=E1101
+# pylint: disable-msg=E1103
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction, DatabaseError
+
+from indicator.models import Indicator, INDICATOR_TYPES
+
+ADD_COLUMN = "ALTER TABLE indicator_indicator "+\
+        "ADD COLUMN indicator_type varchar(50) NOT NULL DEFAULT '';"
+
+class Command(NoArgsCommand):
+    'Set indicator_type on old indicators'
+    
+    help = 'Set indicator_type on indicators saved before it existed'
+    
+    def handle_noargs(self, **options):       # We don't use **options  pylint: disable-msg=W0613
+        'Called by NoArgsCommand'
+
+        cursor = connection.cursor()
+        try:
+            cursor.execute(ADD_COLUMN)
+            transaction.commit_unless_managed()
+            print('Added: indicator_indicator.indicator_type')
+        except DatabaseError, exc:
+            transaction.rollback_unless_managed()
+            print('Skipped (%s): indicator_indicator.indicator_type' % str(exc).strip())
+
+        for indicator_type, model in INDICATOR_TYPES.items():
+            sql = "update indicator_indicator set indicator_type = %s "+\
+                    "where indicator_type = '' and id in "+\
+                    "(select indicator_ptr_id from "+ model._meta.db_table +");"
+            cursor.execute(sql, [indicator_type])
+            print('%s: %d indicators' % (indicator_type, cursor.rowcount))
+
+        transaction.commit_unless_managed()
+
+        num_missing = Indicator.objects.filter(indicator_type = '').count()
+        if num_missing:
+            print('%d indicators have no subclass row' % num_missing)
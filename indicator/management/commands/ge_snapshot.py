@@ -0,0 +1,88 @@
+"""Writes columnar snapshots of campaigns (answers, indicators, profiles, groups)
+for reporting, see indicator.snapshot. Run it daily: each run only adds the new days.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Disable the pylint check for dynamically added attributes. This happens a lot
+# with Django DB model usage.
+# pylint: disable-msg=E1101
+# pylint: disable-msg=E1103
+
+
+import datetime
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from indicator import snapshot
+from campaign.models import Campaign
+
+
+class Command(BaseCommand):
+    'Snapshot campaign data to columnar files'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--campaign', type='int', dest='campaign_id', default=None,
+            help='Only snapshot the campaign with this id'),
+        make_option('--path', dest='path', default=None,
+            help='Directory to write to. Defaults to settings.SNAPSHOT_DIR'),
+        make_option('--until', dest='until', default=None,
+            help='Last action date to write (YYYY-MM-DD). '+ 
+                 'Defaults to settings.SNAPSHOT_OPEN_DAYS before today.'),
+        make_option('--compress', action='store_true', dest='compress', default=False,
+            help='Write compressed .npz files. Smaller, but readers can not memory-map them.'),
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Delete the existing snapshot and write every day again'),
+    )
+    help = 'Write columnar snapshots of campaign data for reporting'
+
+    def handle(self, *args, **options):
+        'Main entry point for command'
+
+        if not snapshot.numpy:
+            raise CommandError('NumPy is not installed')
+
+        campaign_list = Campaign.objects.all()
+        if options['campaign_id']:
+            campaign_list = campaign_list.filter(id = options['campaign_id'])
+            if not campaign_list:
+                raise CommandError('Campaign with id %s not found' % options['campaign_id'])
+
+        until = None
+        if options['until']:
+            try:
+                until = datetime.datetime.strptime(options['until'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--until must be YYYY-MM-DD')
+
+        path = options['path'] or settings.SNAPSHOT_DIR
+
+        for campaign in campaign_list:
+            start_time = time.time()
+            written = snapshot.write(campaign, path, 
+                    until = until, 
+                    compress = options['compress'], 
+                    rebuild = options['rebuild'])
+            print('%s: wrote %d days in %.1fs, to %s' % 
+                    (campaign.name, len(written), time.time() - start_time, 
+                        snapshot.campaign_dir(path, campaign.id)))
@@ -27,14 +27,15 @@
 # Django manages have many public methods
 # pylint: disable-msg=R0904
 
-import math
+import copy
 import datetime
 import random
 from collections import deque
 
 from django.db import models
-from django.db import connection
-from django.db.models import Avg
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Avg, F
+from django.db.models.signals import post_save, post_delete
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.cache import cache
 from django.db.models.fields.related import OneToOneField
@@ -42,42 +43,93 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 
 from profile.models import Profile, Group
-from campaign.models import Campaign 
+from campaign.models import Campaign, CampaignMembership, CampaignStats
 from core.util import get_current_user
 from core import messaging
-from indicator.util import answer_map_by_date
+from indicator.util import answer_map_by_date, likert_percentage, likert_percentages
+from indicator import series, ready, catalog
 
 OVERALL_INDICATOR_NAME = 'OVERALL'
 AVERAGE_USERNAME = 'AVERAGE'
 
+# AverageAccumulator.scope of the totals for everyone. Group ids start at 1.
+EVERYONE_SCOPE = 0
+
+# How long a cached DailyProgress bitmap is used. Short, so that if a fill from
+# an old read lands after a newer value, it is soon replaced from the DB.
+PROGRESS_CACHE_SECONDS = 60
+
+def userize(user_or_group):
+    """Takes a Profile or Group and returns a Profile.
+    If given a Group, returns the system user that owns that groups averages"""
+
+    if isinstance(user_or_group, Profile):
+        return user_or_group
+
+    elif isinstance(user_or_group, Group):
+        return user_or_group.avg_user
+
+    else:
+        return None
+
 def org_files_dir(instance, filename):
     'The path to store files for an instance of Indicator, relative to MEDIA_ROOT'
     return 'organization/'+ instance.campaign.organization.slug +'/'+ filename
 
+# Model class -> ContentType, see content_type_for
+_CONTENT_TYPES = {}
+
+def content_type_for(model):
+    'The ContentType of a model class. Looked up once per process.'
+    if model not in _CONTENT_TYPES:
+        _CONTENT_TYPES[model] = ContentType.objects.get_for_model(model)
+    return _CONTENT_TYPES[model]
+
 class IndicatorManager(models.Manager):
     'Methods above the level of a single Indicator'
     
     def all_regular_indicators(self, campaign, force=False):
-        'All the non-synthetic indicators, ordered by position, for this campaign'
-        
-        cache_key = 'ge_indicators_%d' % campaign.id
-        result = cache.get(cache_key) or []
+        """All the non-synthetic indicators, ordered by position, for this campaign.
+        Likert indicators have their options loaded.
+        @param force Reload from the database, for every process
+        """
 
-        if not result or force: 
-            result = []
-            app = models.get_app('indicator')
-            for model in models.get_models(app):
-                if Indicator in model.__bases__:
+        if force:
+            catalog.bump(campaign.id)
 
-                    queryset = model.objects.filter(campaign = campaign, is_synthetic = False)
-                    result.extend( list(queryset) )
+        def load():
+            'Read them from the database'
+            result = []
+            for model in INDICATOR_TYPES.values():
+                queryset = model.objects.filter(campaign = campaign, is_synthetic = False)
+                result.extend( list(queryset) )
             
             result.sort(key = lambda x: x.position)
+            self.load_options(result)
+            return result
 
-            cache.set(cache_key, result)
-
-        return result
+        # Copies, because callers set attributes on them
+        return [copy.copy(ind) for ind in catalog.get(campaign.id, 'indicators', load)]
     
+    def load_concrete(self, indicators):
+        """The subclass instances of the given Indicators, in the same order. 
+        One query per indicator type, instead of calling subclass() on each.
+        @param indicators List or QuerySet of Indicator, which may already be subclasses
+        """
+        indicators = list(indicators)
+
+        ids_by_type = {}
+        for ind in indicators:
+            if ind.indicator_type in INDICATOR_TYPES and not hasattr(ind, 'indicator_ptr'):
+                ids_by_type.setdefault(ind.indicator_type, []).append(ind.id)
+
+        concrete = {}
+        for indicator_type, id_list in ids_by_type.items():
+            concrete.update( INDICATOR_TYPES[indicator_type].objects.in_bulk(id_list) )
+
+        # Already subclasses, or from before indicator_type was set
+        return [concrete.get(ind.id) or ind.subclass() for ind in indicators]
+
     def get_cached(self, campaign, indicator_id):
         """Like regular get for pk = indicator_id, but from cache if possible"""
         all_inds = self.all_regular_indicators(campaign)
@@ -86,86 +138,194 @@ class IndicatorManager(models.Manager):
                 return ind
         raise Indicator.DoesNotExist()
 
-    def next(self, user, campaign):
+    def next(self, user, campaign, day=None):
         """The next Indicator to ask this user, in the given campaign.
+        @param day The day being answered. Defaults to the users yesterday.
         @raise Indicator.DoesNotExist if this user has answered all their questions
         """
-        ind_ids_by_pos = [ind.id for ind in self.all_regular_indicators(campaign)]
+        if not day:
+            day = user.local_datetime().date() - datetime.timedelta(1)
 
-        day = user.local_datetime().date() - datetime.timedelta(1)
-        todays_answers = Answer.objects.filter(
-                indicator_id__in = ind_ids_by_pos,
-                user = user, 
-                action_date = day)
+        indicator_list = self.all_regular_indicators(campaign)
+        answered_ids = DailyProgress.objects.answered_ids(user, campaign, day, indicator_list)
 
-        # Remove the answered ones from the list
-        for answer in todays_answers:
-            ind_ids_by_pos.remove(answer.indicator_id)
+        for ind in indicator_list:
+            if ind.id not in answered_ids:
+                return ind
 
-        if not ind_ids_by_pos:
-            raise Indicator.DoesNotExist('All indicators answered already')
-        
-        return self.get_cached(campaign, ind_ids_by_pos[0])
+        raise Indicator.DoesNotExist('All indicators answered already')
+
+    def is_done(self, user, campaign, day=None):
+        """Has this user answered all the indicators of campaign for day
+        (defaults to the users yesterday)?"""
+        try:
+            self.next(user, campaign, day)
+            return False
+        except Indicator.DoesNotExist:
+            return True
 
     def average_user(self):
         """The user (profile.Profile) who owns the average results. 
         This user answers the indicators each day with the average of everyone else answers
         """
-        cache_key = 'ge_avg_user'   # Average user is common across all orgs and campaigns
-        user = cache.get(cache_key)
-        if not user:
-            user = Profile.objects.get(user__username = AVERAGE_USERNAME)
-            cache.set(cache_key, user)
-        return user
+        # Average user is common across all orgs and campaigns
+        user = catalog.get(catalog.GLOBAL, 'avg_user', 
+                lambda: Profile.objects.get(user__username = AVERAGE_USERNAME))
+        return copy.copy(user)
     
     def overall_indicator(self, campaign):
         """The synthetic indicator that shows the campaign average over all a users 
         indicators for a given day"""
-        cache_key = 'ge_overall_%d' % campaign.id
-        ind = cache.get(cache_key)
-        if not ind:
-            ind = IndicatorNumber.objects.get(name = OVERALL_INDICATOR_NAME, campaign = campaign)
-            cache.set(cache_key, ind)
-        return ind
+        ind = catalog.get(campaign.id, 'overall', 
+                lambda: IndicatorNumber.objects.get(name = OVERALL_INDICATOR_NAME, campaign = campaign))
+        return copy.copy(ind)
 
     def calculate_day_average(self, campaign, user, action_date):
         """Calculates and saves the average Answer for that user and action_date.
         Stored as an Answer against the overall_indicator"""
-        
+        self.calculate_day_averages(campaign, [(user.id, action_date)])
+
+    def calculate_day_averages(self, campaign, user_dates):
+        """Same as calculate_day_average for many users and days of a campaign at once. 
+        Reads all their answers in one query and saves the results with one update and
+        one insert.
+        @param user_dates List of (user id, action_date)
+        @return Map of (user id, action_date) to the average saved. Days without a 
+        (non-zero) average are left alone, and not included.
+        """
+        user_dates = set(user_dates)
+        if not user_dates:
+            return {}
+
         overall_indicator = self.overall_indicator(campaign)
-        
-        overall_avg = 0
-        count = 0
 
-        # Load all this users answers, only including indicators for current campaign
-        campaign_indicator_ids = [ind.id for ind in self.all_regular_indicators(campaign)] 
-        answers = Answer.objects.filter(
-                user = user, 
-                action_date = action_date, 
-                indicator_id__in = campaign_indicator_ids,
-                is_skip=False).select_related(depth=1)
+        # all_regular_indicators are already subclass instances
+        indicators = dict( [(ind.id, ind) for ind in self.all_regular_indicators(campaign)
+                            if ind.can_average()] )
+        self.load_options(indicators.values())
+
+        # Load all these users answers, only including indicators for current campaign
+        answer_rows = Answer.objects.filter(
+                user__id__in = list( set([user_id for user_id, _ in user_dates]) ),
+                action_date__in = list( set([action_date for _, action_date in user_dates]) ),
+                indicator_id__in = indicators.keys(),
+                is_skip = False).values_list('user', 'action_date', 'indicator_id', 'answer_num')
+
+        rows_by_indicator = {}
+        for user_id, action_date, indicator_id, answer_num in answer_rows:
+            key = (user_id, action_date)
+            if key in user_dates:
+                rows_by_indicator.setdefault(indicator_id, []).append( (key, answer_num) )
+
+        totals = {}
+        for indicator_id, rows in rows_by_indicator.items():
+            pcts = indicators[indicator_id].as_percentages([answer_num for _, answer_num in rows])
+            for (key, _), pct in zip(rows, pcts):
+                total, count = totals.get(key, (0, 0))
+                totals[key] = (total + pct, count + 1)
+
+        results = {}
+        for key, (total, count) in totals.items():
+            result = total / count
+            if result != 0:
+                results[key] = result
+
+        Answer.objects.save_values(overall_indicator, results)
+        return results
+
+    def load_options(self, indicators):
+        """Loads the options of all the likert indicators in one query, so that 
+        their options() and as_percentage don't query each time.
+        @param indicators Indicator subclass instances. Updated in place.
+        """
+        likert_indicators = [ind for ind in indicators 
+                             if isinstance(ind, IndicatorLikert) and ind.option_list is None]
+        if not likert_indicators:
+            return
 
-        for answer in answers:
-            
-            indicator = answer.indicator.subclass()
-            if indicator.can_average():
-                pct = indicator.as_percentage( answer.answer_num )
-                overall_avg += pct
-                count += 1
+        options_by_indicator = {}
+        for option in Option.objects.\
+                filter(indicator__in = [ind.id for ind in likert_indicators]).\
+                order_by('position'):
+            options_by_indicator.setdefault(option.indicator_id, []).append(option)
+
+        for ind in likert_indicators:
+            ind.option_list = options_by_indicator.get(ind.id, [])
+            ind.num_choices = len(ind.option_list)
+
+    def update_overall_averages(self, campaign, action_date, group_avg_user_ids):
+        """Updates the overall indicator for the average user, which is the average of 
+        all users over all indicators on action_date, and for the given groups.
+        Run after the indicator averages for that day are up to date.
+        @param group_avg_user_ids avg_user_id of the groups whose overall average has changed
+        """
+        user_dates = [(avg_user_id, action_date) for avg_user_id in group_avg_user_ids 
+                      if avg_user_id]
+        user_dates.append( (self.average_user().id, action_date) )
+        self.calculate_day_averages(campaign, user_dates)
+
+    def update_user_averages(self, campaign, user, action_date):
+        """Updates user's overall average for action_date, and how that compares
+        to the average user. Run after the indicator averages are up to date."""
+        averages = self.calculate_day_averages(campaign, [(user.id, action_date)])
+        CampaignMembership.objects.save_scores(
+                campaign, self.compared_to_average_scores(campaign, averages))
+
+    def compared_to_average_all(self, campaign, user, action_date, tolerance=5):
+        """Indicator.compared_to_average for all the regular indicators of campaign,
+        with one query for the answers of user and the average user.
+        @return Map of indicator id to (toleranced_value, value), same as compared_to_average.
+        Indicators that user or the average user didn't answer on action_date are left out.
+        """
+        indicators = dict( [(ind.id, ind) for ind in self.all_regular_indicators(campaign)] )
+        avg_user = self.average_user()
 
-        try:
-            result = overall_avg / count
-        except ZeroDivisionError:
-            result = 0
-        
-        if result != 0:
-            (result_obj, _) = Answer.objects.get_or_create(
-                                           user = user,
-                                           indicator_content_type = overall_indicator.content_type,
-                                           indicator_id = overall_indicator.id,
-                                           action_date = action_date)
-            result_obj.answer_num = result
-            result_obj.save()
+        nums = {}
+        for user_id, indicator_id, answer_num in Answer.objects.filter(
+                user__in = [user.id, avg_user.id], 
+                action_date = action_date, 
+                indicator_id__in = indicators.keys(),
+                is_skip = False).values_list('user', 'indicator_id', 'answer_num'):
+            nums[(user_id, indicator_id)] = answer_num
+
+        ratings = {}
+        for indicator_id, indicator in indicators.items():
+            user_num = nums.get( (user.id, indicator_id) )
+            avg_num = nums.get( (avg_user.id, indicator_id) )
+            if user_num is None or avg_num is None:
+                continue
+            ratings[indicator_id] = indicator.rating(user_num, avg_num, tolerance)
+        return ratings
+
+    def compared_to_average_scores(self, campaign, user_averages):
+        """compared_to_average on the overall indicator for many users at once, 
+        on each users latest day. One query, for the average users answers.
+        @param user_averages Map of (user id, action_date) to the users overall average,
+        as returned by calculate_day_averages
+        @return Map of user id to the difference with the average user, the second value 
+        of Indicator.compared_to_average. Users whose day has no average are left out.
+        """
+        latest = {}
+        for user_id, action_date in user_averages:
+            if action_date > latest.get(user_id, datetime.date.min):
+                latest[user_id] = action_date
+        if not latest:
+            return {}
+
+        overall = self.overall_indicator(campaign)
+        norms = dict( Answer.objects.filter(
+                user = self.average_user(),
+                indicator_id = overall.id,
+                action_date__in = list( set(latest.values()) )).\
+                values_list('action_date', 'answer_num') )
+
+        scores = {}
+        for user_id, action_date in latest.items():
+            norm = norms.get(action_date)
+            if norm is None:
+                continue
+            _, scores[user_id] = overall.rating(user_averages[(user_id, action_date)], norm)
+        return scores
 
     '''
     def norm(self):
@@ -221,6 +381,11 @@ class Indicator(models.Model):
     is_synthetic = models.BooleanField(default=False)
     
     description = models.TextField()
+
+    # Which subclass this is, so that subclass() knows which table to look in.
+    # Key of INDICATOR_TYPES. Set by save. 
+    # Existing databases get the column and old rows' types from: ge_set_indicator_types
+    indicator_type = models.CharField(max_length=50, blank=True, default='', editable=False)
     
     created = models.DateTimeField(default=datetime.datetime.now())
 
@@ -234,6 +399,12 @@ class Indicator(models.Model):
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        'Records which subclass this is'
+        if self._meta.module_name in INDICATOR_TYPES:
+            self.indicator_type = self._meta.module_name
+        super(Indicator, self).save(*args, **kwargs)
+
     def get_manager_url(self):
         """URL of this indicator in the admin manager"""
         raise NotImplementedError()
@@ -272,6 +443,17 @@ class Indicator(models.Model):
         @raise ValueError if this indicator cannot be expressed as a percentage"""
         raise NotImplementedError()
 
+    def as_percentages(self, nums):
+        """as_percentage of each of a list of numerical values from Answers.
+        @return List of percentages, same order as nums
+        """
+        return [self.as_percentage(num) for num in nums]
+
+    def is_valid_answer(self, num):
+        """Is num an allowed value for an Answer to this indicator? 
+        Same check as this indicators form, see indicator.forms"""
+        raise NotImplementedError()
+
     def answer_value(self, answer):
         "The value of this answer for display"
         raise NotImplementedError()
@@ -293,61 +475,72 @@ class Indicator(models.Model):
                 action_date=action_date, 
                 is_skip=False, 
                 indicator_id=self.id)
-        user_val = self.as_percentage(user_ans.answer_num)
 
         #avg_moving_avg = self.moving_average(days_back=days_back)
         avg_user = Indicator.objects.average_user()
         avg_ans = Answer.objects.get(user=avg_user, action_date=action_date, indicator_id=self.id)
-        norm = self.as_percentage(avg_ans.answer_num)
 
-        diff = user_val - norm
+        return self.rating(user_ans.answer_num, avg_ans.answer_num, tolerance)
+
+    def rating(self, user_num, avg_num, tolerance=5):
+        """Compares a users answer to the average users answer, see compared_to_average"""
+        diff = self.as_percentage(user_num) - self.as_percentage(avg_num)
         toleranced = diff
         if -tolerance <= diff <= tolerance:
             toleranced = 0
 
         return (toleranced, diff)
 
-    def average(self, average_date, group=None):
-        """Calculates the average for this indicator on the given day across all users.
+    def average(self, average_date):
+        """Calculates the average for this indicator on the given day across all users,
+        and across the users of each group.
         Saves to the database.
-        Stores the result as an Answer for average_user.
-        @param group Calculate average for users of that group.
+        Stores the results as Answers for average_user and for each groups avg_user.
+        @return Map of avg_user id to the average saved for them.
         """
-        if group:
-            average_user = group.avg_user
-        else:
-            average_user = Indicator.objects.average_user()
-        
-        average = 0
-        count = 0
-        
-        answers = Answer.objects\
-                .filter(indicator_id = self.id, 
-                    action_date = average_date,
-                    is_skip=False)\
-                .exclude(user__is_system_user = True)\
-                .select_related(depth=1)
-        if group:
-            answers = [ans for ans in answers if group in ans.user.groups.all()]
+        averages = Answer.objects.daily_averages(self, average_date)
+        return self._save_averages(average_date, averages)
 
-        for answer in answers:
-            if answer.user.is_system_user:  # Don't include 'Average', 'admin', etc  
-                continue
-            
-            if answer.answer_num:
-                average += answer.answer_num
-                count += 1
-        
-        if count != 0:
-        
-            (average_obj, _) = Answer.objects.get_or_create(
-                                                     indicator_content_type=self.content_type,
-                                                     indicator_id = self.id,
-                                                     user = average_user,
-                                                     action_date = average_date)
-            
-            average_obj.answer_num = float(average) / float(count)
-            average_obj.save()
+    def average_from_totals(self, average_date):
+        """Like average, but uses the running totals in AverageAccumulator instead
+        of reading every Answer. AnswerManager.create_update keeps those totals current.
+        @return Map of avg_user id to the average saved for them.
+        """
+        averages = AverageAccumulator.objects.averages(self, average_date)
+        return self._save_averages(average_date, averages)
+
+    def _save_averages(self, average_date, averages):
+        """Stores averages as Answers of the matching average users.
+        @param averages Map of group id to average. The everyone average has key None.
+        @return Map of avg_user id to the average saved for them.
+        """
+        if not averages:
+            return {}
+
+        avg_user_ids = {}
+        if None in averages:
+            avg_user_ids[None] = Indicator.objects.average_user().id
+
+        group_ids = [group_id for group_id in averages if group_id is not None]
+        if group_ids:
+            group_qs = Group.objects.filter(id__in = group_ids, avg_user__isnull = False)
+            avg_user_ids.update( group_qs.values_list('id', 'avg_user') )
+
+        results = {}
+        for group_id, avg_user_id in avg_user_ids.items():
+            results[avg_user_id] = averages[group_id]
+
+        Answer.objects.save_averages(self, average_date, results)
+        return results
+
+    def update_averages(self, action_date, groups):
+        """Updates the averages for this indicator on action_date, and the overall
+        averages of the average user and of the given groups.
+        @param groups Groups whose overall average has changed
+        """
+        self.average_from_totals(action_date)
+        Indicator.objects.update_overall_averages(self.campaign, action_date, 
+                [group.avg_user_id for group in groups])
 
     def moving_average(self, user=None, days_back=None):
         """Average of everyones answers to this indicator over days_back.
@@ -411,13 +604,22 @@ class Indicator(models.Model):
     @property
     def content_type(self):
         'The ContentType for this class'
-        return ContentType.objects.get_for_model(self)
+        return content_type_for(self.__class__)
 
     def subclass(self):
-        'The more specific type of indicator'
+        'The more specific type of indicator. At most one query.'
          
         if hasattr(self, 'indicator_ptr'):  # Already the subclass
             return self 
+
+        if self.indicator_type in INDICATOR_TYPES:
+            return INDICATOR_TYPES[self.indicator_type].objects.get(pk = self.id)
+
+        # Saved before we had indicator_type. ge_set_indicator_types fixes those.
+        return self._probe_subclass()
+
+    def _probe_subclass(self):
+        'Finds the subclass by trying each subclass relation in turn. Slow.'
          
         for rel_obj in self._meta.get_all_related_objects():
             # In Django subclasses are linked to their parent via a OneToOneField
@@ -472,20 +674,16 @@ class Indicator(models.Model):
         indicator_view = {}
         indicator_view['indicator_id'] = self.id
         
-        from_data, to_data, from_avgs, to_avgs = self.answers_with_average(from_user, to_user)
+        (from_data, to_data, from_avgs, to_avgs, from_average, to_average) = \
+                self._graph_data(userize(from_user), userize(to_user))
 
         indicator_view['from_data'] = from_data
         indicator_view['to_data'] = to_data
         indicator_view['from_avg_data'] = from_avgs
         indicator_view['to_avg_data'] = to_avgs
         
-        try:
-            indicator_view['from_average'] = self.moving_average(from_user)
-            indicator_view['to_average'] = self.moving_average(to_user)
-        except ValueError:
-            # Indicator doesn't support a baseline
-            indicator_view['from_average'] = 0
-            indicator_view['to_average'] = 0
+        indicator_view['from_average'] = from_average
+        indicator_view['to_average'] = to_average
 
         indicator_view['value_ticks'] = self.graph_ticks()
         indicator_view['hover_labels'] = self.graph_labels()
@@ -531,54 +729,89 @@ class Indicator(models.Model):
         - to_avgs: Time average of to User or Group's answers.
         """
 
-        def userize(user_or_group):
-            """Takes a Profile or Group and returns a Profile.
-            If given a Group, returns the system user that owns that groups averages"""
+        from_user = userize(from_user_or_group)
+        to_user = userize(to_user_or_group)
 
-            if isinstance(user_or_group, Profile):
-                return user_or_group
+        return self._graph_data(from_user, to_user)[:4]
 
-            elif isinstance(user_or_group, Group):
-                return user_or_group.avg_user
+    def _graph_data(self, from_user, to_user):
+        """Graph series, and overall averages, of two users answers to this indicator.
+        Cached until either users answers change, see indicator.series.
+        @return Tuple of six values: 
+        from_data, to_data, from_avgs, to_avgs as in answers_with_average, then
+        from_average, to_average: Average of all the users answers, 0 if this
+        indicator can't be averaged.
+        """
+        from_version, from_rows = series.user_rows(self, from_user)
+        to_version, to_rows = series.user_rows(self, to_user)
+        versions = (from_version, to_version)
 
-            else:
-                return None
+        cache_key = series.graph_cache_key(self, from_user, to_user)
+        cached = cache.get(cache_key)
+        if cached and cached[0] == versions:
+            return cached[1]
 
-        from_user = userize(from_user_or_group)
-        to_user = userize(to_user_or_group)
+        if series.numpy:
+            graph_data = series.graph_series(from_rows, to_rows)
+        else:
+            graph_data = self._graph_series(from_rows, to_rows)
+
+        me_data, average_data, me_avgs, average_avgs, missing_ids = graph_data
+
+        for answer_id in missing_ids:
+            if answer_id:
+                messaging.send(messaging.SUBJECT_AVG, answer_id)
+
+        if self.can_average():
+            from_average = series.mean(from_rows)
+            to_average = series.mean(to_rows)
+        else:
+            # Indicator doesn't support a baseline
+            from_average = to_average = 0
+
+        result = (me_data, average_data, me_avgs, average_avgs, from_average, to_average)
+        cache.set(cache_key, (versions, result))
+        return result
+
+    def _graph_series(self, my_answers_iter, average_answers_iter):
+        """Pure python version of series.graph_series, for when NumPy isn't installed.
+        @param my_answers_iter From user's Answers (or AnswerRows), ordered by action_date
+        @param average_answers_iter To user's Answers (or AnswerRows), ordered by action_date
+        @return Tuple of (from_data, to_data, from_avgs, to_avgs, missing_ids).
+        See series.graph_series.
+        """
 
-        my_answers_iter = Answer.objects.by_indicator(from_user, self)
         my_answers = answer_map_by_date(my_answers_iter)
-                
-        average_answers_iter = Answer.objects.by_indicator(to_user, self)
         average_answers = answer_map_by_date(average_answers_iter) 
 
         my_avgs = self._aggregate_averages(my_answers_iter)
         average_avgs = self._aggregate_averages(average_answers_iter)
 
+        my_answer_ids = {}
+        for answer in my_answers_iter:
+            my_answer_ids[answer.action_date] = answer.id
+
+        missing_ids = []
         for action_date in my_answers.keys():
             # This can happen if the back-end worker fell over or is slow
             if not action_date in average_answers:
-                my_ans = Answer.objects.get(
-                        action_date=action_date, 
-                        user=from_user, 
-                        indicator_id=self.id)
-                messaging.send(messaging.SUBJECT_AVG, my_ans.id)
+                missing_ids.append(my_answer_ids[action_date])
                 # No value for avg yet, so pretend avg has same value as user
-                average_answers[action_date] = my_ans.num_value
-                average_avgs[action_date] = my_ans.num_value
+                average_answers[action_date] = my_answers[action_date]
+                average_avgs[action_date] = my_answers[action_date]
 
         answers = []
         for action_date, average_value in average_answers.items():
             me_value = my_answers[action_date] if action_date in my_answers else None
             my_avg = my_avgs[action_date] if action_date in my_avgs else None 
+            average_avg = average_avgs[action_date] if action_date in average_avgs else None
                 
             answers.append(
                     (action_date, 
                     me_value, 
                     average_value, 
                     my_avg, 
-                    average_avgs[action_date]
+                    average_avg
                     )
                 )
          
@@ -597,7 +830,7 @@ class Indicator(models.Model):
             if average_avg or average_avg == 0:
                 average_avgs.append( [action_date, average_avg] )
 
-        return (me_data, average_data, me_avgs, average_avgs)
+        return (me_data, average_data, me_avgs, average_avgs, missing_ids)
 
 class IndicatorLikert(Indicator):
     """Five point likert-type scale - http://en.wikipedia.org/wiki/Likert_scale"""
@@ -627,12 +860,32 @@ class IndicatorLikert(Indicator):
         'Can an average be calculated for this indicator?'
         return True
 
+    # The options by position, and how many there are. Loaded on first use, or for 
+    # many indicators at once by IndicatorManager.load_options. The indicators from
+    # all_regular_indicators have them already, and are reloaded when options change.
+    option_list = None
+    num_choices = None
+
+    def options(self):
+        'The Options of this indicator, by position'
+        if self.option_list is None:
+            self.option_list = list( self.option_set.order_by('position') )
+            self.num_choices = len(self.option_list)
+        return self.option_list
+
     def as_percentage(self, num):
         "Takes the numerical value from an Answer, and returns it as a percentage"
-        if not num:
-            return 0
-        num_choices = self.option_set.count() 
-        return math.ceil( (num-1) * (100.0 / (num_choices-1)) )
+        self.options()
+        return likert_percentage(num, self.num_choices)
+
+    def as_percentages(self, nums):
+        'See Indicator.as_percentages'
+        self.options()
+        return likert_percentages(nums, self.num_choices)
+
+    def is_valid_answer(self, num):
+        'See Indicator.is_valid_answer'
+        return unicode(num) in [choice for (choice, _) in IndicatorLikert.LIKERT_CHOICES]
 
     def display_type(self):
         'The type of this indicator, to select which HTML block to show'
@@ -657,12 +910,12 @@ class IndicatorLikert(Indicator):
     def graph_ticks(self):
         'Y values for the graph of this indicator'
         #return [int(x) for (x, _) in IndicatorLikert.LIKERT_CHOICES]
-        return [option.position for option in self.option_set.order_by('position')]
+        return [option.position for option in self.options()]
 
     def graph_labels(self):
         'Y-axis labels for the graph of this indicator'
         #return [y for (_, y) in IndicatorLikert.LIKERT_CHOICES]
-        return [option.value for option in self.option_set.order_by('position')]
+        return [option.value for option in self.options()]
 
     def graph_has_numeric_legend(self):
         """See super-class"""
@@ -710,6 +963,14 @@ class IndicatorNumber(Indicator):
         
         return min( num * (100 / top_value), 100 )  # Don't exceed 100%! 
 
+    def is_valid_answer(self, num):
+        'See Indicator.is_valid_answer'
+        if self.number_range_start is not None and num < self.number_range_start:
+            return False
+        if self.number_range_end is not None and num > self.number_range_end:
+            return False
+        return True
+
     def display_type(self):
         'The type of this indicator, to select which HTML block to show'
         return 'number'
@@ -768,6 +1029,19 @@ class IndicatorNumber(Indicator):
             return self.graph_ticks()
 
 
+def position_bit(indicator):
+    """The bit for indicator in a DailyProgress bitmap. 
+    Indicators share a bit if their positions are equal modulo MAX_POSITIONS, 
+    in which case DailyProgressManager.answered_ids reads the Answers instead."""
+    return 1 << ((indicator.position or 0) % DailyProgress.MAX_POSITIONS)
+
+
+# The concrete Indicator types, by the value of Indicator.indicator_type.
+# Add new Indicator subclasses here.
+INDICATOR_TYPES = dict( [(model._meta.module_name, model) 
+                         for model in (IndicatorLikert, IndicatorNumber)] )
+
+
 class Option(models.Model):
     """One of the choices for an Indicator"""
 
@@ -786,52 +1060,163 @@ class AnswerManager(models.Manager):
     """Methods above the level of a single Answer"""
 
     def create_update(self, user, indicator, action_date, value, is_skip, answer=None): 
-        'Creates and returns a new Answer with the given parameters, or updates the given one'
-        
-        is_new_answer = False
+        """Creates and returns a new Answer with the given parameters, or updates the 
+        existing one. 
+        @param answer Ignored, the existing answer is found by user, indicator and action_date
+        """
+        answer_num = None if is_skip else int( value )
+        return self.save_day(user, indicator.campaign, action_date, 
+                [(indicator, answer_num, is_skip)])[0]
+
+    def save_day(self, user, campaign, action_date, answer_values):
+        """Creates or updates several of a users Answers for a day, in one transaction,
+        then queues one average job for all of them.
+        @param answer_values List of (indicator, answer_num, is_skip). 
+        answer_num is ignored for skips.
+        @return List of the Answers, in the same order
+        """
+        answers = []
+        new_indicators = []
+        deltas = []
+
+        with transaction.commit_on_success():
+            for indicator, answer_num, is_skip in answer_values:
+                if is_skip:
+                    answer_num = None
+
+                answer, is_new_answer, previous_num = self.upsert(
+                        user, indicator, action_date, answer_num, is_skip, add_points=False)
+                answers.append(answer)
+                deltas.append( (indicator, previous_num, answer_num) )
+                if is_new_answer:
+                    new_indicators.append(indicator)
+
+            if new_indicators:
+                user.add_participation_points( len(new_indicators) )
+
+        if new_indicators and not user.is_system_user:
+            CampaignStats.objects.add(campaign, user, num_answers = len(new_indicators))
+        if not user.is_system_user:
+            CampaignMembership.objects.touch(campaign, user)
+
+        if not user.is_system_user:
+            group_ids = list( user.groups.values_list('id', flat=True) )
+            for indicator, previous_num, answer_num in deltas:
+                AverageAccumulator.objects.apply_delta(
+                        indicator, action_date, user, previous_num, answer_num, 
+                        group_ids = group_ids)
 
-        if not answer:
-            try:
-                answer = self.get(
-                              user = user, 
-                              indicator_id = indicator.id,
-                              indicator_content_type = ContentType.objects.get_for_model(indicator),
-                              action_date = action_date
-                              )
-                
-            except Answer.DoesNotExist:
-                answer = Answer(user = user, 
-                                action_date = action_date,
-                                is_skip = is_skip)
-                answer.indicator = indicator
-                is_new_answer = True
-        
-        if is_skip:
-            answer.answer_num = None
-        else:
-            answer.answer_num = int( value )
-        
-        answer.is_skip = is_skip
-        answer.save()
-        
-        if is_new_answer:
-            user.add_participation_points()
-        
-        try:
-            Indicator.objects.next(user, indicator.campaign)
-            is_last_indicator = False
-        except Indicator.DoesNotExist:
-            is_last_indicator = True
+        for answer in answers:
+            series.answer_changed(answer.indicator_id, user.id)
 
-        if not is_skip:
+        if answer_values:
+            # All of them, not just the new ones, so a bit lost to a race is set again
+            # when the user re-answers
+            DailyProgress.objects.mark_answered(user, campaign, action_date, 
+                    [indicator for indicator, _, _ in answer_values])
+        is_last_indicator = Indicator.objects.is_done(user, campaign, action_date)
+
+        answer_ids = ','.join([str(answer.id) for answer in answers if not answer.is_skip])
+        if answer_ids:
             if is_last_indicator:
-                # Worker won't have time before results screen comes up
-                answer.update_averages()
+                # Results screen comes up next. It waits (briefly) for the worker.
+                ready.mark_pending(user)
+                messaging.send(messaging.SUBJECT_AVG_URGENT, answer_ids)
             else:
                 # Usual case, do out-of-band for performance
-                messaging.send(messaging.SUBJECT_AVG, answer.id)
+                messaging.send(messaging.SUBJECT_AVG, answer_ids)
 
-        return answer
+        return answers
+
+    def upsert(self, user, indicator, action_date, answer_num, is_skip, add_points=True):
+        """Updates the users answer to indicator on action_date, or inserts it if they 
+        haven't answered yet. A user answering twice at once gets one row, see
+        Answer.Meta.unique_together. 
+        Doesn't update averages, see save_day for that.
+        @param add_points Add a participation point if the answer is new
+        @return Tuple of (Answer, True if it is new, the previous answer_num or None
+        if it was new or skipped)
+        """
+        content_type_id = indicator.content_type.id
+        key_params = [user.id, indicator.id, action_date]
+        cursor = connection.cursor()
+
+        existing = self._update_answer(cursor, answer_num, is_skip, key_params)
+        if existing:
+            answer_id, previous_num, was_skip = existing
+            is_new = False
+        else:
+            sid = transaction.savepoint()
+            try:
+                answer_id = self._insert_answer(cursor, 
+                        [content_type_id] + key_params + [answer_num, is_skip])
+                transaction.savepoint_commit(sid)
+                is_new = True
+                previous_num = was_skip = None
+            except IntegrityError:
+                # They answered in another request since our update
+                transaction.savepoint_rollback(sid)
+                answer_id, previous_num, was_skip = \
+                        self._update_answer(cursor, answer_num, is_skip, key_params)
+                is_new = False
+
+        if is_new and add_points:
+            user.add_participation_points()
+
+        transaction.commit_unless_managed()
+
+        answer = Answer(
+                id = answer_id,
+                indicator_content_type_id = content_type_id,
+                indicator_id = indicator.id,
+                user = user,
+                action_date = action_date,
+                answer_num = answer_num,
+                is_skip = is_skip)
+        setattr(answer, Answer.indicator.cache_attr, indicator)
+        return answer, is_new, (None if was_skip else previous_num)
+
+    def _update_answer(self, cursor, answer_num, is_skip, key_params):
+        """Sets the value of an existing answer.
+        @param key_params [user id, indicator id, action_date]
+        @return Tuple of (id, previous answer_num, previous is_skip), or None if 
+        there's no answer.
+        """
+        if 'postgresql' in connection.settings_dict['ENGINE']:
+            # The join to the old row returns its values from before the update
+            sql = "update indicator_answer a set answer_num = %s, is_skip = %s "+\
+                    "from indicator_answer old where old.id = a.id "+\
+                    "and a.user_id = %s and a.indicator_id = %s and a.action_date = %s "+\
+                    "returning a.id, old.answer_num, old.is_skip;"
+            cursor.execute(sql, [answer_num, is_skip] + key_params)
+            return cursor.fetchone()
+
+        lock = " for update" if 'mysql' in connection.settings_dict['ENGINE'] else ""
+        cursor.execute("select id, answer_num, is_skip from indicator_answer "+\
+                "where user_id = %s and indicator_id = %s and action_date = %s"+ lock +";",
+                key_params)
+        existing = cursor.fetchone()
+        if existing:
+            cursor.execute("update indicator_answer set answer_num = %s, is_skip = %s "+\
+                    "where id = %s;", [answer_num, is_skip, existing[0]])
+        return existing
+
+    def _insert_answer(self, cursor, params):
+        """Inserts an answer.
+        @param params [content type id, user id, indicator id, action_date, answer_num, is_skip]
+        @return The new answers id
+        """
+        sql = "insert into indicator_answer "+\
+                "(indicator_content_type_id, user_id, indicator_id, action_date, "+\
+                "answer_num, is_skip, created) values (%s, %s, %s, %s, %s, %s, %s)"
+        params = params + [datetime.datetime.now()]
+
+        if 'postgresql' in connection.settings_dict['ENGINE']:
+            cursor.execute(sql + " returning id;", params)
+            return cursor.fetchone()[0]
+
+        cursor.execute(sql + ";", params)
+        return connection.ops.last_insert_id(cursor, 'indicator_answer', 'id')
 
     '''
     def by_day(self, user, indicator_ids, day = None):
@@ -859,6 +1244,147 @@ class AnswerManager(models.Manager):
         answer_qs = answer_qs.order_by('action_date')        
         return answer_qs
 
+    def daily_averages(self, indicator, action_date):
+        """Average of the real users answers to indicator on action_date, for everyone
+        and for each group, in a single query.
+        @return Map of group id to average. The everyone average has key None.
+        Groups with no answers are not included.
+        """
+        result = {}
+        for group_id, (total, count) in self.daily_totals(indicator, action_date).items():
+            result[group_id] = total / count
+        return result
+
+    def daily_totals(self, indicator, action_date):
+        """Sum and count of the real users answers to indicator on action_date, for everyone
+        and for each group, in a single query.
+        @return Map of group id to tuple (sum, count). Everyone has key None.
+        Groups with no answers are not included.
+        """
+
+        where = "where a.indicator_id = %s and a.action_date = %s and a.is_skip = %s "+\
+                "and p.is_system_user = %s and a.answer_num <> 0 "
+
+        sql = "select null, sum(a.answer_num), count(a.answer_num) "+\
+                "from indicator_answer a "+\
+                "inner join profile_profile p on p.id = a.user_id "+\
+                where +\
+                "union all "+\
+                "select pg.group_id, sum(a.answer_num), count(a.answer_num) "+\
+                "from indicator_answer a "+\
+                "inner join profile_profile p on p.id = a.user_id "+\
+                "inner join profile_profile_groups pg on pg.profile_id = a.user_id "+\
+                where +\
+                "group by pg.group_id;"
+
+        params = [indicator.id, action_date, False, False]
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params + params)
+
+        result = {}
+        for group_id, total, count in cursor.fetchall():
+            if count:
+                result[group_id] = (float(total), count)
+        return result
+
+    def prefetch_indicators(self, answers):
+        """Loads the indicators of all the answers, so that answer.indicator 
+        doesn't query for each one. One query per type of indicator.
+        @param answers List or QuerySet of Answer
+        @return List of the answers
+        """
+        answers = list(answers)
+
+        ids_by_type = {}
+        for answer in answers:
+            if answer.indicator_content_type_id and answer.indicator_id:
+                ids_by_type.setdefault(
+                        answer.indicator_content_type_id, set()).add(answer.indicator_id)
+
+        indicators = {}
+        for content_type_id, id_set in ids_by_type.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            for indicator_id, indicator in model.objects.in_bulk( list(id_set) ).items():
+                indicators[(content_type_id, indicator_id)] = indicator
+
+        cache_attr = Answer.indicator.cache_attr
+        for answer in answers:
+            key = (answer.indicator_content_type_id, answer.indicator_id)
+            if key in indicators:
+                setattr(answer, cache_attr, indicators[key])
+
+        return answers
+
+    def save_averages(self, indicator, action_date, averages):
+        """Creates or updates the Answers of several average users in one write each.
+        @param averages Map of avg_user id to the average value to store for them.
+        """
+        self.save_values(indicator, 
+                dict( [((user_id, action_date), value) for user_id, value in averages.items()] ))
+
+    def save_values(self, indicator, values):
+        """Creates or updates many Answers to indicator, with one update and one insert.
+        @param values Map of (user id, action_date) to the answer_num to store.
+        """
+        if not values:
+            return
+
+        user_ids = set([user_id for user_id, _ in values])
+        action_dates = set([action_date for _, action_date in values])
+        existing = [row for row in self.filter(
+                        indicator_id = indicator.id,
+                        action_date__in = list(action_dates),
+                        user__id__in = list(user_ids)).values_list('id', 'user', 'action_date')
+                    if (row[1], row[2]) in values]
+
+        cursor = connection.cursor()
+
+        update_ids = []
+        update_params = []
+        seen_keys = set()
+        for answer_id, user_id, action_date in existing:
+            update_ids.append(answer_id)
+            update_params.extend([answer_id, values[(user_id, action_date)]])
+            seen_keys.add( (user_id, action_date) )
+
+        if update_ids:
+            sql = "update indicator_answer set answer_num = case id "+\
+                    "when %s then %s " * len(update_ids) +\
+                    "end where id in (" + ", ".join(["%s"] * len(update_ids)) + ");"
+            cursor.execute(sql, update_params + update_ids)
+
+        new_keys = [key for key in values if key not in seen_keys]
+        if new_keys:
+            content_type_id = indicator.content_type.id
+            now = datetime.datetime.now()
+
+            insert_params = []
+            for user_id, action_date in new_keys:
+                insert_params.extend([
+                    content_type_id, indicator.id, user_id, action_date,
+                    values[(user_id, action_date)], False, now])
+
+            sql = "insert into indicator_answer "+\
+                    "(indicator_content_type_id, indicator_id, user_id, action_date, "+\
+                    "answer_num, is_skip, created) values "+\
+                    ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(new_keys)) + ";"
+
+            sid = transaction.savepoint()
+            try:
+                cursor.execute(sql, insert_params)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Another process inserted some of them since our select. 
+                # Go again for those, which finds and updates them.
+                transaction.savepoint_rollback(sid)
+                self.save_values(indicator, dict( [(key, values[key]) for key in new_keys] ))
+
+        transaction.commit_unless_managed()
+
+        for user_id in user_ids:
+            series.answer_changed(indicator.id, user_id)
+
 
 class Answer(models.Model):
     "Response to an indicator"
@@ -882,9 +1408,11 @@ class Answer(models.Model):
 
     option = models.ForeignKey(Option, null=True, blank=True)
 
-    #class Meta:
-    #    """Django config"""
-    #    unique_together = ('user', 'indicator_content_type', 'indicator_id', 'action_date')
+    class Meta:
+        """Django config"""
+        # Indicator ids are unique across the Indicator subclasses, so content type isn't needed. 
+        # Also serves the per user lookups. ge_answer_schema adds it to existing databases.
+        unique_together = ('user', 'indicator_id', 'action_date')
 
     def __unicode__(self):
         #return unicode(self.user) +' for '+ unicode(self.indicator.id) +' on '+ unicode(self.action_date) +' = '+ unicode(self.value)
@@ -915,18 +1443,285 @@ class Answer(models.Model):
         indicator = self.indicator
         action_date = self.action_date
 
-        indicator.average(action_date)
+        indicator.update_averages(action_date, geuser.groups.all())
+        Indicator.objects.update_user_averages(indicator.campaign, geuser, action_date)
 
-        for group in geuser.groups.all():
-            indicator.average(action_date, group=group)
-            Indicator.objects.calculate_day_average(indicator.campaign, group.avg_user, action_date)
 
-        Indicator.objects.calculate_day_average(indicator.campaign, geuser, action_date)
+class AverageAccumulatorManager(models.Manager):
+    """Methods above the level of a single AverageAccumulator"""
 
-        # Update overall indicator for Avg user which is
-        # the average of all users over all indicators on specific day
-        avg_user = Indicator.objects.average_user()
-        Indicator.objects.calculate_day_average(indicator.campaign, avg_user, action_date)
+    def apply_delta(self, indicator, action_date, user, old_num, new_num, group_ids=None):
+        """Moves the running totals for everyone and for each of user's groups
+        from including old_num to including new_num.
+        Call after the Answer is saved: a scope with no totals yet for the day 
+        (first answer, or a day from before the totals existed) is 
+        started from all the saved Answers, which includes this one.
+        Pass None (or 0, which isn't averaged) for a skipped or new answer.
+        @param group_ids Ids of user's groups, if the caller already has them
+        """
+        old_num = old_num or 0
+        new_num = new_num or 0
+        if old_num == new_num:
+            return
+
+        total_delta = float(new_num - old_num)
+        count_delta = (1 if new_num else 0) - (1 if old_num else 0)
+
+        if group_ids is None:
+            group_ids = list( user.groups.values_list('id', flat=True) )
+        scopes = [EVERYONE_SCOPE] + list(group_ids)
+        scope_qs = self.filter(
+                indicator = indicator.id, action_date = action_date, scope__in = scopes)
+
+        num_updated = scope_qs.update(
+                total = F('total') + total_delta,
+                count = F('count') + count_delta)
+
+        if num_updated < len(scopes):
+            existing = set( scope_qs.values_list('scope', flat=True) )
+            correct = Answer.objects.daily_totals(indicator, action_date)
+
+            for scope in scopes:
+                if scope in existing:
+                    continue
+                group_id = scope or None
+                total, count = correct.get(group_id, (0, 0))
+
+                sid = transaction.savepoint()
+                try:
+                    self.create(
+                            indicator_id = indicator.id,
+                            action_date = action_date,
+                            group_id = group_id,
+                            scope = scope,
+                            total = total,
+                            count = count)
+                    transaction.savepoint_commit(sid)
+                except IntegrityError:
+                    # Another process started it since our update, from totals that 
+                    # may or may not include our answer. Adding our delta could count 
+                    # it twice, so set it from the answers again instead.
+                    transaction.savepoint_rollback(sid)
+                    total, count = Answer.objects.daily_totals(indicator, action_date).\
+                            get(group_id, (0, 0))
+                    self.filter(indicator = indicator.id, 
+                                action_date = action_date, 
+                                scope = scope).update(total = total, count = count)
+
+            transaction.commit_unless_managed()
+
+    def averages(self, indicator, action_date):
+        """Average of indicator on action_date from the running totals.
+        @return Map of group id to average. The everyone average has key None.
+        """
+        result = {}
+        for group_id, total, count in self.filter(
+                indicator = indicator.id, 
+                action_date = action_date).values_list('group', 'total', 'count'):
+
+            if count > 0:
+                result[group_id] = total / count
+        return result
+
+    def rebuild(self, indicator, action_date):
+        """Replaces the running totals for indicator on action_date 
+        with totals calculated from all the Answers.
+        @return List of (group id, old (sum, count), new (sum, count)) that didn't match
+        """
+        current = {}
+        for accumulator in self.filter(indicator = indicator.id, action_date = action_date):
+            current[accumulator.group_id] = (accumulator.total, accumulator.count)
+
+        correct = Answer.objects.daily_totals(indicator, action_date)
+
+        drift = []
+        for group_id in set(current.keys()) | set(correct.keys()):
+            old_totals = current.get(group_id, (0, 0))
+            new_totals = correct.get(group_id, (0, 0))
+            if abs(old_totals[0] - new_totals[0]) > 0.0001 or old_totals[1] != new_totals[1]:
+                drift.append( (group_id, old_totals, new_totals) )
+
+        if drift:
+            self.filter(indicator = indicator.id, action_date = action_date).delete()
+            for group_id, (total, count) in correct.items():
+                self.create(
+                        indicator_id = indicator.id,
+                        action_date = action_date,
+                        group_id = group_id,
+                        scope = group_id or EVERYONE_SCOPE,
+                        total = total,
+                        count = count)
+
+        return drift
+
+
+class AverageAccumulator(models.Model):
+    """Running sum and count of the real users answers to an indicator on a day,
+    for everyone (group is null) or for the users of one group.
+    Lets us update averages for a new answer without reading all the other answers.
+    """
+
+    objects = AverageAccumulatorManager()
+
+    indicator = models.ForeignKey(Indicator)
+    action_date = models.DateField()
+    group = models.ForeignKey(Group, null=True, blank=True)
+
+    # group id, or EVERYONE_SCOPE. Unlike group never NULL, so the unique key 
+    # stops a second everyone row too (NULLs are never equal in a unique index).
+    # Existing databases get the column from: ge_reconcile_averages --schema
+    scope = models.IntegerField(default=EVERYONE_SCOPE)
+
+    total = models.FloatField(default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        """Django config"""
+        unique_together = ('indicator', 'action_date', 'scope')
+
+    def __unicode__(self):
+        return u'%s on %s: %s / %s' % (self.indicator_id, self.action_date, self.total, self.count)
+
+
+class DailyProgressManager(models.Manager):
+    """Methods above the level of a single DailyProgress"""
+
+    def _cache_key(self, user, campaign, day):
+        'Memcached key of a users progress for the day'
+        return 'ge_progress_%d_%d_%s' % (campaign.id, user.id, day.isoformat())
+
+    def answered_ids(self, user, campaign, day, indicator_list):
+        """Ids of the indicators in indicator_list that user has answered on day. 
+        From the cached bitmap, then the DailyProgress row. Only reads the Answers if
+        there is no row yet, or if two of the indicators share a bit.
+        @param indicator_list The regular indicators of campaign
+        """
+        bits = [position_bit(ind) for ind in indicator_list]
+        if len(set(bits)) != len(bits):
+            return self._answered_ids_from_answers(user, day, indicator_list)
+
+        cache_key = self._cache_key(user, campaign, day)
+        answered = cache.get(cache_key)
+        if answered is None:
+            try:
+                answered = self.get(user = user, campaign = campaign, action_date = day).answered
+            except DailyProgress.DoesNotExist:
+                answered = self._from_answers(user, day, indicator_list)
+            # add, not set: if mark_answered has cached a newer bitmap since our read, keep it
+            cache.add(cache_key, answered, PROGRESS_CACHE_SECONDS)
+
+        return set([ind.id for ind in indicator_list if answered & position_bit(ind)])
+
+    def mark_answered(self, user, campaign, day, indicators):
+        """Sets the bits for indicators in the users progress for day, in one update.
+        Call after saving the users Answers to those indicators on day.
+        Caches the bitmap as saved, rather than deleting it, so that a concurrent 
+        answered_ids can't cache the value from before our update."""
+        bits = 0
+        for indicator in indicators:
+            bits |= position_bit(indicator)
+
+        cursor = connection.cursor()
+        sql = "update indicator_dailyprogress set answered = answered | %s "+\
+                "where user_id = %s and campaign_id = %s and action_date = %s;"
+        params = [bits, user.id, campaign.id, day]
+        cursor.execute(sql, params)
+
+        if not cursor.rowcount:
+            # First answer of the day. The answer is already saved, so it's included.
+            indicator_list = Indicator.objects.all_regular_indicators(campaign)
+            try:
+                self.create(
+                        user = user, 
+                        campaign = campaign, 
+                        action_date = day,
+                        answered = self._from_answers(user, day, indicator_list))
+            except IntegrityError:
+                # Someone else created it. They may have read the answers before ours
+                # was committed, so set our bits in their row.
+                transaction.rollback_unless_managed()
+                cursor = connection.cursor()
+                cursor.execute(sql, params)
+
+        transaction.commit_unless_managed()
+
+        answered = self.filter(user = user, campaign = campaign, action_date = day).\
+                values_list('answered', flat=True)
+        if answered:
+            cache.set(self._cache_key(user, campaign, day), answered[0], PROGRESS_CACHE_SECONDS)
+        else:
+            cache.delete( self._cache_key(user, campaign, day) )
+
+    def _answered_ids_from_answers(self, user, day, indicator_list):
+        'Ids of the indicators in indicator_list that user has an Answer to on day'
+        return set( Answer.objects.filter(
+                indicator_id__in = [ind.id for ind in indicator_list],
+                user = user, 
+                action_date = day).values_list('indicator_id', flat=True) )
+
+    def _from_answers(self, user, day, indicator_list):
+        'Progress bitmap calculated from the users Answers'
+        answered_ids = self._answered_ids_from_answers(user, day, indicator_list)
+        answered = 0
+        for ind in indicator_list:
+            if ind.id in answered_ids:
+                answered |= position_bit(ind)
+        return answered
+
+
+class DailyProgress(models.Model):
+    """Which of a campaigns indicators a user has answered on a day, as a bitmap.
+    Bit n is set when they have answered the indicator at position n (see position_bit),
+    so Indicator.objects.next doesn't have to read their Answers.
+    """
+
+    # Bits in a BigIntegerField, leaving the sign bit alone
+    MAX_POSITIONS = 63
+
+    objects = DailyProgressManager()
+
+    user = models.ForeignKey(Profile)
+    campaign = models.ForeignKey(Campaign)
+    action_date = models.DateField()
+    answered = models.BigIntegerField(default=0)
+
+    class Meta:
+        """Django config"""
+        unique_together = ('user', 'campaign', 'action_date')
+
+    def __unicode__(self):
+        return u'%s on %s: %s' % (self.user_id, self.action_date, bin(self.answered))
+
+
+class BackfillCheckpoint(models.Model):
+    """A chunk of days of a campaign whose averages ge_calc_mean has recalculated.
+    Lets a run that crashed carry on where it stopped. Deleted when a run finishes.
+    """
+
+    campaign = models.ForeignKey(Campaign)
+    start_date = models.DateField()
+    end_date = models.DateField()
+
+    num_rows = models.IntegerField(default=0, help_text='Averages saved')
+    finished = models.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        """Django config"""
+        unique_together = ('campaign', 'start_date', 'end_date')
+
+    def __unicode__(self):
+        return u'%s: %s to %s' % (self.campaign_id, self.start_date, self.end_date)
+
+
+def clear_catalog(sender, **kwargs):    # pylint: disable-msg=W0613
+    """An indicator or option changed, so the cached indicators 
+    (and the option data on them) of its campaign are out of date"""
+    instance = kwargs['instance']
+    if isinstance(instance, Option):
+        instance = instance.indicator
+    catalog.bump(instance.campaign_id)
 
-        geuser.update_compared_to_average(indicator.campaign, action_date)
 
+for model in (IndicatorLikert, IndicatorNumber, Option):
+    post_save.connect(clear_catalog, sender=model)
+    post_delete.connect(clear_catalog, sender=model)
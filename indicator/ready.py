@@ -0,0 +1,69 @@
+"""Results-ready tokens.
+
+When a user answers their last indicator of the day, the web request marks their
+results as pending and queues an urgent average job, instead of recomputing the
+averages itself. The worker clears the mark once that users averages are done.
+The results page waits a bounded time for that, then shows whatever averages
+are already stored.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import time
+
+from django.core.cache import cache
+
+# Long enough for a slow worker, short enough that a dead one doesn't
+# keep making the results page wait.
+PENDING_SECONDS = 60
+
+POLL_SECONDS = 0.1
+
+
+def _cache_key(user_id):
+    """Key of the pending mark for a user"""
+    return 'ge_results_pending_%d' % user_id
+
+
+def mark_pending(user):
+    """The users averages are being recalculated"""
+    cache.set(_cache_key(user.id), True, PENDING_SECONDS)
+
+
+def mark_ready(user_id):
+    """The users averages are up to date. Called by the worker."""
+    cache.delete(_cache_key(user_id))
+
+
+def is_ready(user):
+    """False if the users averages are still being recalculated"""
+    return not cache.get(_cache_key(user.id))
+
+
+def wait(user, timeout):
+    """Wait up to timeout seconds for the users averages to be recalculated.
+    @return True if they were, False if we gave up.
+    """
+    deadline = time.time() + timeout
+    while not is_ready(user):
+        if time.time() >= deadline:
+            return False
+        time.sleep(POLL_SECONDS)
+    return True
@@ -0,0 +1,196 @@
+"""Graph data for indicators.
+
+graph_series does the same as Indicator._graph_series, but with NumPy, on arrays 
+indexed by date instead of per-answer maps and lists.
+If NumPy is not installed, 'numpy' is None here and callers should use the
+pure python version.
+
+Each users answers to an indicator are cached as a list of AnswerRow (see user_rows),
+tagged with the version that was current when they were read from the database. 
+When an answer is saved, answer_changed gives the list a new version, under its own
+key. A cached list with an old version is read again, so a list read from the 
+database before a save, and cached after it, is never used. Graph data for a 
+(indicator, from user, to user) is cached with the versions of the two lists it 
+was built from, so it is used until either of them changes.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import random
+import datetime
+from collections import namedtuple
+
+from django.core.cache import cache
+
+try:
+    import numpy
+except ImportError:     # pylint: disable-msg=W0704
+    numpy = None
+
+# Just the Answer fields the graphs need. Has the same attribute names as Answer. 
+AnswerRow = namedtuple('AnswerRow', 'id action_date answer_num')
+
+
+def answer_rows(answer_qs):
+    """The (id, action_date, answer_num) of each answer in the queryset,
+    ordered by action_date. Doesn't build Answer objects."""
+    return [AnswerRow(*row) for row in 
+            answer_qs.order_by('action_date').values_list('id', 'action_date', 'answer_num')]
+
+
+def _rows_cache_key(indicator_id, user_id):
+    """Key under which to cache a users answers to an indicator"""
+    return 'ge_series_%d_%d' % (indicator_id, user_id)
+
+
+def _version_cache_key(indicator_id, user_id):
+    """Key under which to cache the current version of a users answers to an indicator"""
+    return 'ge_series_version_%d_%d' % (indicator_id, user_id)
+
+
+def graph_cache_key(indicator, from_user, to_user):
+    """Key under which to cache graph data for indicator between two users"""
+    return 'ge_graph_%d_%d_%d' % (indicator.id, from_user.id, to_user.id)
+
+
+def _new_version():
+    """A version number for a changed answer list"""
+    return random.getrandbits(48)
+
+
+def user_rows(indicator, user):
+    """The non-skipped answers of user to indicator, ordered by action_date, from 
+    the cache if possible.
+    @return Tuple of (version, list of AnswerRow)
+    """
+    from indicator.models import Answer
+
+    cache_key = _rows_cache_key(indicator.id, user.id)
+    version_key = _version_cache_key(indicator.id, user.id)
+
+    cached = cache.get_many([cache_key, version_key])
+    version = cached.get(version_key)
+    if version is None:
+        cache.add(version_key, _new_version())
+        # A fresh one if it was evicted again already. The list won't be reused.
+        version = cache.get(version_key) or _new_version()
+
+    result = cached.get(cache_key)
+    if result is None or result[0] != version:
+        # Version read before the answers, so if an answer is saved in between, 
+        # this list is out of date as soon as it's cached
+        result = (version, answer_rows(Answer.objects.by_indicator(user, indicator)))
+        cache.set(cache_key, result)
+    return result
+
+
+def answer_changed(indicator_id, user_id):
+    """Gives the cached answers of user to indicator a new version, so the next 
+    user_rows reads them again. Call whenever an answer is saved.
+    The whole list is re-read, not just the changed day: patching the cached list 
+    lets two saves at once leave a list missing one of them behind.
+    """
+    cache.set(_version_cache_key(indicator_id, user_id), _new_version())
+
+
+def mean(rows):
+    """Average of the answer values in rows, like Indicator.moving_average 
+    with no days_back. 0 if there are none"""
+    values = [row.answer_num for row in rows if row.answer_num is not None]
+    if not values:
+        return 0
+    return sum(values) / float(len(values))
+
+
+def graph_series(from_rows, to_rows, window_size=30):
+    """Data for graphing, in one pass over dense date-indexed arrays.
+
+    @param from_rows List of (id, action_date, answer_num) for the from user, by action_date
+    @param to_rows Same for the to user
+    @param window_size Number of answers to include in each moving average
+    @return Tuple of five values. The first four are lists of [date, value],
+    same as Indicator.answers_with_average:
+    - from_data, to_data, from_avgs, to_avgs.
+    The fifth is a list of the ids of from answers on days the to user has no answer.
+    Those days use the from value for the to user.
+    """
+    if not from_rows and not to_rows:
+        return [], [], [], [], []
+
+    all_ordinals = [row[1].toordinal() for row in from_rows] + \
+                   [row[1].toordinal() for row in to_rows]
+    start = min(all_ordinals)
+    length = max(all_ordinals) - start + 1
+
+    from_present, from_values, from_avgs, from_ids = _dense(from_rows, start, length, window_size)
+    to_present, to_values, to_avgs, _ = _dense(to_rows, start, length, window_size)
+
+    # This can happen if the back-end worker fell over or is slow.
+    # No value for avg yet, so pretend avg has same value as user
+    missing = from_present & ~to_present
+    to_values[missing] = from_values[missing]
+    to_avgs[missing] = from_values[missing]
+    missing_ids = from_ids[missing].tolist()
+
+    order = numpy.nonzero(from_present | to_present)[0]
+    dates = [datetime.date.fromordinal(start + i) for i in order.tolist()]
+
+    def pairs(values):
+        'List of [date, value] for the dates in order which have a value'
+        selected = values[order]
+        keep = ~numpy.isnan(selected)
+        return [[action_date, value]
+                for action_date, value, is_kept in zip(dates, selected.tolist(), keep.tolist())
+                if is_kept]
+
+    return (pairs(from_values), pairs(to_values), pairs(from_avgs), pairs(to_avgs), missing_ids)
+
+
+def _dense(rows, start, length, window_size):
+    """Spreads rows over an array with one slot per day from ordinal start.
+    @return Tuple of arrays: (has answer, answer_num, moving average, answer id).
+    Days without a value are NaN.
+    """
+    present = numpy.zeros(length, dtype=bool)
+    values = numpy.empty(length)
+    values.fill(numpy.nan)
+    avgs = values.copy()
+    ids = numpy.zeros(length, dtype=numpy.int64)
+
+    if not rows:
+        return present, values, avgs, ids
+
+    index = numpy.array([row[1].toordinal() for row in rows]) - start
+    nums = numpy.array([numpy.nan if row[2] is None else row[2] for row in rows], dtype=float)
+
+    present[index] = True
+    values[index] = nums
+    ids[index] = [row[0] for row in rows]
+
+    # Moving average over the last window_size answers, from cumulative sums.
+    # Zero and missing answers are not averaged.
+    is_valid = ~numpy.isnan(nums) & (nums != 0)
+    valid_nums = nums[is_valid]
+    sums = numpy.concatenate(([0.0], numpy.cumsum(valid_nums)))
+    upper = numpy.arange(1, len(valid_nums) + 1)
+    lower = numpy.maximum(upper - window_size, 0)
+    avgs[index[is_valid]] = (sums[upper] - sums[lower]) / (upper - lower)
+
+    return present, values, avgs, ids
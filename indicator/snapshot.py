@@ -0,0 +1,330 @@
+"""Columnar snapshots of a campaigns data, for reporting without the production database.
+
+A snapshot is a directory per campaign, holding one NumPy .npy file per column:
+
+    campaign_<id>/
+        manifest.json           Days written, and when
+        answers/YYYY-MM-DD/     One directory per action_date, written once
+        indicators/ profiles/ groups/           Rewritten on each run
+        memberships/ campaign_memberships/      Rewritten on each run
+
+Each run only writes the answers for days that aren't in the snapshot yet, up to 
+settings.SNAPSHOT_OPEN_DAYS before today (people can still answer the days after that).
+The averages are the answers of the average users, so they are in answers too. 
+
+Readers get the columns memory-mapped (numpy.load mmap_mode='r'), so nothing is 
+copied until it is used. With compress=True each partition is one .npz file instead, 
+which is smaller but has to be read into memory.
+
+Needs NumPy. If it is not installed 'numpy' is None here.
+"""
+
+#    Copyright 2010,2011 Good Energy Research Inc. <graham@goodenergy.ca>, <jeremy@goodenergy.ca>
+#    
+#    This file is part of Good Energy.
+#    
+#    Good Energy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    
+#    Good Energy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#    
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Good Energy. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import json
+import shutil
+import datetime
+
+from django.conf import settings
+from django.db.models import Q, Min
+
+try:
+    import numpy
+except ImportError:     # pylint: disable-msg=W0704
+    numpy = None
+
+from indicator.models import Indicator, Answer
+from profile.models import Profile, Group
+from campaign.models import CampaignMembership
+
+DATE_FORMAT = '%Y-%m-%d'
+MANIFEST = 'manifest.json'
+TMP_SUFFIX = '.tmp'
+
+# Column name and dtype of each table. Missing numbers are NaN, missing ids -1.
+ANSWER_COLUMNS = [
+    ('id', 'int64'),
+    ('indicator_id', 'int32'),
+    ('user_id', 'int32'),
+    ('answer_num', 'float64'),
+    ('is_skip', 'bool'),
+    ('created', 'datetime64[s]'),
+    ]
+
+INDICATOR_COLUMNS = [
+    ('id', 'int32'),
+    ('position', 'int32'),
+    ('indicator_type', 'unicode'),
+    ('name', 'unicode'),
+    ('is_synthetic', 'bool'),
+    ]
+
+PROFILE_COLUMNS = [
+    ('id', 'int32'),
+    ('is_system_user', 'bool'),
+    ('participation_points', 'int32'),
+    ('inspiration_points', 'int32'),
+    ('created', 'datetime64[s]'),
+    ]
+
+GROUP_COLUMNS = [
+    ('id', 'int32'),
+    ('name', 'unicode'),
+    ('avg_user_id', 'int32'),
+    ]
+
+MEMBERSHIP_COLUMNS = [
+    ('group_id', 'int32'),
+    ('user_id', 'int32'),
+    ]
+
+CAMPAIGN_MEMBERSHIP_COLUMNS = [
+    ('user_id', 'int32'),
+    ('join_date', 'datetime64[D]'),
+    ('compared_to_average', 'float64'),
+    ]
+
+
+def campaign_dir(path, campaign_id):
+    'Directory of a campaigns snapshot under path'
+    return os.path.join(path, 'campaign_%d' % campaign_id)
+
+
+def write(campaign, path, until=None, compress=False, rebuild=False):
+    """Brings the snapshot of campaign under path up to date.
+    @param until Last action_date to write. Defaults to SNAPSHOT_OPEN_DAYS before today.
+    @param compress Write each partition as one compressed .npz, see module doc
+    @param rebuild Forget the days already written, and write them all again
+    @return List of the action_dates written
+    """
+    base = campaign_dir(path, campaign.id)
+    if rebuild and os.path.exists(base):
+        shutil.rmtree(base)
+    if not os.path.exists(base):
+        os.makedirs( os.path.join(base, 'answers') )
+
+    manifest = read_manifest(path, campaign.id)
+    done = set(manifest['days'])
+
+    if not until:
+        until = datetime.date.today() - datetime.timedelta(settings.SNAPSHOT_OPEN_DAYS)
+
+    indicator_list = list( Indicator.objects.filter(campaign = campaign).order_by('position') )
+    indicator_ids = [indicator.id for indicator in indicator_list]
+
+    if campaign.is_fixed_dates:
+        day = campaign.start_date
+        until = min(until, campaign.end_date)
+    else:
+        # Runs from each users join date, so the campaign dates don't bound the answers
+        day = Answer.objects.filter(indicator_id__in = indicator_ids).\
+                aggregate(first = Min('action_date'))['first']
+
+    written = []
+    while day and day <= until:
+        if day.strftime(DATE_FORMAT) not in done:
+            _write_partition(base, 'answers', day.strftime(DATE_FORMAT), 
+                    _answer_columns(indicator_ids, day), compress)
+            written.append(day)
+
+            # After each day, so an interrupted run carries on from there
+            manifest['days'].append( day.strftime(DATE_FORMAT) )
+            _write_manifest(base, manifest, compress)
+
+        day += datetime.timedelta(1)
+
+    for name, columns in _dimension_tables(campaign, indicator_list):
+        _write_partition(base, '', name, columns, compress)
+    _write_manifest(base, manifest, compress)
+
+    return written
+
+
+def read_manifest(path, campaign_id):
+    """The manifest of a campaigns snapshot, as a dict: 'days' is the list of 
+    action_dates written (YYYY-MM-DD), 'compress' and 'updated' are from the last run."""
+    filename = os.path.join(campaign_dir(path, campaign_id), MANIFEST)
+    if not os.path.exists(filename):
+        return {'campaign_id': campaign_id, 'days': []}
+
+    manifest_file = open(filename)
+    try:
+        return json.load(manifest_file)
+    finally:
+        manifest_file.close()
+
+
+def days(path, campaign_id):
+    'The action_dates in the snapshot, oldest first'
+    return sorted([datetime.datetime.strptime(day, DATE_FORMAT).date() 
+                   for day in read_manifest(path, campaign_id)['days']])
+
+
+def read_answers(path, campaign_id, start=None, end=None):
+    """The answers in the snapshot, a day at a time.
+    @param start, end First and last action_date to read. Default is all.
+    @return Iterator of (action_date, dict of column name: array), oldest first
+    """
+    base = campaign_dir(path, campaign_id)
+    for day in days(path, campaign_id):
+        if (start and day < start) or (end and day > end):
+            continue
+        yield day, _read_partition(os.path.join(base, 'answers'), day.strftime(DATE_FORMAT))
+
+
+def read_table(path, campaign_id, name):
+    """One of the tables rewritten on each run: 'indicators', 'profiles', 'groups', 
+    'memberships' (of groups) or 'campaign_memberships' (with the users scores).
+    @return dict of column name: array
+    """
+    return _read_partition(campaign_dir(path, campaign_id), name)
+
+
+def _answer_columns(indicator_ids, day):
+    'The columns of the answers to the given indicators on day'
+    rows = Answer.objects.\
+            filter(indicator_id__in = indicator_ids, action_date = day).\
+            order_by('id').\
+            values_list('id', 'indicator_id', 'user_id', 'answer_num', 'is_skip', 'created')
+    return _columns(ANSWER_COLUMNS, rows)
+
+
+def _dimension_tables(campaign, indicator_list):
+    'List of (name, columns) of the tables rewritten on each run'
+
+    indicator_rows = [(ind.id, ind.position, ind.indicator_type, ind.name, ind.is_synthetic) 
+                      for ind in indicator_list]
+
+    profile_rows = Profile.objects.\
+            filter( Q(organization = campaign.organization) | Q(is_system_user = True) ).\
+            order_by('id').\
+            values_list('id', 'is_system_user', 'participation_points', 
+                    'inspiration_points', 'created')
+
+    group_list = Group.objects.filter(organization = campaign.organization).order_by('id')
+    group_rows = [(group.id, group.name, group.avg_user_id) for group in group_list]
+
+    membership_rows = Profile.groups.through.objects.\
+            filter(group__organization = campaign.organization).\
+            order_by('group', 'profile').\
+            values_list('group', 'profile')
+
+    campaign_membership_rows = CampaignMembership.objects.\
+            filter(campaign = campaign).\
+            order_by('user').\
+            values_list('user', 'join_date', 'compared_to_average')
+
+    return [
+        ('indicators', _columns(INDICATOR_COLUMNS, indicator_rows)),
+        ('profiles', _columns(PROFILE_COLUMNS, profile_rows)),
+        ('groups', _columns(GROUP_COLUMNS, group_rows)),
+        ('memberships', _columns(MEMBERSHIP_COLUMNS, membership_rows)),
+        ('campaign_memberships', _columns(CAMPAIGN_MEMBERSHIP_COLUMNS, campaign_membership_rows)),
+        ]
+
+
+def _columns(column_types, rows):
+    """Turns rows (tuples in the order of column_types) into one array per column.
+    @return List of (column name, array)
+    """
+    rows = list(rows)
+    result = []
+    for index, (name, dtype) in enumerate(column_types):
+        values = [row[index] for row in rows]
+
+        if dtype == 'float64':
+            values = [numpy.nan if value is None else value for value in values]
+        elif dtype == 'int32':
+            values = [-1 if value is None else value for value in values]
+        elif dtype == 'unicode':
+            values = [value or u'' for value in values]
+
+        result.append( (name, numpy.array(values, dtype=dtype)) )
+    return result
+
+
+def _write_partition(base, subdir, name, columns, compress):
+    """Writes columns as base/subdir/name/<column>.npy, or base/subdir/name.npz. 
+    Writes to a temporary name first, so readers never see half a partition."""
+    parent = os.path.join(base, subdir)
+
+    if compress:
+        final = os.path.join(parent, name +'.npz')
+        tmp = final + TMP_SUFFIX
+        tmp_file = open(tmp, 'wb')
+        try:
+            numpy.savez_compressed(tmp_file, **dict(columns))
+        finally:
+            tmp_file.close()
+    else:
+        final = os.path.join(parent, name)
+        tmp = final + TMP_SUFFIX
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for column_name, values in columns:
+            numpy.save(os.path.join(tmp, column_name +'.npy'), values)
+
+    # Either format might be there from an earlier run
+    _remove( os.path.join(parent, name) )
+    _remove( os.path.join(parent, name +'.npz') )
+    os.rename(tmp, final)
+
+
+def _read_partition(parent, name):
+    'Reads a partition written by _write_partition, memory-mapped if it is not compressed'
+    compressed = os.path.join(parent, name +'.npz')
+    if os.path.exists(compressed):
+        npz = numpy.load(compressed)
+        try:
+            return dict( (column_name, npz[column_name]) for column_name in npz.files )
+        finally:
+            npz.close()
+
+    directory = os.path.join(parent, name)
+    result = {}
+    for filename in os.listdir(directory):
+        column_name, ext = os.path.splitext(filename)
+        if ext == '.npy':
+            result[column_name] = numpy.load(os.path.join(directory, filename), mmap_mode='r')
+    return result
+
+
+def _write_manifest(base, manifest, compress):
+    'Replaces the manifest in base'
+    manifest['compress'] = compress
+    manifest['updated'] = datetime.datetime.now().isoformat()
+
+    filename = os.path.join(base, MANIFEST)
+    tmp_file = open(filename + TMP_SUFFIX, 'w')
+    try:
+        json.dump(manifest, tmp_file, indent=2)
+    finally:
+        tmp_file.close()
+    os.rename(filename + TMP_SUFFIX, filename)
+
+
+def _remove(filename):
+    'Deletes a file or directory, if it exists'
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    elif os.path.exists(filename):
+        os.remove(filename)
@@ -0,0 +1,6 @@
+-- Run by syncdb after creating indicator_answer. 
+-- The unique (user_id, indicator_id, action_date) index comes from Answer.Meta.unique_together.
+-- For an existing database, run: ./manage.py ge_answer_schema indexes
+
+-- Daily averages, participation and exports: one indicator on one day, or a range of days
+CREATE INDEX indicator_answer_indicator_date ON indicator_answer (indicator_id, action_date);
@@ -27,13 +27,14 @@
 
 from django.conf.urls.defaults  import patterns, url
 
-from indicator.views import answer_create_single, answer_table, questions_json
+from indicator.views import answer_create_single, answer_create_bulk, answer_table, questions_json
 from indicator.views import create_edit, indicator_list, delete, indicators_csv, answers_csv
 
 urlpatterns = patterns('',
   
   url(r'^input/(?P<indicator_id>\d+)/$', answer_create_single, name='single_input_with_id'),
   url(r'^input/$', answer_create_single, name='single_input'),
+  url(r'^input/all/$', answer_create_bulk, name='bulk_input'),
   
   url(r'^questions.json$', questions_json, name='questions_json'),
   url(r'^all.csv$', indicators_csv, name='indicators_csv'),
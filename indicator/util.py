@@ -20,9 +20,38 @@
 #
 
 
+import math
+
+try:
+    import numpy
+except ImportError:     # pylint: disable-msg=W0704
+    numpy = None
+
+
 def answer_map_by_date(answer_list):
     'Converts an iterable of answers into a map of action_date:answer_num'
     result = {}
     for answer in answer_list:
         result[answer.action_date] = answer.answer_num
     return result    
+
+
+def likert_percentage(num, num_choices):
+    """A likert answer as a percentage: the first choice is 0%, the last 100%.
+    No answer (0 or None) is 0%."""
+    if not num:
+        return 0
+    return math.ceil( (num-1) * (100.0 / (num_choices-1)) )
+
+
+def likert_percentages(nums, num_choices):
+    """likert_percentage of each of nums, in one go if NumPy is installed.
+    @return List of percentages, same order as nums
+    """
+    if not numpy:
+        return [likert_percentage(num, num_choices) for num in nums]
+
+    values = numpy.array([num or 0 for num in nums], dtype=float)
+    result = numpy.ceil( (values - 1) * (100.0 / (num_choices - 1)) )
+    result[values == 0] = 0
+    return result.tolist()
@@ -25,7 +25,6 @@
 # pylint: disable-msg=E1103
 
 import datetime
-import csv
 
 from django.shortcuts               import render_to_response, get_object_or_404
 from django.template                import RequestContext
@@ -37,7 +36,9 @@ from profile.models     import Profile
 from indicator.models   import Indicator, Answer
 from indicator.forms    import indicator_form, IndicatorCreateEditForm
 from campaign.models    import Campaign
-from core.util          import get_current_organization, chop_campaign, ge_login_required
+from core.util          import get_current_organization, get_current_campaign
+from core.util          import chop_campaign, ge_login_required
+from core               import export
 
 class IndicatorView():
     'A display version of Indicator'
@@ -109,6 +110,57 @@ def answer_create_single(request, campaign_slug=None, indicator_id=None):
 
     return redirect_to_indicator(request, campaign_slug=campaign_slug) 
 
+@ge_login_required
+def answer_create_bulk(request, campaign_slug=None):
+    """POST response to all of the current campaigns indicators for a day at once.
+    Saves the answers in one transaction, and queues one average job for them.
+
+    POST fields, for each indicator answered: 'answer_<indicator id>' with the value,
+    or 'skip_<indicator id>' = 1 to skip it. Indicators not mentioned are left alone.
+     
+    @return: For AJAX call HttpResponse OK if success, ERROR plus some detail if failure.
+    For an HTTP call, redirect to next indicator
+    """
+
+    if request.method != 'POST':
+        return redirect_to_indicator(request, campaign_slug=campaign_slug) 
+
+    geuser = request.user.get_profile()
+    campaign = get_current_campaign()
+
+    answer_values = []
+    for indicator in Indicator.objects.all_regular_indicators(campaign):
+
+        if request.POST.get('skip_%d' % indicator.id) == '1':
+            answer_values.append( (indicator, None, True) )
+            continue
+
+        value = request.POST.get('answer_%d' % indicator.id)
+        if value is None or value == '':
+            continue
+
+        try:
+            answer_num = int(value)
+        except ValueError:
+            answer_num = None
+        if answer_num is None or not indicator.is_valid_answer(answer_num):
+            return HttpResponse(
+                    'ERROR - Invalid answer for indicator {id}'.format(id=indicator.id),
+                    mimetype='text/plain')
+
+        answer_values.append( (indicator, answer_num, False) )
+
+    if not answer_values:
+        return HttpResponse('ERROR - No answers', mimetype='text/plain')
+
+    yesterday = geuser.local_datetime().date() - datetime.timedelta(1)
+    Answer.objects.save_day(geuser, campaign, yesterday, answer_values)
+
+    if request.is_ajax():
+        return HttpResponse('OK')
+
+    return redirect_to_indicator(request, campaign_slug=campaign_slug) 
+
 def answer_table(request, user_id):
     "Displays a table of all the users answers"
     
@@ -123,11 +175,13 @@ def answer_table(request, user_id):
     first_date = None
     last_date = None
     answer_map = {} 
-    for answer in Answer.objects.filter(user = user).order_by('created', 'indicator__name'):
+    answer_list = Answer.objects.prefetch_indicators( 
+            Answer.objects.filter(user = user).order_by('action_date', 'created') )
+    for answer in answer_list:
         if not first_date:
             first_date = answer.action_date
         last_date = answer.action_date
-        answer_map[ str(answer.action_date) +'_'+ str(answer.indicator.id) ] = answer
+        answer_map[ str(answer.action_date) +'_'+ str(answer.indicator_id) ] = answer
     
     answers = []
     current_date = first_date
@@ -268,11 +322,22 @@ def indicators_csv(request):
     org = current_user.organization
     campaign_list = Campaign.objects.filter(organization = org)
 
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=indicators.csv'
+    def row_chunks():
+        'One chunk per campaign'
+        for campaign in campaign_list:
+            yield [[
+                campaign.id,
+                campaign.name,
+                indicator.id,
+                indicator.content_type,
+                indicator.position,
+                indicator.name,
+                indicator.question,
+                indicator.description,
+                indicator.created
+                ] for indicator in Indicator.objects.load_concrete(campaign.indicator_set.all())]
 
-    writer = csv.writer(response)
-    writer.writerow([
+    return export.csv_response('indicators.csv', [
         'Campaign Id',
         'Campaign Name',
         'Indicator Id',
@@ -282,70 +347,62 @@ def indicators_csv(request):
         'Question',
         'description',
         'created'
-        ])
-
-    for campaign in campaign_list:
-        for indicator in campaign.indicator_set.all():
-            writer.writerow([
-                campaign.id,
-                campaign.name,
-                indicator.id,
-                indicator.subclass().content_type,
-                indicator.position,
-                indicator.name,
-                indicator.question,
-                indicator.description,
-                indicator.created
-                ])
-
-    return response
+        ], row_chunks())
+
+ANSWERS_CSV_HEADER = [
+    'Answer Id',
+    'Indicator Id',
+    'User Id',
+    'Action Date',
+    'Numeric Value',
+    'Text Value',
+    'Is Skip',
+    'Created'
+    ]
+
+def answers_csv_chunks(indicator_ids, start, end):
+    """Rows of answers.csv for the answers to the given indicators between 
+    start and end (see core.export.date_range), a chunk at a time, 
+    by action_date then id"""
+
+    queryset = export.filter_dates(
+            Answer.objects.filter(indicator_id__in = indicator_ids), 'action_date', start, end)
+
+    for answer_list in export.in_chunks(queryset, order_field = 'action_date'):
+        Answer.objects.prefetch_indicators(answer_list)
+        yield [[
+            answer.id,
+            answer.indicator_id,
+            answer.user_id,
+            answer.action_date,
+            answer.answer_num,
+            answer.value if answer.indicator else '',
+            answer.is_skip,
+            answer.created
+            ] for answer in answer_list]
 
 @ge_login_required
 @chop_campaign
 def answers_csv(request):
-    'CSV of the answers for this users indicators'
+    """CSV of the answers for this users indicators.
+    GET params 'start' and 'end' (YYYY-MM-DD) select the action dates, 
+    default is the last 30 days."""
 
     current_user = request.user.get_profile()
     if not current_user.user.is_staff:
         raise PermissionDenied('Only administrators can view this file')
 
+    try:
+        start, end = export.date_range(request.GET, default_days=30)
+    except ValueError:
+        return HttpResponse('ERROR - Dates must be YYYY-MM-DD', mimetype='text/plain')
+
     org = current_user.organization
     campaign_ids = Campaign.objects.filter(organization = org).values_list('id', flat=True)
-    indicator_ids = Indicator.objects.\
+    indicator_ids = list( Indicator.objects.\
             filter(campaign__id__in = campaign_ids).\
-            values_list('id', flat=True)
+            values_list('id', flat=True) )
     
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=answers.csv'
-
-    writer = csv.writer(response)
-    writer.writerow([
-        'Answer Id',
-        'Indicator Id',
-        'User Id',
-        'Action Date',
-        'Numeric Value',
-        'Text Value',
-        'Is Skip',
-        'Created'
-        ])
-
-    start_date = datetime.datetime.now() - datetime.timedelta(30)
-    answer_list = Answer.objects.filter(
-            indicator_id__in = indicator_ids, 
-            action_date__gt = start_date).order_by('action_date')
-    for answer in answer_list:
-
-        writer.writerow([
-            answer.id,
-            answer.indicator_id,
-            answer.user_id,
-            answer.action_date,
-            answer.answer_num,
-            answer.answer_text,
-            answer.is_skip,
-            answer.created
-            ])
-
-    return response
+    return export.csv_response('answers.csv', 
+            ANSWERS_CSV_HEADER, answers_csv_chunks(indicator_ids, start, end))
 
@@ -140,7 +140,6 @@ class RegistrationForm(forms.Form):
             try:
                 referer = Profile.objects.get(pk = long(referer_id))
                 referer.add_participation_points(points=5)
-                referer.save()
 
                 geuser.referer = referer
             except (Profile.DoesNotExist, ValueError):
@@ -264,6 +263,7 @@ class SettingsForm(forms.Form):
         self.geuser.employer = self.cleaned_data['employer']
         self.geuser.postal_code = self.cleaned_data['postal_code']
 
-        self.geuser.save()
+        # Not save(): the cached profile can have old points
+        self.geuser.save_fields('is_new_user', 'timezone', 'employer', 'postal_code')
         return self.geuser
 
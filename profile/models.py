@@ -113,6 +113,7 @@ class Profile(models.Model):
     
     about = models.TextField(blank=True, null=True, 
                 help_text='User editable section of profile')
+    # No longer updated: scores are per campaign, see CampaignMembership.compared_to_average
     compared_to_average = models.FloatField(default=0,
                 help_text='How does this user compare to the overall average?')
     participation_points = models.IntegerField(default=1)
@@ -172,37 +173,47 @@ class Profile(models.Model):
 
     def rank(self, campaign):
         """School type grade for how well user is doing"""
-        exact = self.ranking(campaign)
-        total = campaign.users.count()
-
-        num_rank = int((float(exact) / total) * len(GRADES))
-
-        # Very last user gets 6, so move down to 5
-        return GRADES[min(num_rank, 5)] 
+        from campaign import leaderboard
+        return leaderboard.get(campaign).grade(self.id)
 
     def ranking(self, campaign):
         """Order in total campaign participants of this user on 
         overall indicator"""
-
-        num_above = campaign.users\
-                .filter(compared_to_average__gt=self.compared_to_average)\
-                .count()
+        from campaign import leaderboard
 
         # If no-one is better than us, we rank as number 1, and so on down
-        return num_above + 1  
+        return leaderboard.get(campaign).rank(self.id)
+
+    def save_fields(self, *field_names):
+        """Writes just the given fields, so the rest of a stale (cached) copy of this 
+        Profile doesn't overwrite newer values. Drops the cached copies of this Profile
+        and of its auth User (like save, which refreshes both), so a User saved 
+        alongside, e.g. by SettingsForm, is re-read too."""
+        Profile.objects.filter(pk = self.id).\
+                update(**dict( [(name, getattr(self, name)) for name in field_names] ))
+        cache.delete(Profile.objects.cache_key_geuser(self.user_id))
+        cache.delete(Profile.objects.cache_key_auth_user(self.user_id))
+
+    def add_to(self, **deltas):
+        """Adds to counter fields, e.g. add_to(inspiration_points=1), in one update of 
+        just those columns, so concurrent requests don't lose counts. 
+        Drops the cached copy of this Profile."""
+        Profile.objects.filter(pk = self.id).\
+                update(**dict( [(name, models.F(name) + delta) for name, delta in deltas.items()] ))
+        cache.delete(Profile.objects.cache_key_geuser(self.user_id))
+
+        for name, delta in deltas.items():
+            setattr(self, name, getattr(self, name) + delta)
 
     def add_participation_points(self, points=1):
-        """Adds participation points to this users total. Saves the user"""
-        self.participation_points += points 
-        self.save()
+        """Adds participation points to this users total, see add_to"""
+        self.add_to(participation_points = points)
 
     def give_inspiration_point(self, geuser):
         """Give someone an inspiration point from our credit"""
 
-        self.inspiration_points_credit -= 1
-        geuser.inspiration_points += 1
-        self.save()
-        geuser.save()
+        self.add_to(inspiration_points_credit = -1)
+        geuser.add_to(inspiration_points = 1)
 
     def profile_pic_filename(self, abspath=False, ext=None, variant=None):
         """Path of the original profile picture they uploaded.
@@ -278,19 +289,8 @@ class Profile(models.Model):
         comments = EntryComment.objects.filter(who=self).count() 
     
         self.participation_points = answers + status_updates + comments
-        self.save()
+        self.save_fields('participation_points')
     
-    def update_compared_to_average(self, campaign, action_date):
-        """Updates the compared_to_average field for given campaign and day"""
-        from indicator.models import Indicator
-        
-        overall = Indicator.objects.overall_indicator(campaign)
-        _, new_distance = overall.compared_to_average(self, action_date)
-
-        if self.compared_to_average != new_distance:
-            self.compared_to_average = new_distance
-            self.save()
-        
     def local_datetime(self):
         """The current datetime in this users timezone: 
             datetime.datetime.now() with correct tz"""
@@ -25,7 +25,6 @@
 # pylint: disable-msg=E1103
 
 import os.path
-import csv
 import random
 import operator
 from json import JSONEncoder
@@ -47,13 +46,14 @@ from django.http                    import HttpResponseNotAllowed
 from profile.forms          import LoginForm, RegistrationForm, SettingsForm
 from profile.models         import Profile
 from profile.view_objects   import ProfileView
-from core                   import gravatar
+from core                   import gravatar, export
 from core.models            import ShortURL
 from core.util              import get_current_organization, json_encoder_default, chop_campaign
+from core.util              import get_current_campaign
 from core.util              import ge_login_required
 from profile.forms          import PasswordResetForm
 from profile.util           import save_picture
-from campaign.models        import Campaign
+from campaign.models        import Campaign, CampaignMembership
 from status.models          import Entry
 from status.view_objects    import EntryView
 
@@ -254,7 +254,7 @@ def crop(request, campaign_slug):
             new_profile_pic = request.FILES['picture']
             relative_pic_name = save_picture(geuser, new_profile_pic)
             geuser.avatar = relative_pic_name
-            geuser.save()
+            geuser.save_fields('avatar')
 
             crop_url = reverse('profile_crop', kwargs={'campaign_slug': campaign_slug})
             return HttpResponseRedirect(crop_url)
@@ -271,7 +271,7 @@ def crop(request, campaign_slug):
             resized.save( geuser.profile_pic_filename(abspath=True) )
             
             geuser.avatar = geuser.profile_pic_filename(abspath=False)
-            geuser.save()
+            geuser.save_fields('avatar')
 
             # Clear status dashboard from cache so new pic will show
             for campaign in geuser.campaign_set.all():
@@ -398,7 +398,7 @@ def about(request):
     elif request.method == 'POST':
         new_about = request.POST['about']
         geuser.about = new_about
-        geuser.save()
+        geuser.save_fields('about')
         return HttpResponseRedirect(geuser.get_absolute_url())
         
     else:
@@ -407,23 +407,51 @@ def about(request):
 @ge_login_required
 @chop_campaign
 def users_csv(request):
-    'Output a CSV file of all the users for this organizations campaigns'
+    """Output a CSV file of all the users for this organizations campaigns.
+    Compared to average is their score in the current campaign, blank if they 
+    are not in it.
+    GET params 'start' and 'end' (YYYY-MM-DD) select by date joined, default is all."""
 
     current_user = request.user.get_profile()
     if not current_user.user.is_staff:
         raise PermissionDenied('Only administrators can view this file')
 
+    try:
+        start, end = export.date_range(request.GET)
+    except ValueError:
+        return HttpResponse('ERROR - Dates must be YYYY-MM-DD', mimetype='text/plain')
+
     org = current_user.organization
+    campaign = get_current_campaign()
 
-    user_list = Profile.objects.\
+    user_qs = Profile.objects.\
             filter(organization = org, is_system_user = False).\
-            select_related(depth=1)
-
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=users.csv'
-
-    writer = csv.writer(response)
-    writer.writerow([
+            select_related('user')
+    user_qs = export.filter_dates(user_qs, 'created', start, end)
+
+    def row_chunks():
+        'Rows of the CSV, a chunk of users at a time'
+        for user_list in export.in_chunks(user_qs):
+            scores = dict( CampaignMembership.objects.\
+                    filter(campaign = campaign, user__in = [geuser.id for geuser in user_list]).\
+                    values_list('user', 'compared_to_average') )
+            yield [[
+                geuser.id,
+                geuser.user.username,
+                geuser.user.first_name,
+                geuser.user.last_name,
+                geuser.user.email,
+                geuser.avatar,
+                geuser.timezone,
+                scores.get(geuser.id, ''),
+                geuser.participation_points,
+                geuser.inspiration_points,
+                geuser.created,
+                geuser.user.last_login,
+                geuser.about
+                ] for geuser in user_list]
+
+    return export.csv_response('users.csv', [
         'User Id',
         'Username', 
         'First name', 
@@ -436,26 +464,7 @@ def users_csv(request):
         'Inspiration Points', 
         'Created', 
         'Last Login', 
-        'About'])
-
-    for geuser in user_list:
-        writer.writerow([
-            geuser.id,
-            geuser.user.username,
-            geuser.user.first_name,
-            geuser.user.last_name,
-            geuser.user.email,
-            geuser.avatar,
-            geuser.timezone,
-            geuser.compared_to_average,
-            geuser.participation_points,
-            geuser.inspiration_points,
-            geuser.created,
-            geuser.user.last_login,
-            geuser.about
-            ])
-
-    return response
+        'About'], row_chunks())
 
 @chop_campaign
 def is_email_registered(request):
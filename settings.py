@@ -233,12 +233,52 @@ COMPRESS_CSS = {
     }
 }
 
+# Message queue between the web app and the worker: 'gearman', or 'local' for
+# an SQLite file at LOCAL_QUEUE_PATH (single box setups and load tests)
+MESSAGING_BACKEND = 'gearman'
+LOCAL_QUEUE_PATH = os.path.join(ROOT_DIR, 'queue.sqlite')
+
 GEARMAN_SERVERS = ["127.0.0.1"]
 #DAEMON_PIDFILE = os.path.join(ROOT_DIR, 'gedaemon.pid')
 
 SHORT_URL_DOMAIN = 'http://ge1.ca/'     # Must have ending slash
 
 #MAX_WORKER_THREADS = 10
+
+# ge_worker collects average jobs for this long, then recomputes each
+# distinct indicator / day / group set once
+AVERAGE_BATCH_SECONDS = 2
+
+# How ge_worker runs the average recomputes: 'thread' runs them one at a time 
+# in a background thread, 'process' spreads them over a pool of WORKER_PROCESSES 
+# processes, each of which is replaced after WORKER_MAX_JOBS_PER_PROCESS jobs (Python 2.7+).
+WORKER_MODE = 'thread'
+WORKER_PROCESSES = 4
+WORKER_MAX_JOBS_PER_PROCESS = 1000
+
+# Average jobs ge_worker accepts before it stops taking jobs from Gearman
+WORKER_QUEUE_SIZE = 5000
+
+# On SIGTERM, how long ge_worker waits for accepted jobs to finish
+WORKER_DRAIN_SECONDS = 30
+
+# How long the results page waits for the worker to update the averages after
+# a user answers their last indicator, before showing the previous averages
+RESULTS_WAIT_SECONDS = 3
+
+# Indicators are cached in each process as well as in memcached, see indicator.catalog.
+# Most entries to keep per process, and how often to check memcached for changes.
+CATALOG_SIZE = 500
+CATALOG_CHECK_SECONDS = 5
+
+# CSV exports read this many rows at a time, see core.export
+EXPORT_CHUNK_SIZE = 2000
+
+# Columnar snapshots of campaign data, see indicator.snapshot. Where to write them,
+# and how many recent days are left out because people can still answer them.
+SNAPSHOT_DIR = os.path.join(ROOT_DIR, 'snapshots')
+SNAPSHOT_OPEN_DAYS = 2
+
 setup_logging()
 
 try:
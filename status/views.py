@@ -34,7 +34,7 @@ from django.core.exceptions         import PermissionDenied
 from django.template                import RequestContext
 from django.template.loader         import render_to_string
 
-from campaign.models        import Campaign
+from campaign.models        import Campaign, CampaignStats, CampaignMembership
 from core.util              import get_current_organization, get_current_user, json_encoder_default
 from core.util              import chop_campaign, ge_login_required
 from status.models          import Entry, EntryComment
@@ -54,6 +54,8 @@ def create(request, campaign_slug=None):
                   msg = request.POST['status'],
                   campaign = campaign)
     entry.save()
+    CampaignStats.objects.add(campaign, geuser, num_ideas = 1)
+    CampaignMembership.objects.touch(campaign, geuser)
     EntryView.refresh_recent_activity(campaign)
     Entry.objects.clear_dashboard_cache(campaign)
 